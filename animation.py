@@ -0,0 +1,97 @@
+import os
+from typing import List, Tuple
+
+import numpy as np
+
+from camera import Camera
+
+
+class CameraPath:
+    """
+    A camera path through a scene, given by keyframes: the cameras of some of the frames,
+    in increasing order of their frame numbers. The cameras of the frames between every two
+    keyframes are interpolated linearly, and the frames after the last keyframe keep its
+    camera.
+    """
+
+    def __init__(self, keyframes: List[Tuple[int, Camera]]):
+        if not keyframes:
+            raise ValueError("A camera path needs at least one keyframe")
+        self.keyframes = sorted(keyframes, key=lambda keyframe: keyframe[0])
+        if self.keyframes[0][0] != 0:
+            raise ValueError("A camera path's first keyframe must be frame 0")
+        frames = [frame for frame, _ in self.keyframes]
+        if len(set(frames)) != len(frames):
+            raise ValueError("A camera path can't have two keyframes of the same frame")
+
+    @property
+    def frame_count(self) -> int:
+        """
+        The number of frames up to the last keyframe, including it.
+        """
+        return self.keyframes[-1][0] + 1
+
+    def camera_at(self, frame: int) -> Camera:
+        frames = [keyframe_frame for keyframe_frame, _ in self.keyframes]
+        after = np.searchsorted(frames, frame, side="right")
+        if after == len(frames):
+            return self.keyframes[-1][1]
+        start_frame, start = self.keyframes[after - 1]
+        end_frame, end = self.keyframes[after]
+        fraction = (frame - start_frame) / (end_frame - start_frame)
+        return Camera(
+            start.position + fraction * (end.position - start.position),
+            start.look_at + fraction * (end.look_at - start.look_at),
+            start.up_vector + fraction * (end.up_vector - start.up_vector),
+            start.screen_distance
+            + fraction * (end.screen_distance - start.screen_distance),
+            start.screen_width + fraction * (end.screen_width - start.screen_width),
+        )
+
+    def cameras(self, frame_count: int) -> List[Camera]:
+        """
+        Return the cameras of the first frame_count frames.
+        """
+        return [self.camera_at(frame) for frame in range(frame_count)]
+
+
+def parse_camera_path(file_path: str, camera: Camera) -> CameraPath:
+    """
+    Parse a camera path file, in the format of the scene files: every line is a keyframe,
+    "key frame px py pz lx ly lz ux uy uz", optionally followed by the screen's distance and
+    width, like a "cam" line with the frame's number first. Keyframes without them keep the
+    given camera's (usually the scene's).
+    """
+    keyframes = []
+    with open(file_path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            parts = line.split()
+            obj_type = parts[0]
+            params = [float(p) for p in parts[1:]]
+            if obj_type != "key":
+                raise ValueError("Unknown object type: {}".format(obj_type))
+            if len(params) not in (10, 12):
+                raise ValueError(f"A keyframe has 10 or 12 parameters: {line}")
+            screen = params[10:] or [camera.screen_distance, camera.screen_width]
+            keyframes.append(
+                (
+                    int(params[0]),
+                    Camera(params[1:4], params[4:7], params[7:10], *screen),
+                )
+            )
+    return CameraPath(keyframes)
+
+
+def frame_path(pattern: str, frame: int) -> str:
+    """
+    Return the path of a frame's image: the pattern formatted with the frame's number, like
+    "frames/{frame:04d}.png", or for patterns without a {frame} field, the pattern's name with
+    the frame's number appended, like "frames/fly_0007.png" for "frames/fly.png".
+    """
+    if "{frame" in pattern:
+        return pattern.format(frame=frame)
+    root, extension = os.path.splitext(pattern)
+    return f"{root}_{frame:04d}{extension}"
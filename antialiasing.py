@@ -0,0 +1,54 @@
+import numpy as np
+
+from consts import COLOR_SCALE
+from sampling import grid_cell_indices
+
+
+def edge_scores(img_mat: np.ndarray, surface_indices: np.ndarray) -> np.ndarray:
+    """
+    Return a (height, width) array of how much every pixel of the image needs more samples:
+    its largest color difference from any of its 4 neighbors, as a fraction of COLOR_SCALE
+    in its most different channel, plus 1 if any of its neighbors' primary rays hit another
+    surface, so that geometric edges come before shading changes.
+    :param img_mat: The (height, width, COLOR_CHANNELS) image, rendered with one sample per
+    pixel.
+    :param surface_indices: The (height, width) array of the surfaces the pixels' primary
+    rays hit, or -1.
+    """
+    colors = img_mat / COLOR_SCALE
+    scores = np.zeros(surface_indices.shape)
+    for axis in (0, 1):
+        differences = np.abs(np.diff(colors, axis=axis)).max(axis=2)
+        differences += np.diff(surface_indices, axis=axis) != 0
+        first = (slice(None),) * axis + (slice(None, -1),)
+        second = (slice(None),) * axis + (slice(1, None),)
+        np.maximum(scores[first], differences, out=scores[first])
+        np.maximum(scores[second], differences, out=scores[second])
+    return scores
+
+
+def select_pixels(scores: np.ndarray, threshold: float, max_count: int) -> np.ndarray:
+    """
+    Return the sorted flat indices of the pixels whose score is above the threshold, keeping
+    only the max_count highest scoring ones if there are more.
+    """
+    scores = scores.ravel()
+    selected = np.flatnonzero(scores > threshold)
+    if len(selected) > max_count:
+        order = np.argsort(-scores[selected], kind="stable")
+        selected = np.sort(selected[order[:max_count]])
+    return selected
+
+
+def stratified_pixel_offsets(
+    rng: np.random.Generator, count: int, root_number_samples: int
+) -> np.ndarray:
+    """
+    Return a (count, root_number_samples^2, 2) array of random (row, column) offsets from
+    pixels' centers, in pixels, one in every cell of a root_number_samples x
+    root_number_samples grid over each pixel.
+    """
+    row_indices, col_indices = grid_cell_indices(root_number_samples)
+    cells = np.stack([row_indices, col_indices], axis=1)
+    jitter = rng.random((count, len(cells), 2))
+    return (cells + jitter) / root_number_samples - 0.5
@@ -1,12 +1,19 @@
-from typing import List, Optional, Tuple
+from typing import Iterator, List, Optional, Tuple, Union
 
 import numpy as np
 
-from material import Material
+import stats
+import vector
+from consts import EPSILON, INTERSECTION_BATCH_SIZE
+from material import Material, MaterialArrays
 from ray import Ray
 
 
 class Surface:
+    # Scenes may have millions of surfaces, which are only a few numbers each, so they don't
+    # carry an attribute dictionary.
+    __slots__ = ("material",)
+
     def __init__(self, material: Material):
         self.material = material
 
@@ -16,11 +23,106 @@ class Surface:
         """
         raise NotImplementedError()
 
-    def reflection_ray(self, ray: Ray, intersection: np.ndarray) -> Ray:
+    def intersect_many(self, sources: np.ndarray, directions: np.ndarray) -> np.ndarray:
+        """
+        Receive (N, 3) arrays of ray sources and directions, and return an (N,) array of the
+        ray parameters t of the intersections with the surface, or inf where they don't intersect.
+        """
+        parameters = self.stack_parameters([self])
+        return self.intersect_stacked(parameters, sources, directions)[:, 0]
+
+    @classmethod
+    def stack_parameters(cls, surfaces: List["Surface"]) -> Tuple[np.ndarray, ...]:
+        """
+        Receive a list of surfaces of this type, and return their geometric parameters stacked
+        into arrays, in the format expected by intersect_stacked.
+        """
+        raise NotImplementedError()
+
+    @classmethod
+    def unstack_parameters(
+        cls, parameters: Tuple[np.ndarray, ...], materials: List[Material]
+    ) -> List["Surface"]:
+        """
+        The inverse of stack_parameters, receive the stacked parameters of surfaces of this
+        type and their materials, and return the surfaces.
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def stacked_bounding_boxes(
+        parameters: Tuple[np.ndarray, ...],
+    ) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Receive the stacked parameters of S surfaces of this type, and return a pair of (S, 3)
+        arrays of the minimal and maximal corners of their axis aligned bounding boxes,
+        or None if surfaces of this type are unbounded.
+        """
+        return None
+
+    @staticmethod
+    def stacked_near_segment(
+        parameters: Tuple[np.ndarray, ...],
+        start: np.ndarray,
+        end: np.ndarray,
+        radius: float,
+    ) -> np.ndarray:
+        """
+        Receive the stacked parameters of S unbounded surfaces of this type, and return an
+        (S,) boolean array of whether they may come within radius of the segment from start
+        to end, see occluders.LightOccluders. Bounded surfaces are tested by their bounding
+        boxes instead. The test is conservative, by default every surface may.
+        """
+        return np.ones(len(parameters[0]), dtype=bool)
+
+    @staticmethod
+    def intersect_stacked(
+        parameters: Tuple[np.ndarray, ...],
+        sources: np.ndarray,
+        directions: np.ndarray,
+    ) -> np.ndarray:
+        """
+        Receive the stacked parameters of S surfaces of this type and (N, 3) arrays of ray
+        sources and directions, and return an (N, S) array of the ray parameters t of the
+        intersections of every ray with every surface, or inf where they don't intersect.
+        """
+        raise NotImplementedError()
+
+    @classmethod
+    def intersect_stacked_all(
+        cls,
+        parameters: Tuple[np.ndarray, ...],
+        sources: np.ndarray,
+        directions: np.ndarray,
+    ) -> np.ndarray:
+        """
+        Like intersect_stacked, but return an (N, S, 2) array of the ray parameters t of all
+        the points where every ray crosses every surface's boundary (entering and leaving
+        it), or inf where it doesn't. Surfaces which are crossed at most once per ray only
+        fill the first entry.
+        """
+        t = cls.intersect_stacked(parameters, sources, directions)
+        return np.stack([t, np.full_like(t, np.inf)], axis=2)
+
+    def hit_record(self, ray: Ray, t: float, index: int) -> "HitRecord":
+        """
+        Return the record of the ray's hit with the surface at the ray parameter t, where
+        index is the surface's index in the scene.
+        """
+        point = ray.at(t)
+        return HitRecord(
+            t, index, self, point, self.normal_at_point(point, ray.direction)
+        )
+
+    def reflection_ray(
+        self, ray: Ray, intersection: np.ndarray, normal: Optional[np.ndarray] = None
+    ) -> Ray:
         """
         Receive a ray and intersection point on the surface, and return the reflected ray.
+        The surface's normal at the point is calculated, unless it's given.
         """
-        normal = self.normal_at_point(intersection, ray.direction)
+        if normal is None:
+            normal = self.normal_at_point(intersection, ray.direction)
         reflection_vec = ray.direction - 2 * (ray.direction @ normal) * normal
         reflection_vec /= np.linalg.norm(reflection_vec)
         return Ray(intersection, reflection_vec)
@@ -31,37 +133,558 @@ class Surface:
         """
         raise NotImplementedError()
 
+    def orient_normal(self, normal: np.ndarray, ray_vec: np.ndarray) -> np.ndarray:
+        """
+        Receive the normal at a point on the surface, and return it as normal_at_point would
+        for a ray with the given direction. Only two-sided surfaces, whose normals face the
+        rays, change it.
+        """
+        return normal
+
+    def normals_at_points(self, points: np.ndarray, ray_vecs: np.ndarray) -> np.ndarray:
+        """
+        The batched version of normal_at_point, receive (N, 3) arrays of points on the surface
+        and ray directions, and return an (N, 3) array of the normals at these points.
+        """
+        parameters = self.stack_parameters([self])
+        rows = np.zeros(len(points), dtype=np.int64)
+        return self.stacked_normals_at_points(parameters, rows, points, ray_vecs)
+
+    @staticmethod
+    def stacked_normals_at_points(
+        parameters: Tuple[np.ndarray, ...],
+        rows: np.ndarray,
+        points: np.ndarray,
+        ray_vecs: np.ndarray,
+        faces: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """
+        Receive the stacked parameters of S surfaces of this type, an (N,) array of the rows
+        of the surfaces the given (N, 3) points are on, and the (N, 3) directions of the rays
+        that hit them, and return an (N, 3) array of the normals at the points.
+        :param faces: An optional (N,) array of the faces the rays hit, for surfaces whose
+        hits have them, see stacked_hit_faces.
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def stacked_hit_faces(
+        parameters: Tuple[np.ndarray, ...],
+        rows: np.ndarray,
+        sources: np.ndarray,
+        directions: np.ndarray,
+    ) -> np.ndarray:
+        """
+        Receive the stacked parameters of S surfaces of this type, an (N,) array of the rows
+        of the surfaces the given (N, 3) rays hit, and return an (N,) array of the faces they
+        hit, see HitRecord. By default surfaces have no faces, and it's all -1.
+        """
+        return np.full(len(rows), -1, dtype=np.int64)
+
+
+class SurfaceGroups:
+    """
+    The surfaces of a scene, grouped by their type, with the parameters of every group stacked
+    into arrays, so that a batch of rays is intersected with all the surfaces of a type in a
+    single NumPy pass. It behaves like the list of surfaces it's built from.
+    The surfaces share a table of their distinct materials, stacked into MaterialArrays, and
+    the material of every surface is looked up by its row in the table, its material id.
+    :param surfaces: The surfaces, or None for surfaces that only exist as their groups'
+    stacked parameters, see scene_cache.CompiledScene.to_objects. The batched renderers only
+    use the groups, and the surfaces' objects are only built from them (once) when they're
+    first needed, by the scalar renderer.
+    :param groups: Optional precomputed groups, in the format of the groups attribute, for
+    surfaces whose parameters are already stacked. Required without surfaces.
+    :param materials: An optional precomputed table of the surfaces' materials, given with
+    the (S,) array of their material_ids. Required without surfaces.
+    """
+
+    def __init__(
+        self,
+        surfaces: Optional[List[Surface]],
+        groups: Optional[List[Tuple[type, np.ndarray, Tuple[np.ndarray, ...]]]] = None,
+        materials: Optional[MaterialArrays] = None,
+        material_ids: Optional[np.ndarray] = None,
+    ):
+        self._surfaces = None if surfaces is None else list(surfaces)
+        # An optional acceleration structure over the bounded surfaces, see bvh.BVH.
+        self.bvh = None
+        # The surfaces' indices by their ids, built on the first call to index_of.
+        self._surface_indices = None
+
+        if groups is None:
+            indices_by_type = {}
+            for index, surface in enumerate(self.surfaces):
+                indices_by_type.setdefault(type(surface), []).append(index)
+            groups = [
+                (
+                    surface_type,
+                    np.array(indices, dtype=np.int64),
+                    surface_type.stack_parameters([self.surfaces[i] for i in indices]),
+                )
+                for surface_type, indices in indices_by_type.items()
+            ]
+        self.groups = groups
+        if materials is None:
+            distinct = {}
+            for surface in self.surfaces:
+                distinct.setdefault(id(surface.material), surface.material)
+            rows = {key: row for row, key in enumerate(distinct)}
+            material_ids = np.array(
+                [rows[id(surface.material)] for surface in self.surfaces],
+                dtype=np.int64,
+            )
+            materials = MaterialArrays(list(distinct.values()))
+        self.materials = materials
+        self.material_ids = material_ids
+        # The fraction of light every surface lets through, for the transparent shadows.
+        self.transparencies = materials.transparency[material_ids]
+        # The group of every surface, and its row in the group's parameters.
+        self.group_ids = np.empty(len(material_ids), dtype=np.int64)
+        self.group_rows = np.empty(len(material_ids), dtype=np.int64)
+        for group_id, (_, group_indices, _) in enumerate(groups):
+            self.group_ids[group_indices] = group_id
+            self.group_rows[group_indices] = np.arange(len(group_indices))
+
+    @property
+    def surfaces(self) -> List[Surface]:
+        if self._surfaces is None:
+            materials = self.materials.unstack()
+            surface_materials = [materials[i] for i in self.material_ids.tolist()]
+            self._surfaces = [None] * len(self.material_ids)
+            for surface_type, group_indices, parameters in self.groups:
+                group_indices = group_indices.tolist()
+                for index, surface in zip(
+                    group_indices,
+                    surface_type.unstack_parameters(
+                        parameters, [surface_materials[i] for i in group_indices]
+                    ),
+                ):
+                    self._surfaces[index] = surface
+        return self._surfaces
+
+    def __getstate__(self) -> dict:
+        # The surfaces' indices are keyed by their ids, which don't survive pickling.
+        state = self.__dict__.copy()
+        state["_surface_indices"] = None
+        return state
+
+    def __len__(self) -> int:
+        return len(self.material_ids)
+
+    def __iter__(self) -> Iterator[Surface]:
+        return iter(self.surfaces)
+
+    def __getitem__(self, index: int) -> Surface:
+        return self.surfaces[index]
+
+    def index_of(self, surface: Optional[Surface]) -> int:
+        """
+        Return the index of the given surface in the scene, or -1 if it's None.
+        """
+        if surface is None:
+            return -1
+        if self._surface_indices is None:
+            self._surface_indices = {
+                id(surface): index for index, surface in enumerate(self.surfaces)
+            }
+        return self._surface_indices[id(surface)]
+
+
+class HitRecord:
+    """
+    The closest hit of a ray: the ray parameter t of the intersection, the index of the hit
+    surface in the scene and the surface itself, the intersection point, and the surface's
+    normal there (as normal_at_point returns it for the ray), found once so that shading and
+    the secondary rays reuse it.
+    For cubes, face is the index of the hit face in cube.NORMALS, and otherwise it's -1.
+    """
+
+    __slots__ = ("t", "index", "surface", "point", "normal", "face")
+
+    def __init__(
+        self,
+        t: float,
+        index: int,
+        surface: Surface,
+        point: np.ndarray,
+        normal: np.ndarray,
+        face: int = -1,
+    ):
+        self.t = t
+        self.index = index
+        self.surface = surface
+        self.point = point
+        self.normal = normal
+        self.face = face
+
+
+def as_surface_groups(surfaces: Union[List[Surface], SurfaceGroups]) -> SurfaceGroups:
+    return surfaces if isinstance(surfaces, SurfaceGroups) else SurfaceGroups(surfaces)
+
 
 def get_closest_surface(
     ray: Ray,
-    surfaces: List[Surface],
+    surfaces: Union[List[Surface], SurfaceGroups],
     source_surface: Surface = None,
 ) -> Tuple[Surface, np.ndarray]:
     """
     Receive a ray and the list of surfaces, and return a pair of the closest surface and its
     intersection point with the ray.
     :param ray: The shot ray.
-    :param surfaces: A list of the surfaces in the scene.
+    :param surfaces: The surfaces in the scene, preferably already grouped by SurfaceGroups.
     :param source_surface: An optional parameter indicating the surface, the ray is shot from.
     This surface will be ignored when searching for the closest surface.
     :returns: A pair of the closest surface and the intersection point.
     """
-    closest_surface = None
-    closest_intersection = None
-    min_dist = float("inf")
+    hit = get_closest_hit(ray, surfaces, source_surface)
+    if hit is None:
+        return None, None
+    return hit.surface, hit.point
+
+
+def get_closest_hit(
+    ray: Ray,
+    surfaces: Union[List[Surface], SurfaceGroups],
+    source_surface: Surface = None,
+) -> Optional[HitRecord]:
+    """
+    Like get_closest_surface, but return the record of the ray's closest hit, or None if it
+    doesn't hit any surface.
+    """
+    surfaces = as_surface_groups(surfaces)
+    closest_indices, closest_t = get_closest_surfaces(
+        ray.source[np.newaxis, :],
+        ray.direction[np.newaxis, :],
+        surfaces,
+        source_indices=np.array([surfaces.index_of(source_surface)]),
+    )
+    index = int(closest_indices[0])
+    if index == -1:
+        return None
+    return surfaces[index].hit_record(ray, float(closest_t[0]), index)
+
+
+@stats.timed("intersection")
+def get_closest_surfaces(
+    sources: np.ndarray,
+    directions: np.ndarray,
+    surfaces: Union[List[Surface], SurfaceGroups],
+    source_indices: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The batched version of get_closest_surface.
+    Every type of surface is intersected with all the rays in one pass, in chunks of at most
+    INTERSECTION_BATCH_SIZE ray-surface pairs.
+    :param sources: An (N, 3) array of the rays' sources.
+    :param directions: An (N, 3) array of the rays' (normalized) directions.
+    :param surfaces: The surfaces in the scene.
+    :param source_indices: An optional (N,) array of the indices of the surfaces the rays are
+    shot from, or -1 for rays which aren't shot from a surface.
+    :returns: A pair of (N,) arrays, the index of the closest surface (-1 for rays that don't
+    hit any surface) and the ray parameter t of the intersection with it (inf for misses).
+    """
+    surfaces = as_surface_groups(surfaces)
+    closest_indices = np.full(len(sources), -1, dtype=np.int64)
+    min_t = np.full(len(sources), np.inf)
+    rows = np.arange(len(sources))
+    group_batch_size = max(1, INTERSECTION_BATCH_SIZE // max(1, len(sources)))
+
+    for surface_type, group_indices, parameters in surfaces.groups:
+        if surfaces.bvh is not None and surface_type in surfaces.bvh.surface_types:
+            continue
+        for start in range(0, len(group_indices), group_batch_size):
+            batch = slice(start, start + group_batch_size)
+            t = surface_type.intersect_stacked(
+                tuple(parameter[batch] for parameter in parameters),
+                sources,
+                directions,
+            )
+            stats.count("tests." + surface_type.__name__, t.size)
+            update_closest_surfaces(
+                closest_indices,
+                min_t,
+                rows,
+                t,
+                group_indices[batch],
+                source_indices,
+            )
+
+    if surfaces.bvh is not None:
+        surfaces.bvh.update_closest_surfaces(
+            sources, directions, closest_indices, min_t, source_indices
+        )
+
+    return closest_indices, min_t
+
+
+@stats.timed("intersection")
+def get_all_hits(
+    sources: np.ndarray,
+    directions: np.ndarray,
+    surfaces: Union[List[Surface], SurfaceGroups],
+    source_indices: Optional[np.ndarray] = None,
+    max_t: Optional[np.ndarray] = None,
+    groups: Optional[List[Tuple[type, np.ndarray, Tuple[np.ndarray, ...]]]] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Return all the points where the rays cross the surfaces' boundaries, in a single pass.
+    The hits are returned in a compressed sparse row layout: the hits of ray i are found at
+    [offsets[i], offsets[i + 1]), sorted by their distance along the ray, with ties broken in
+    favor of the surface that appears first in the scene, so the first hit of every ray is
+    the one get_closest_surfaces finds.
+    :param sources: An (N, 3) array of the rays' sources.
+    :param directions: An (N, 3) array of the rays' (normalized) directions.
+    :param surfaces: The surfaces in the scene.
+    :param source_indices: An optional (N,) array of the surfaces the rays are shot from,
+    which are ignored, or -1.
+    :param max_t: An optional (N,) array of the ray parameters beyond which hits are ignored.
+    :param groups: Optional groups of the only surfaces the rays may hit, which are
+    intersected instead of all the surfaces (and their BVH), see are_segments_occluded.
+    :returns: A tuple of the (N + 1,) offsets, and the (H,) arrays of the hits' surface
+    indices and ray parameters t.
+    """
+    surfaces = as_surface_groups(surfaces)
+    if max_t is None:
+        max_t = np.full(len(sources), np.inf)
+    hit_rays, hit_surfaces, hit_t = [], [], []
+    group_batch_size = max(1, INTERSECTION_BATCH_SIZE // max(1, 2 * len(sources)))
 
-    for surface in surfaces:
-        if surface == source_surface:
+    bvh = surfaces.bvh if groups is None else None
+    for surface_type, group_indices, parameters in (
+        surfaces.groups if groups is None else groups
+    ):
+        if bvh is not None and surface_type in bvh.surface_types:
             continue
+        for start in range(0, len(group_indices), group_batch_size):
+            batch = slice(start, start + group_batch_size)
+            t = surface_type.intersect_stacked_all(
+                tuple(parameter[batch] for parameter in parameters),
+                sources,
+                directions,
+            )
+            stats.count("tests." + surface_type.__name__, t.shape[0] * t.shape[1])
+            rays, columns, _ = np.nonzero(t < max_t[:, np.newaxis, np.newaxis])
+            hit_rays.append(rays)
+            hit_surfaces.append(group_indices[batch][columns])
+            hit_t.append(t[t < max_t[:, np.newaxis, np.newaxis]])
+
+    if bvh is not None:
+        rays, surface_indices, t = bvh.collect_hits(sources, directions, max_t)
+        hit_rays.append(rays)
+        hit_surfaces.append(surface_indices)
+        hit_t.append(t)
+
+    hit_rays = np.concatenate(hit_rays or [np.empty(0, dtype=np.int64)])
+    hit_surfaces = np.concatenate(hit_surfaces or [np.empty(0, dtype=np.int64)])
+    hit_t = np.concatenate(hit_t or [np.empty(0)])
+    if source_indices is not None:
+        kept = hit_surfaces != source_indices[hit_rays]
+        hit_rays, hit_surfaces, hit_t = hit_rays[kept], hit_surfaces[kept], hit_t[kept]
+
+    order = np.lexsort((hit_surfaces, hit_t, hit_rays))
+    offsets = np.zeros(len(sources) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(hit_rays, minlength=len(sources)), out=offsets[1:])
+    return offsets, hit_surfaces[order], hit_t[order]
+
 
-        intersection = surface.intersect(ray)
-        if intersection is None:
+def update_closest_surfaces(
+    closest_indices: np.ndarray,
+    min_t: np.ndarray,
+    rows: np.ndarray,
+    t: np.ndarray,
+    surface_indices: np.ndarray,
+    source_indices: Optional[np.ndarray] = None,
+) -> None:
+    """
+    Update the closest hits found so far with the intersections of some of the rays with
+    some of the surfaces.
+    :param closest_indices: The (N,) array of the closest surfaces found so far, updated in place.
+    :param min_t: The (N,) array of the closest hits' ray parameters, updated in place.
+    :param rows: An (R,) array of the indices of the intersected rays.
+    :param t: An (R, S) array of the ray parameters of the intersections.
+    :param surface_indices: An (S,) array of the indices of the intersected surfaces.
+    :param source_indices: An optional (N,) array of the surfaces the rays are shot from,
+    which are ignored.
+    """
+    if source_indices is not None:
+        t[source_indices[rows, np.newaxis] == surface_indices[np.newaxis, :]] = np.inf
+
+    # Ties are broken in favor of the surface that appears first in the scene,
+    # like the scalar search does.
+    closest = np.argmin(t, axis=1)
+    closest_t = t[np.arange(len(rows)), closest]
+    candidates = surface_indices[closest]
+    current_t = min_t[rows]
+    closer = (closest_t < current_t) | (
+        (closest_t == current_t)
+        & np.isfinite(closest_t)
+        & (candidates < closest_indices[rows])
+    )
+    closest_indices[rows[closer]] = candidates[closer]
+    min_t[rows[closer]] = closest_t[closer]
+
+
+@stats.timed("occlusion")
+def are_segments_occluded(
+    sources: np.ndarray,
+    dests: np.ndarray,
+    surfaces: Union[List[Surface], SurfaceGroups],
+    groups: Optional[List[Tuple[type, np.ndarray, Tuple[np.ndarray, ...]]]] = None,
+) -> np.ndarray:
+    """
+    Receive (N, 3) arrays of segments' start and end points, and return an (N,) boolean array
+    which is True for the segments that are blocked by a surface before reaching their end.
+    Unlike get_closest_surfaces, this is an any-hit query: a segment is dropped from the
+    search as soon as any blocker is found, so the search stops early for occluded segments.
+    Hits within EPSILON of the end point are considered to be on the end point's surface.
+    :param groups: Optional groups of the only surfaces that may block the segments, in the
+    format of SurfaceGroups.groups, which are intersected instead of all the surfaces (and
+    their BVH), see occluders.LightOccluders.
+    """
+    surfaces = as_surface_groups(surfaces)
+    directions = dests - sources
+    distances = np.linalg.norm(directions, axis=1)
+    directions /= distances[:, np.newaxis]
+    max_t = distances - EPSILON
+
+    occluded = np.zeros(len(sources), dtype=bool)
+    rays = np.arange(len(sources))
+    bvh = surfaces.bvh if groups is None else None
+    for surface_type, group_indices, parameters in (
+        surfaces.groups if groups is None else groups
+    ):
+        if bvh is not None and surface_type in bvh.surface_types:
             continue
+        group_batch_size = max(1, INTERSECTION_BATCH_SIZE // max(1, len(rays)))
+        for start in range(0, len(group_indices), group_batch_size):
+            if len(rays) == 0:
+                return occluded
+            batch = slice(start, start + group_batch_size)
+            t = surface_type.intersect_stacked(
+                tuple(parameter[batch] for parameter in parameters),
+                sources[rays],
+                directions[rays],
+            )
+            stats.count("tests." + surface_type.__name__, t.size)
+            blocked = np.any(t < max_t[rays, np.newaxis], axis=1)
+            occluded[rays[blocked]] = True
+            rays = rays[~blocked]
+
+    if bvh is not None and len(rays) > 0:
+        bvh.update_occluded(sources, directions, max_t, occluded, rays)
+
+    return occluded
+
+
+def segment_transmittances(
+    sources: np.ndarray,
+    dests: np.ndarray,
+    surfaces: Union[List[Surface], SurfaceGroups],
+    groups: Optional[List[Tuple[type, np.ndarray, Tuple[np.ndarray, ...]]]] = None,
+) -> np.ndarray:
+    """
+    Receive (N, 3) arrays of segments' start and end points, and return an (N,) array of the
+    fraction of light that passes along every segment: the product of the transparencies of
+    the surfaces that block it before its end, each counted once however many times the
+    segment crosses its boundary. Unblocked segments get 1, and like in are_segments_occluded,
+    hits within EPSILON of the end point are considered to be on the end point's surface.
+    For groups, see are_segments_occluded.
+    """
+    surfaces = as_surface_groups(surfaces)
+    directions = dests - sources
+    distances = np.linalg.norm(directions, axis=1)
+    directions /= distances[:, np.newaxis]
+    offsets, hit_surfaces, _ = get_all_hits(
+        sources, directions, surfaces, max_t=distances - EPSILON, groups=groups
+    )
+    hit_rays = np.repeat(np.arange(len(sources)), np.diff(offsets))
+    blockers = np.unique(hit_rays * len(surfaces) + hit_surfaces)
+    transmittances = np.ones(len(sources))
+    np.multiply.at(
+        transmittances,
+        blockers // len(surfaces),
+        surfaces.transparencies[blockers % len(surfaces)],
+    )
+    return transmittances
 
-        dist = np.linalg.norm(intersection - ray.source)
-        if dist < min_dist:
-            closest_surface = surface
-            closest_intersection = intersection
-            min_dist = dist
 
-    return closest_surface, closest_intersection
+def _group_rows(
+    surfaces: SurfaceGroups, surface_indices: np.ndarray
+) -> Iterator[Tuple[type, Tuple[np.ndarray, ...], np.ndarray, np.ndarray]]:
+    """
+    Sort the given surfaces by their groups once, and yield the type and the parameters of
+    every group with any of them, with the positions in surface_indices of its surfaces, and
+    their rows in the group.
+    """
+    group_ids = surfaces.group_ids[surface_indices]
+    order = np.argsort(group_ids, kind="stable")
+    bounds = np.searchsorted(group_ids[order], np.arange(len(surfaces.groups) + 1))
+    for group_id, (surface_type, _, parameters) in enumerate(surfaces.groups):
+        selected = order[bounds[group_id] : bounds[group_id + 1]]
+        if len(selected) > 0:
+            rows = surfaces.group_rows[surface_indices[selected]]
+            yield surface_type, parameters, selected, rows
+
+
+def normals_at_points(
+    surfaces: Union[List[Surface], SurfaceGroups],
+    surface_indices: np.ndarray,
+    points: np.ndarray,
+    ray_vecs: np.ndarray,
+    faces: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Return an (N, 3) array of the normals at the given points, where the i-th point lies on
+    the surface at index surface_indices[i].
+    The points are sorted by the groups of their surfaces once, and the normals of every
+    group's points are calculated together, see Surface.stacked_normals_at_points.
+    :param faces: An optional (N,) array of the faces of the hits at the points, see
+    hit_faces.
+    """
+    surfaces = as_surface_groups(surfaces)
+    normals = np.empty_like(points)
+    for surface_type, parameters, selected, rows in _group_rows(
+        surfaces, surface_indices
+    ):
+        normals[selected] = surface_type.stacked_normals_at_points(
+            parameters,
+            rows,
+            points[selected],
+            ray_vecs[selected],
+            None if faces is None else faces[selected],
+        )
+    return normals
+
+
+def hit_faces(
+    surfaces: Union[List[Surface], SurfaceGroups],
+    surface_indices: np.ndarray,
+    sources: np.ndarray,
+    directions: np.ndarray,
+) -> np.ndarray:
+    """
+    The batched version of HitRecord's faces: return an (N,) array of the faces the given
+    rays hit the surfaces at surface_indices on, or -1 for surfaces without faces, see
+    Surface.stacked_hit_faces.
+    """
+    surfaces = as_surface_groups(surfaces)
+    faces = np.empty(len(surface_indices), dtype=np.int64)
+    for surface_type, parameters, selected, rows in _group_rows(
+        surfaces, surface_indices
+    ):
+        faces[selected] = surface_type.stacked_hit_faces(
+            parameters, rows, sources[selected], directions[selected]
+        )
+    return faces
+
+
+def reflection_directions(directions: np.ndarray, normals: np.ndarray) -> np.ndarray:
+    """
+    The batched version of Surface.reflection_ray, return the reflected directions of the rays
+    with the given directions, off the surfaces with the given normals.
+    """
+    reflections = (
+        directions - 2 * vector.dot_rows(directions, normals)[:, np.newaxis] * normals
+    )
+    return vector.normalize_rows(reflections)
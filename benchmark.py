@@ -0,0 +1,343 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from base_surface import SurfaceGroups, get_closest_hit, get_closest_surface
+from consts import COLOR_CHANNELS
+from cube import Cube
+from infinite_plane import InfinitePlane
+from material import Material
+from ray import Ray
+from ray_tracer import RayTracer
+from scene import parse_scene_file
+from sphere import Sphere
+from tiles import split_into_tiles
+
+SCENES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scenes")
+BENCHMARK_SCENES = [
+    "original",
+    "pool",
+    "pool-boxes",
+    "Transparency",
+    "Room1",
+    "all-scene",
+    "MyScene3",
+]
+BENCHMARK_FORMAT_VERSION = 1
+# The number of calls every microbenchmark makes.
+MICROBENCHMARK_CALLS = 1000
+
+
+def render_case(
+    scene_name: str, size: int, root_number_shadow_rays: int, seed: int
+) -> Tuple[Dict[str, float], np.ndarray]:
+    """
+    Render a scene once, tile by tile with a fixed seed so the image is reproducible, and
+    return a pair of the times of its phases and ray counts, and the rendered image.
+    """
+    phases = {}
+    start = time.perf_counter()
+    camera, scene_settings, surfaces, lights = parse_scene_file(
+        os.path.join(SCENES_DIR, scene_name + ".txt")
+    )
+    scene_settings.root_number_shadow_rays = root_number_shadow_rays
+    phases["parse"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ray_tracer = RayTracer(camera, scene_settings, surfaces, lights)
+    phases["build"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    img_mat = np.zeros((size, size, COLOR_CHANNELS))
+    shadow_rays = 0
+    for tile in split_into_tiles(size, size):
+        shadow_rays += ray_tracer.render_tile(img_mat, tile, seed).sum()
+    phases["render"] = time.perf_counter() - start
+
+    statistics = ray_tracer.ray_tree_statistics
+    counts = {
+        "primary_rays": size * size,
+        "secondary_rays": statistics.spawned - statistics.pruned,
+        "shadow_rays": int(shadow_rays),
+    }
+    return {**phases, **counts}, np.uint8(img_mat)
+
+
+def run_scene_benchmarks(
+    scene_names: List[str],
+    sizes: List[int],
+    shadow_ray_roots: List[int],
+    repeat: int,
+    seed: int,
+) -> Tuple[List[dict], Dict[str, np.ndarray]]:
+    """
+    Render every combination of scene, size and number of shadow rays. Every case is first
+    rendered under tracemalloc, to measure its peak memory, and then timed repeat times,
+    keeping the fastest run.
+    Return a pair of the cases' results, and their images keyed by the cases' names.
+    """
+    results = []
+    images = {}
+    for scene_name in scene_names:
+        for size in sizes:
+            for root_number_shadow_rays in shadow_ray_roots:
+                name = f"{scene_name}_{size}_{root_number_shadow_rays}"
+                tracemalloc.start()
+                _, images[name] = render_case(
+                    scene_name, size, root_number_shadow_rays, seed
+                )
+                _, peak_memory = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+                runs = [
+                    render_case(scene_name, size, root_number_shadow_rays, seed)[0]
+                    for _ in range(repeat)
+                ]
+                best = min(runs, key=lambda run: run["render"])
+                rays = (
+                    best["primary_rays"] + best["secondary_rays"] + best["shadow_rays"]
+                )
+                result = {
+                    "name": name,
+                    "scene": scene_name,
+                    "size": size,
+                    "root_number_shadow_rays": root_number_shadow_rays,
+                    "phases": {
+                        phase: best[phase] for phase in ("parse", "build", "render")
+                    },
+                    "primary_rays": best["primary_rays"],
+                    "secondary_rays": best["secondary_rays"],
+                    "shadow_rays": best["shadow_rays"],
+                    "rays_per_second": rays / best["render"],
+                    "primary_rays_per_second": best["primary_rays"] / best["render"],
+                    "peak_memory": peak_memory,
+                }
+                results.append(result)
+                print(
+                    f"{name:28} {best['render']:8.3f}s "
+                    f"{result['rays_per_second']:12.0f} rays/s "
+                    f"{peak_memory / 2**20:8.1f} MiB",
+                    file=sys.stderr,
+                )
+    return results, images
+
+
+def _random_rays(rng: np.random.Generator, count: int) -> List[Ray]:
+    """
+    Return rays from random points around the origin, aimed at random points near it,
+    so that about half of them hit the microbenchmarks' surfaces.
+    """
+    sources = rng.uniform(-5, 5, (count, 3))
+    targets = rng.uniform(-1, 1, (count, 3))
+    return [Ray.ray_between_points(s, t) for s, t in zip(sources, targets)]
+
+
+def microbenchmarks(seed: int) -> Dict[str, Callable[[], None]]:
+    """
+    Return the microbenchmarks, functions which each make a fixed number of calls to one of
+    the renderer's scalar hot paths.
+    """
+    rng = np.random.default_rng(seed)
+    rays = _random_rays(rng, MICROBENCHMARK_CALLS)
+    material = Material([1, 0, 0], [1, 1, 1], [0, 0, 0], 10, 0)
+    sphere = Sphere([0, 0, 0], 1, material)
+    cube = Cube([0, 0, 0], 1.5, material)
+    plane = InfinitePlane([0, 1, 0], -1, material)
+
+    _, _, surfaces, lights = parse_scene_file(os.path.join(SCENES_DIR, "pool.txt"))
+    surfaces = SurfaceGroups(surfaces)
+    light = lights[0]
+    points = [ray.at(t) for ray, t in zip(rays, rng.uniform(0, 2, len(rays)))]
+
+    def intersect_all(surface):
+        return lambda: [surface.intersect(ray) for ray in rays]
+
+    return {
+        "Sphere.intersect": intersect_all(sphere),
+        "Cube.intersect": intersect_all(cube),
+        "InfinitePlane.intersect": intersect_all(plane),
+        "get_closest_surface": lambda: [
+            get_closest_surface(ray, surfaces) for ray in rays
+        ],
+        "get_closest_hit": lambda: [get_closest_hit(ray, surfaces) for ray in rays],
+        "Light.calculate_intensity": lambda: [
+            light.calculate_intensity(surfaces, 3, point, rng) for point in points
+        ],
+    }
+
+
+def run_microbenchmarks(repeat: int, seed: int) -> List[dict]:
+    results = []
+    for name, benchmark in microbenchmarks(seed).items():
+        best = min(timeit.repeat(benchmark, number=1, repeat=repeat))
+        results.append(
+            {
+                "name": name,
+                "calls": MICROBENCHMARK_CALLS,
+                "seconds": best,
+                "calls_per_second": MICROBENCHMARK_CALLS / best,
+            }
+        )
+        print(f"{name:28} {MICROBENCHMARK_CALLS / best:12.0f} calls/s", file=sys.stderr)
+    return results
+
+
+def save_images(images: Dict[str, np.ndarray], image_dir: str) -> None:
+    os.makedirs(image_dir, exist_ok=True)
+    for name, image in images.items():
+        Image.fromarray(image).save(os.path.join(image_dir, name + ".png"))
+
+
+def compare(
+    results: dict,
+    images: Dict[str, np.ndarray],
+    baseline: dict,
+    tolerance: float,
+    image_tolerance: int,
+) -> List[str]:
+    """
+    Compare the results with a baseline, and return the descriptions of the regressions:
+    cases that got slower by more than the tolerance (a fraction of the baseline's rate),
+    and images that differ from the baseline's by more than image_tolerance color levels.
+    """
+    regressions = []
+    for kind, metric in (
+        ("scenes", "rays_per_second"),
+        ("microbenchmarks", "calls_per_second"),
+    ):
+        baseline_cases = {case["name"]: case for case in baseline.get(kind, [])}
+        for case in results[kind]:
+            baseline_case = baseline_cases.get(case["name"])
+            if baseline_case is None:
+                continue
+            ratio = case[metric] / baseline_case[metric]
+            if ratio < 1.0 - tolerance:
+                regressions.append(
+                    f"{case['name']}: {metric} dropped to {ratio:.1%} of the baseline"
+                )
+
+    image_dir = baseline.get("image_dir")
+    if image_dir is not None:
+        for name, image in images.items():
+            baseline_path = os.path.join(image_dir, name + ".png")
+            if not os.path.exists(baseline_path):
+                continue
+            baseline_image = np.asarray(Image.open(baseline_path))
+            if baseline_image.shape != image.shape:
+                regressions.append(f"{name}: the image's shape changed")
+                continue
+            diff = np.abs(baseline_image.astype(np.int64) - image)
+            if diff.max() > image_tolerance:
+                changed = np.mean(np.any(diff > image_tolerance, axis=2))
+                regressions.append(
+                    f"{name}: the image differs from the baseline by up to "
+                    f"{diff.max()} levels, in {changed:.2%} of the pixels"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the ray tracer on the bundled scenes"
+    )
+    parser.add_argument(
+        "--scenes",
+        nargs="+",
+        default=BENCHMARK_SCENES,
+        help="The names of the scenes to render, from the scenes directory",
+    )
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[50, 100], help="Image side lengths"
+    )
+    parser.add_argument(
+        "--shadow-rays",
+        type=int,
+        nargs="+",
+        default=[1, 3],
+        help="The roots of the numbers of shadow rays to render with",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="The number of timed runs of every case"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="The random seed")
+    parser.add_argument(
+        "--no-micro", action="store_true", help="Skip the microbenchmarks"
+    )
+    parser.add_argument(
+        "--output", type=str, default=None, help="Write the results to this JSON file"
+    )
+    parser.add_argument(
+        "--image-dir",
+        type=str,
+        default=None,
+        help="Save the rendered images into this directory, to serve as a baseline",
+    )
+    parser.add_argument(
+        "--compare",
+        type=str,
+        default=None,
+        help="A baseline JSON file of a previous run, to check for regressions",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="The fraction a rate may drop below the baseline's without being flagged",
+    )
+    parser.add_argument(
+        "--image-tolerance",
+        type=int,
+        default=1,
+        help="The number of color levels a pixel may differ from the baseline's image",
+    )
+    args = parser.parse_args()
+
+    scene_results, images = run_scene_benchmarks(
+        args.scenes, args.sizes, args.shadow_rays, args.repeat, args.seed
+    )
+    results = {
+        "version": BENCHMARK_FORMAT_VERSION,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "image_dir": None,
+        "scenes": scene_results,
+        "microbenchmarks": (
+            [] if args.no_micro else run_microbenchmarks(args.repeat, args.seed)
+        ),
+    }
+    if args.image_dir is not None:
+        save_images(images, args.image_dir)
+        results["image_dir"] = os.path.abspath(args.image_dir)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(
+            results, images, baseline, args.tolerance, args.image_tolerance
+        )
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
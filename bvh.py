@@ -0,0 +1,519 @@
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import stats
+from base_surface import SurfaceGroups, update_closest_surfaces
+from consts import BVH_BIN_COUNT, BVH_MAX_LEAF_SIZE, EPSILON
+
+# The relative costs of testing a ray against a node's box and against a primitive,
+# used by the surface area heuristic.
+TRAVERSAL_COST = 1.0
+INTERSECTION_COST = 1.0
+
+
+def _surface_area(lows: np.ndarray, highs: np.ndarray) -> np.ndarray:
+    extent = np.maximum(highs - lows, 0.0)
+    return 2.0 * (
+        extent[..., 0] * extent[..., 1]
+        + extent[..., 1] * extent[..., 2]
+        + extent[..., 2] * extent[..., 0]
+    )
+
+
+class BVH:
+    """
+    A bounding volume hierarchy over the bounded surfaces of a scene (spheres and cubes),
+    built top-down with the binned surface area heuristic.
+    Unbounded surfaces, such as infinite planes, aren't part of the hierarchy, and are still
+    tested against every ray by get_closest_surfaces.
+    The nodes are stored as flat arrays, where the children of an inner node are found by
+    their indices, and every leaf keeps the stacked parameters of its primitives, grouped by
+    their type, so it can be intersected with intersect_stacked directly.
+    """
+
+    def __init__(self, surfaces: SurfaceGroups):
+        start_time = time.perf_counter()
+
+        self.surface_types = set()
+        bounded_groups = []
+        for surface_type, group_indices, parameters in surfaces.groups:
+            bounding_boxes = surface_type.stacked_bounding_boxes(parameters)
+            if bounding_boxes is None:
+                continue
+            self.surface_types.add(surface_type)
+            bounded_groups.append(
+                (surface_type, group_indices, parameters, bounding_boxes)
+            )
+
+        self._groups = [(t, p) for t, _, p, _ in bounded_groups]
+        self._primitive_groups = np.concatenate(
+            [np.full(len(g), i) for i, (_, g, _, _) in enumerate(bounded_groups)]
+            or [np.empty(0, dtype=np.int64)]
+        ).astype(np.int64)
+        self._primitive_local_indices = np.concatenate(
+            [np.arange(len(g)) for _, g, _, _ in bounded_groups]
+            or [np.empty(0, dtype=np.int64)]
+        ).astype(np.int64)
+        self._primitive_surface_indices = np.concatenate(
+            [g for _, g, _, _ in bounded_groups] or [np.empty(0, dtype=np.int64)]
+        ).astype(np.int64)
+        lows = np.concatenate([b[0] for *_, b in bounded_groups] or [np.empty((0, 3))])
+        highs = np.concatenate([b[1] for *_, b in bounded_groups] or [np.empty((0, 3))])
+
+        self.primitive_count = len(self._primitive_surface_indices)
+        self._build(lows - EPSILON, highs + EPSILON)
+
+        self.build_time = time.perf_counter() - start_time
+        self.reset_statistics()
+
+    def _build(self, lows: np.ndarray, highs: np.ndarray) -> None:
+        centroids = (lows + highs) / 2.0
+        order = np.arange(self.primitive_count)
+
+        node_lows, node_highs, node_axes, children, leaves = [], [], [], [], []
+        self.max_depth = 0
+
+        def add_node(start: int, end: int, depth: int) -> int:
+            node_lows.append(lows[order[start:end]].min(axis=0, initial=np.inf))
+            node_highs.append(highs[order[start:end]].max(axis=0, initial=-np.inf))
+            node_axes.append(0)
+            children.append((-1, -1))
+            leaves.append(None)
+            self.max_depth = max(self.max_depth, depth)
+            return len(node_lows) - 1
+
+        stack = [(add_node(0, self.primitive_count, 0), 0, self.primitive_count, 0)]
+        while stack:
+            node, start, end, depth = stack.pop()
+            split = self._find_split(
+                order[start:end],
+                lows,
+                highs,
+                centroids,
+                node_lows[node],
+                node_highs[node],
+            )
+            if split is None:
+                leaves[node] = self._make_leaf(order[start:end])
+                continue
+
+            axis, left_mask = split
+            node_primitives = order[start:end]
+            order[start:end] = np.concatenate(
+                [node_primitives[left_mask], node_primitives[~left_mask]]
+            )
+            middle = start + int(np.count_nonzero(left_mask))
+            left = add_node(start, middle, depth + 1)
+            right = add_node(middle, end, depth + 1)
+            node_axes[node] = axis
+            children[node] = (left, right)
+            stack.append((left, start, middle, depth + 1))
+            stack.append((right, middle, end, depth + 1))
+
+        self._node_lows = np.array(node_lows).reshape(-1, 3)
+        self._node_highs = np.array(node_highs).reshape(-1, 3)
+        self._node_axes = np.array(node_axes, dtype=np.int64)
+        self._children = np.array(children, dtype=np.int64).reshape(-1, 2)
+        self._leaves = leaves
+        self.node_count = len(node_lows)
+        self.leaf_count = sum(leaf is not None for leaf in leaves)
+
+    def _find_split(
+        self,
+        primitives: np.ndarray,
+        lows: np.ndarray,
+        highs: np.ndarray,
+        centroids: np.ndarray,
+        node_low: np.ndarray,
+        node_high: np.ndarray,
+    ) -> Optional[Tuple[int, np.ndarray]]:
+        """
+        Find the split of the node's primitives with the lowest surface area heuristic cost.
+        Return a pair of the split axis and the mask of the primitives that go to the left
+        child, or None if the node should be a leaf.
+        """
+        count = len(primitives)
+        if count <= BVH_MAX_LEAF_SIZE:
+            return None
+
+        node_centroids = centroids[primitives]
+        centroid_low = node_centroids.min(axis=0)
+        centroid_extent = node_centroids.max(axis=0) - centroid_low
+        if not np.any(centroid_extent > 0):
+            # All the centroids coincide, so there's no meaningful split - halve the node.
+            left_mask = np.arange(count) < count // 2
+            return 0, left_mask
+
+        best_cost, best_axis, best_bins, best_split = np.inf, -1, None, -1
+        for axis in range(3):
+            if centroid_extent[axis] <= 0:
+                continue
+            bins = (
+                (node_centroids[:, axis] - centroid_low[axis])
+                / centroid_extent[axis]
+                * BVH_BIN_COUNT
+            ).astype(np.int64)
+            bins = np.minimum(bins, BVH_BIN_COUNT - 1)
+
+            bin_counts = np.bincount(bins, minlength=BVH_BIN_COUNT)
+            bin_lows = np.full((BVH_BIN_COUNT, 3), np.inf)
+            bin_highs = np.full((BVH_BIN_COUNT, 3), -np.inf)
+            np.minimum.at(bin_lows, bins, lows[primitives])
+            np.maximum.at(bin_highs, bins, highs[primitives])
+
+            # Sweep the bins from both sides, so that the i-th split separates the bins
+            # [0, i] from [i + 1, BVH_BIN_COUNT).
+            left_areas = _surface_area(
+                np.minimum.accumulate(bin_lows)[:-1],
+                np.maximum.accumulate(bin_highs)[:-1],
+            )
+            right_areas = _surface_area(
+                np.minimum.accumulate(bin_lows[::-1])[::-1][1:],
+                np.maximum.accumulate(bin_highs[::-1])[::-1][1:],
+            )
+            left_counts = np.cumsum(bin_counts)[:-1]
+            right_counts = count - left_counts
+            costs = left_areas * left_counts + right_areas * right_counts
+            costs[(left_counts == 0) | (right_counts == 0)] = np.inf
+
+            split = int(np.argmin(costs))
+            if costs[split] < best_cost:
+                best_cost, best_axis, best_bins, best_split = (
+                    costs[split],
+                    axis,
+                    bins,
+                    split,
+                )
+
+        if best_bins is None:
+            return None
+
+        node_area = _surface_area(node_low, node_high)
+        split_cost = TRAVERSAL_COST + INTERSECTION_COST * best_cost / max(
+            node_area, EPSILON
+        )
+        if split_cost >= INTERSECTION_COST * count and count <= 2 * BVH_MAX_LEAF_SIZE:
+            return None
+        return best_axis, best_bins <= best_split
+
+    def _make_leaf(
+        self, primitives: np.ndarray
+    ) -> List[Tuple[type, Tuple[np.ndarray, ...], np.ndarray]]:
+        leaf = []
+        primitive_groups = self._primitive_groups[primitives]
+        for group in np.unique(primitive_groups):
+            surface_type, parameters = self._groups[group]
+            group_primitives = primitives[primitive_groups == group]
+            local_indices = self._primitive_local_indices[group_primitives]
+            leaf.append(
+                (
+                    surface_type,
+                    tuple(parameter[local_indices] for parameter in parameters),
+                    self._primitive_surface_indices[group_primitives],
+                )
+            )
+        return leaf
+
+    def update_closest_surfaces(
+        self,
+        sources: np.ndarray,
+        directions: np.ndarray,
+        closest_indices: np.ndarray,
+        min_t: np.ndarray,
+        source_indices: Optional[np.ndarray] = None,
+    ) -> None:
+        """
+        Intersect the rays with the surfaces in the hierarchy, and update the closest hits
+        found so far in place, see get_closest_surfaces.
+        The rays are traversed together as a packet: every node is tested against the rays
+        that reached it, and only the rays whose closest hit so far isn't nearer than the node
+        continue to its children.
+        """
+        if self.primitive_count == 0 or len(sources) == 0:
+            return
+
+        # Zero components are replaced with tiny ones, so that the slab distances are
+        # (signed) infinities instead of NaNs.
+        inverse_directions = 1.0 / np.where(directions == 0, 1e-300, directions)
+        self.rays_traced += len(sources)
+
+        stack = [(0, np.arange(len(sources)))]
+        while stack:
+            node, rays = stack.pop()
+            self.node_tests += len(rays)
+            t_enter = self._entry_distances(
+                node, sources[rays], inverse_directions[rays]
+            )
+            rays = rays[t_enter <= min_t[rays]]
+            if len(rays) == 0:
+                continue
+
+            leaf = self._leaves[node]
+            if leaf is not None:
+                for surface_type, parameters, surface_indices in leaf:
+                    t = surface_type.intersect_stacked(
+                        parameters, sources[rays], directions[rays]
+                    )
+                    self.primitive_tests += t.size
+                    stats.count("tests." + surface_type.__name__, t.size)
+                    update_closest_surfaces(
+                        closest_indices,
+                        min_t,
+                        rays,
+                        t,
+                        surface_indices,
+                        source_indices,
+                    )
+                continue
+
+            # Visit the child that's closer for most of the rays first, so the farther one
+            # is more likely to be culled by the hits found in the closer one.
+            left, right = self._children[node]
+            if directions[rays, self._node_axes[node]].sum() < 0:
+                left, right = right, left
+            stack.append((right, rays))
+            stack.append((left, rays))
+
+    def update_closest_surfaces_in_packets(
+        self,
+        sources: np.ndarray,
+        directions: np.ndarray,
+        packets,
+        closest_indices: np.ndarray,
+        min_t: np.ndarray,
+    ) -> None:
+        """
+        Like update_closest_surfaces, for rays split into packets with bounding frusta (see
+        frustum.RayPackets): every inner node is tested against the frusta of the packets
+        that reached it, instead of against their rays. At the leaves, the rays of the
+        packets that reached them are tested against their boxes, and then every primitive is
+        culled against the packets' frusta before it's intersected with their rays.
+        """
+        if self.primitive_count == 0 or len(sources) == 0:
+            return
+
+        inverse_directions = 1.0 / np.where(directions == 0, 1e-300, directions)
+        self.rays_traced += len(sources)
+        candidates = np.zeros(len(sources), dtype=bool)
+
+        stack = [(0, np.arange(len(packets)))]
+        while stack:
+            node, node_packets = stack.pop()
+            self.node_tests += len(node_packets)
+            visible = packets.overlap(
+                self._node_lows[node : node + 1],
+                self._node_highs[node : node + 1],
+                node_packets,
+            )
+            node_packets = node_packets[visible[:, 0]]
+            if len(node_packets) == 0:
+                continue
+
+            leaf = self._leaves[node]
+            if leaf is not None:
+                rays = packets.rays(node_packets)
+                self.node_tests += len(rays)
+                t_enter = self._entry_distances(
+                    node, sources[rays], inverse_directions[rays]
+                )
+                rays = rays[t_enter <= min_t[rays]]
+                candidates[rays] = True
+                for surface_type, parameters, surface_indices in leaf:
+                    self.primitive_tests += packets.update_closest_surfaces(
+                        surface_type,
+                        parameters,
+                        surface_indices,
+                        sources,
+                        directions,
+                        closest_indices,
+                        min_t,
+                        node_packets,
+                        candidates,
+                    )
+                candidates[rays] = False
+                continue
+
+            # The packets' rays are close to their frusta's central directions, so these
+            # pick the child that's closer for most of them, like in update_closest_surfaces.
+            left, right = self._children[node]
+            if packets.directions[node_packets, self._node_axes[node]].sum() < 0:
+                left, right = right, left
+            stack.append((right, node_packets))
+            stack.append((left, node_packets))
+
+    def update_occluded(
+        self,
+        sources: np.ndarray,
+        directions: np.ndarray,
+        max_t: np.ndarray,
+        occluded: np.ndarray,
+        rays: np.ndarray,
+    ) -> None:
+        """
+        Mark the given rays which hit a surface in the hierarchy before the ray parameter
+        max_t as occluded, in place, see are_segments_occluded.
+        A ray leaves the traversal as soon as it's found to be occluded.
+        """
+        if self.primitive_count == 0 or len(rays) == 0:
+            return
+
+        inverse_directions = 1.0 / np.where(directions == 0, 1e-300, directions)
+        self.rays_traced += len(rays)
+
+        stack = [(0, rays)]
+        while stack:
+            node, rays = stack.pop()
+            rays = rays[~occluded[rays]]
+            self.node_tests += len(rays)
+            t_enter = self._entry_distances(
+                node, sources[rays], inverse_directions[rays]
+            )
+            rays = rays[t_enter < max_t[rays]]
+            if len(rays) == 0:
+                continue
+
+            leaf = self._leaves[node]
+            if leaf is not None:
+                for surface_type, parameters, _ in leaf:
+                    t = surface_type.intersect_stacked(
+                        parameters, sources[rays], directions[rays]
+                    )
+                    self.primitive_tests += t.size
+                    stats.count("tests." + surface_type.__name__, t.size)
+                    blocked = np.any(t < max_t[rays, np.newaxis], axis=1)
+                    occluded[rays[blocked]] = True
+                    rays = rays[~blocked]
+                    if len(rays) == 0:
+                        break
+                continue
+
+            left, right = self._children[node]
+            if directions[rays, self._node_axes[node]].sum() < 0:
+                left, right = right, left
+            stack.append((right, rays))
+            stack.append((left, rays))
+
+    def collect_hits(
+        self, sources: np.ndarray, directions: np.ndarray, max_t: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Return all the points where the rays cross the boundaries of the surfaces in the
+        hierarchy before the ray parameters max_t, see get_all_hits, as (H,) arrays of the
+        hits' rays, surface indices and ray parameters t, in no particular order.
+        Unlike the other queries, a ray visits every node its segment passes through.
+        """
+        hit_rays, hit_surfaces, hit_t = [], [], []
+        if self.primitive_count == 0 or len(sources) == 0:
+            return (
+                np.empty(0, dtype=np.int64),
+                np.empty(0, dtype=np.int64),
+                np.empty(0),
+            )
+
+        inverse_directions = 1.0 / np.where(directions == 0, 1e-300, directions)
+        self.rays_traced += len(sources)
+
+        stack = [(0, np.arange(len(sources)))]
+        while stack:
+            node, rays = stack.pop()
+            self.node_tests += len(rays)
+            t_enter = self._entry_distances(
+                node, sources[rays], inverse_directions[rays]
+            )
+            rays = rays[t_enter < max_t[rays]]
+            if len(rays) == 0:
+                continue
+
+            leaf = self._leaves[node]
+            if leaf is not None:
+                for surface_type, parameters, surface_indices in leaf:
+                    t = surface_type.intersect_stacked_all(
+                        parameters, sources[rays], directions[rays]
+                    )
+                    self.primitive_tests += t.shape[0] * t.shape[1]
+                    stats.count(
+                        "tests." + surface_type.__name__, t.shape[0] * t.shape[1]
+                    )
+                    hits = t < max_t[rays, np.newaxis, np.newaxis]
+                    leaf_rays, columns, _ = np.nonzero(hits)
+                    hit_rays.append(rays[leaf_rays])
+                    hit_surfaces.append(surface_indices[columns])
+                    hit_t.append(t[hits])
+                continue
+
+            left, right = self._children[node]
+            stack.append((right, rays))
+            stack.append((left, rays))
+
+        if not hit_rays:
+            return (
+                np.empty(0, dtype=np.int64),
+                np.empty(0, dtype=np.int64),
+                np.empty(0),
+            )
+        return (
+            np.concatenate(hit_rays),
+            np.concatenate(hit_surfaces),
+            np.concatenate(hit_t),
+        )
+
+    def _entry_distances(
+        self, node: int, sources: np.ndarray, inverse_directions: np.ndarray
+    ) -> np.ndarray:
+        """
+        Return the ray parameters t at which the rays enter the node's box (0 for rays that
+        start inside it), or inf for rays that miss it.
+        """
+        t1 = (self._node_lows[node] - sources) * inverse_directions
+        t2 = (self._node_highs[node] - sources) * inverse_directions
+        t_near = np.minimum(t1, t2).max(axis=1)
+        t_far = np.maximum(t1, t2).min(axis=1)
+        return np.where(
+            (t_near <= t_far) & (t_far >= 0), np.maximum(t_near, 0.0), np.inf
+        )
+
+    def reset_statistics(self) -> None:
+        self.rays_traced = 0
+        self.node_tests = 0
+        self.primitive_tests = 0
+
+    def traversal_counts(self) -> Tuple[int, int, int]:
+        """
+        Return the traversals' counters since the last reset, to be added to another copy of
+        the hierarchy's ones, like a tile worker's to the main process', see
+        add_traversal_counts.
+        """
+        return self.rays_traced, self.node_tests, self.primitive_tests
+
+    def add_traversal_counts(self, counts: Tuple[int, int, int]) -> None:
+        rays_traced, node_tests, primitive_tests = counts
+        self.rays_traced += rays_traced
+        self.node_tests += node_tests
+        self.primitive_tests += primitive_tests
+
+    def statistics(self) -> Dict[str, float]:
+        """
+        Return the statistics of the hierarchy's build and of the traversals since the last
+        reset, including the fraction of the ray-primitive tests a brute force search would
+        have made, that were culled.
+        """
+        brute_force_tests = self.rays_traced * self.primitive_count
+        return {
+            "primitives": self.primitive_count,
+            "nodes": self.node_count,
+            "leaves": self.leaf_count,
+            "max_depth": self.max_depth,
+            "build_time": self.build_time,
+            "rays_traced": self.rays_traced,
+            "node_tests": self.node_tests,
+            "primitive_tests": self.primitive_tests,
+            "node_tests_per_ray": self.node_tests / max(1, self.rays_traced),
+            "primitive_tests_per_ray": self.primitive_tests / max(1, self.rays_traced),
+            "culled_fraction": (
+                1.0 - self.primitive_tests / brute_force_tests
+                if brute_force_tests
+                else 0.0
+            ),
+        }
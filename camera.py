@@ -4,6 +4,8 @@ import numpy as np
 
 
 class Camera:
+    __slots__ = ("position", "look_at", "up_vector", "screen_distance", "screen_width")
+
     def __init__(
         self,
         position: List[float],
@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import time
+from typing import List
+
+import numpy as np
+
+from consts import CHECKPOINT_INTERVAL, COLOR_CHANNELS
+from tiles import Tile
+
+# Bumped whenever the checkpoint's layout or key change, so old checkpoints aren't reused.
+CHECKPOINT_VERSION = 1
+CHECKPOINT_KEY_FILE = "key.json"
+CHECKPOINT_IMAGE_FILE = "image.npy"
+CHECKPOINT_SHADOW_SAMPLES_FILE = "shadow_samples.npy"
+CHECKPOINT_DONE_FILE = "done.npy"
+CHECKPOINT_FILES = (
+    CHECKPOINT_KEY_FILE,
+    CHECKPOINT_IMAGE_FILE,
+    CHECKPOINT_SHADOW_SAMPLES_FILE,
+    CHECKPOINT_DONE_FILE,
+)
+
+
+def _is_checkpoint_file(name: str) -> bool:
+    # The list of done tiles is written aside first, see RenderCheckpoint.save.
+    return name in CHECKPOINT_FILES or (
+        name.startswith("done.") and name.endswith(".tmp.npy")
+    )
+
+
+def checkpoint_key(scene_path: str, settings: dict) -> str:
+    """
+    Return a hash of everything a render's pixels depend on: the contents of the scene file
+    (or of the files of a compiled scene directory), and the given render settings, which
+    must be JSON serializable (NumPy arrays are converted to lists).
+    """
+    key = hashlib.sha256()
+    key.update(
+        json.dumps(
+            {"version": CHECKPOINT_VERSION, **settings},
+            sort_keys=True,
+            default=lambda value: np.asarray(value).tolist(),
+        ).encode()
+    )
+    if os.path.isdir(scene_path):
+        paths = [
+            os.path.join(scene_path, name) for name in sorted(os.listdir(scene_path))
+        ]
+    else:
+        paths = [scene_path]
+    for path in paths:
+        key.update(os.path.basename(path).encode())
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                key.update(block)
+    return key.hexdigest()
+
+
+class RenderCheckpoint:
+    """
+    A directory holding a partially rendered image: the pixels and the shadow ray counts of
+    the tiles rendered so far, in memory-mapped .npy files, and which of the tiles are done.
+    The list of done tiles is only saved every CHECKPOINT_INTERVAL seconds, after the pixels
+    are flushed to the disk, so a killed render loses at most the tiles of the last interval,
+    and never marks a tile as done before its pixels are saved.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        image: np.ndarray,
+        shadow_sample_map: np.ndarray,
+        done: np.ndarray,
+    ):
+        self.path = path
+        self.image = image
+        self.shadow_sample_map = shadow_sample_map
+        self.done = done
+        self._last_save = time.monotonic()
+
+    @staticmethod
+    def open(
+        path: str,
+        key: str,
+        height: int,
+        width: int,
+        tile_count: int,
+        resume: bool = True,
+    ) -> "RenderCheckpoint":
+        """
+        Return the checkpoint in the given directory if resume is True and it was made with
+        the same key and image size, and otherwise start a new one there.
+        """
+        if resume:
+            checkpoint = RenderCheckpoint._load(path, key, height, width, tile_count)
+            if checkpoint is not None:
+                return checkpoint
+        return RenderCheckpoint.create(path, key, height, width, tile_count)
+
+    @staticmethod
+    def create(
+        path: str, key: str, height: int, width: int, tile_count: int
+    ) -> "RenderCheckpoint":
+        os.makedirs(path, exist_ok=True)
+        # The checkpoint gets a directory of its own, so that removing it can't delete
+        # anything else, like an output image saved next to it.
+        other_files = [
+            name for name in os.listdir(path) if not _is_checkpoint_file(name)
+        ]
+        if other_files:
+            raise ValueError(
+                "{}: The checkpoint directory has other files in it: {}".format(
+                    path, ", ".join(sorted(other_files))
+                )
+            )
+        key_path = os.path.join(path, CHECKPOINT_KEY_FILE)
+        # The key is removed first and written last, so a checkpoint whose creation was
+        # interrupted is never resumed.
+        if os.path.exists(key_path):
+            os.remove(key_path)
+        checkpoint = RenderCheckpoint(
+            path,
+            np.lib.format.open_memmap(
+                os.path.join(path, CHECKPOINT_IMAGE_FILE),
+                mode="w+",
+                dtype=np.float64,
+                shape=(height, width, COLOR_CHANNELS),
+            ),
+            np.lib.format.open_memmap(
+                os.path.join(path, CHECKPOINT_SHADOW_SAMPLES_FILE),
+                mode="w+",
+                dtype=np.float64,
+                shape=(height, width),
+            ),
+            np.zeros(tile_count, dtype=bool),
+        )
+        checkpoint.save()
+        with open(key_path, "w") as f:
+            json.dump({"version": CHECKPOINT_VERSION, "key": key}, f)
+        return checkpoint
+
+    @staticmethod
+    def _load(path: str, key: str, height: int, width: int, tile_count: int):
+        try:
+            with open(os.path.join(path, CHECKPOINT_KEY_FILE), "r") as f:
+                saved_key = json.load(f)
+            if saved_key != {"version": CHECKPOINT_VERSION, "key": key}:
+                return None
+            checkpoint = RenderCheckpoint(
+                path,
+                np.load(os.path.join(path, CHECKPOINT_IMAGE_FILE), mmap_mode="r+"),
+                np.load(
+                    os.path.join(path, CHECKPOINT_SHADOW_SAMPLES_FILE), mmap_mode="r+"
+                ),
+                np.load(os.path.join(path, CHECKPOINT_DONE_FILE)),
+            )
+        except (OSError, ValueError):
+            return None
+        if (
+            checkpoint.image.shape != (height, width, COLOR_CHANNELS)
+            or checkpoint.shadow_sample_map.shape != (height, width)
+            or checkpoint.done.shape != (tile_count,)
+        ):
+            return None
+        return checkpoint
+
+    def pending(self, tiles: List[Tile]) -> List[Tile]:
+        """
+        Return the given tiles which aren't done yet.
+        """
+        return [tile for tile in tiles if not self.done[tile.index]]
+
+    def tile_rendered(self, tile: Tile, pixels: np.ndarray) -> None:
+        """
+        Store a rendered tile's pixels, and mark it as done. Its shadow ray counts are
+        expected to be in shadow_sample_map already.
+        """
+        self.image[tile.top : tile.bottom, tile.left : tile.right] = pixels
+        self.done[tile.index] = True
+        if time.monotonic() - self._last_save >= CHECKPOINT_INTERVAL:
+            self.save()
+
+    def save(self) -> None:
+        self.image.flush()
+        self.shadow_sample_map.flush()
+        # Written aside and renamed, so that an interrupted write doesn't lose the done tiles.
+        done_path = os.path.join(self.path, CHECKPOINT_DONE_FILE)
+        temporary_path = done_path[: -len(".npy")] + f".{os.getpid()}.tmp.npy"
+        np.save(temporary_path, self.done)
+        os.replace(temporary_path, done_path)
+        self._last_save = time.monotonic()
+
+    def remove(self) -> None:
+        """
+        Delete the checkpoint's files, once the render it was made for is saved, and its
+        directory if nothing else was put there since.
+        """
+        del self.image, self.shadow_sample_map
+        for name in os.listdir(self.path):
+            if _is_checkpoint_file(name):
+                os.remove(os.path.join(self.path, name))
+        if not os.listdir(self.path):
+            os.rmdir(self.path)
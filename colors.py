@@ -1,13 +1,133 @@
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 import numpy as np
 
-from base_surface import Surface, get_closest_surface
+import stats
+from base_surface import (
+    Surface,
+    SurfaceGroups,
+    as_surface_groups,
+    get_all_hits,
+    get_closest_hit,
+    get_closest_surfaces,
+    hit_faces,
+    normals_at_points,
+    reflection_directions,
+)
+from consts import RAY_BATCH_SIZE
+from gbuffer import GBuffer
 from light import Light
+from light_selection import shade_selected_lights
+from material import MaterialArrays
 from ray import Ray
 from scene import SceneSettings
 
 
+class RayTreeStatistics:
+    """
+    Counts of the secondary (transparency and reflection) rays spawned while evaluating ray
+    trees, and of those which were pruned instead of being traced.
+    """
+
+    def __init__(self):
+        self.spawned = 0
+        self.pruned = 0
+
+    def merge(self, other: "RayTreeStatistics") -> None:
+        self.spawned += other.spawned
+        self.pruned += other.pruned
+
+
+class TransparencyChains:
+    """
+    The hits along the rays of a batch that continue through transparent surfaces.
+    A transparency ray keeps its parent's direction, so instead of searching for its closest
+    hit again, every layer's ray walks the list of all the hits along its chain's first ray
+    (see get_all_hits), from the hit it was spawned at.
+    :param hit_surfaces: The (H,) surface indices of the hits of all the chains.
+    :param hit_t: The (H,) ray parameters of the hits, along their chains' first rays.
+    :param ends: The (N,) indices after the last hits of every ray's chain.
+    :param cursors: The (N,) indices of the hits every ray was spawned at.
+    :param sources: The (N, 3) sources of the chains' first rays.
+    """
+
+    def __init__(
+        self,
+        hit_surfaces: np.ndarray,
+        hit_t: np.ndarray,
+        ends: np.ndarray,
+        cursors: np.ndarray,
+        sources: np.ndarray,
+    ):
+        self.hit_surfaces = hit_surfaces
+        self.hit_t = hit_t
+        self.ends = ends
+        self.cursors = cursors
+        self.sources = sources
+
+    def take(self, rays) -> "TransparencyChains":
+        return TransparencyChains(
+            self.hit_surfaces,
+            self.hit_t,
+            self.ends[rays],
+            self.cursors[rays],
+            self.sources[rays],
+        )
+
+    def next_hits(
+        self, source_indices: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, "TransparencyChains"]:
+        """
+        Return the index of the closest surface every ray hits (-1 for misses), the ray
+        parameter of the hit along the chain's first ray, and the chains advanced to the
+        hits. Like get_closest_surfaces, the surface every ray is shot from is ignored.
+        """
+        cursors = self.cursors + 1
+        while True:
+            valid = np.flatnonzero(cursors < self.ends)
+            same = valid[self.hit_surfaces[cursors[valid]] == source_indices[valid]]
+            if len(same) == 0:
+                break
+            cursors[same] += 1
+
+        valid = cursors < self.ends
+        surface_indices = np.full(len(cursors), -1, dtype=np.int64)
+        surface_indices[valid] = self.hit_surfaces[cursors[valid]]
+        t = np.full(len(cursors), np.inf)
+        t[valid] = self.hit_t[cursors[valid]]
+        advanced = TransparencyChains(
+            self.hit_surfaces, self.hit_t, self.ends, cursors, self.sources
+        )
+        return surface_indices, t, advanced
+
+
+def prune_rays(
+    weights: np.ndarray,
+    scene_settings: SceneSettings,
+    rng: Optional[np.random.Generator] = None,
+    statistics: Optional[RayTreeStatistics] = None,
+) -> np.ndarray:
+    """
+    Receive an (N, 3) array of the weights of spawned secondary rays, and return an (N,)
+    boolean array of the rays that should be traced, according to the scene's min_ray_weight.
+    With russian roulette, the weights of the rays that survive it are scaled in place,
+    so that the expected color of their pixels doesn't change.
+    """
+    max_weights = weights.max(axis=1)
+    keep = max_weights >= scene_settings.min_ray_weight
+    if scene_settings.russian_roulette:
+        survival_probabilities = max_weights / scene_settings.min_ray_weight
+        random_values = (np.random if rng is None else rng).uniform(size=len(weights))
+        survived = ~keep & (random_values < survival_probabilities)
+        weights[survived] /= survival_probabilities[survived, np.newaxis]
+        keep |= survived
+
+    if statistics is not None:
+        statistics.spawned += len(weights)
+        statistics.pruned += int(np.count_nonzero(~keep))
+    return keep
+
+
 def calculate_color(
     ray: Ray,
     surfaces: List[Surface],
@@ -15,44 +135,78 @@ def calculate_color(
     scene_settings: SceneSettings,
     source_surface: Optional[Surface] = None,
     iteration: int = 0,
+    rng: Optional[np.random.Generator] = None,
+    statistics: Optional[RayTreeStatistics] = None,
+    pixel_index: int = 0,
 ) -> np.ndarray:
-    if iteration == scene_settings.max_recursions:
-        return scene_settings.background_color
+    """
+    Return the color seen by the ray.
+    The ray's tree of transparency and reflection rays is evaluated with an explicit stack,
+    where every ray carries its weight - the product of the transparency and reflection
+    coefficients along its path - and branches that are too weak are pruned by prune_rays.
+    The pixel_index selects the light sample tables, when the soft shadows use them.
+    """
+    stats.count("rays.primary")
+    color = np.zeros(3)
+    rays = [(ray, source_surface, iteration, np.ones(3))]
+    while rays:
+        ray, source_surface, iteration, weight = rays.pop()
+        if iteration == scene_settings.max_recursions:
+            color += weight * scene_settings.background_color
+            continue
 
-    surface, intersection = get_closest_surface(
-        ray, surfaces, source_surface=source_surface
-    )
-    if not surface:
-        return scene_settings.background_color
+        hit = get_closest_hit(ray, surfaces, source_surface=source_surface)
+        if hit is None:
+            color += weight * scene_settings.background_color
+            continue
+        surface = hit.surface
 
-    color = calculate_phong_specularity(
-        intersection, ray, surface, surfaces, lights, scene_settings
-    ) * (1 - surface.material.transparency)
-    if surface.material.transparency > 0:
         color += (
-            calculate_color(
-                Ray(intersection, ray.direction),
-                surfaces,
-                lights,
-                scene_settings,
+            weight
+            * calculate_phong_specularity(
+                hit.point,
+                ray,
                 surface,
-                iteration + 1,
-            )
-            * surface.material.transparency
-        )
-    if surface.material.is_reflective():
-        color += (
-            calculate_color(
-                surface.reflection_ray(ray, intersection),
                 surfaces,
                 lights,
                 scene_settings,
-                surface,
-                iteration + 1,
+                pixel_index,
+                hit.normal,
             )
-            * surface.material.reflection_color
+            * (1 - surface.material.transparency)
         )
 
+        children = []
+        if surface.material.transparency > 0:
+            children.append(
+                (
+                    Ray(hit.point, ray.direction),
+                    weight * surface.material.transparency,
+                    "rays.transparency",
+                )
+            )
+        if surface.material.is_reflective():
+            children.append(
+                (
+                    surface.reflection_ray(ray, hit.point, hit.normal),
+                    weight * surface.material.reflection_color,
+                    "rays.reflection",
+                )
+            )
+        if not children:
+            continue
+
+        weights = np.array([child_weight for _, child_weight, _ in children])
+        keep = prune_rays(weights, scene_settings, rng, statistics)
+        # Push the reflection ray first, so the transparency ray is traced first, in the
+        # same order as the recursive evaluation.
+        for (child_ray, _, counter), child_weight, kept in reversed(
+            list(zip(children, weights, keep))
+        ):
+            if kept:
+                stats.count(counter)
+                rays.append((child_ray, surface, iteration + 1, child_weight))
+
     return color
 
 
@@ -63,6 +217,8 @@ def calculate_phong_specularity(
     surfaces: List[Surface],
     lights: List[Light],
     scene_settings: SceneSettings,
+    pixel_index: int = 0,
+    normal: Optional[np.ndarray] = None,
 ) -> np.ndarray:
     return sum(
         light.calculate_phong_specularity(
@@ -71,6 +227,291 @@ def calculate_phong_specularity(
             surface,
             surfaces,
             scene_settings.root_number_shadow_rays,
+            scene_settings.adaptive_shadows,
+            scene_settings.shadow_sampling,
+            pixel_index,
+            scene_settings.transparent_shadows,
+            normal,
         )
         for light in lights
     )
+
+
+def calculate_colors(
+    sources: np.ndarray,
+    directions: np.ndarray,
+    surfaces: List[Surface],
+    lights: List[Light],
+    scene_settings: SceneSettings,
+    rng: Optional[np.random.Generator] = None,
+    statistics: Optional[RayTreeStatistics] = None,
+    shadow_sample_counts: Optional[np.ndarray] = None,
+    pixel_indices: Optional[np.ndarray] = None,
+    primary_hits: Optional[GBuffer] = None,
+) -> np.ndarray:
+    """
+    The batched (wavefront) version of calculate_color.
+    Instead of recursing per ray, the rays are traced in batches: each batch is intersected,
+    shaded and then split into batches of its transparency and reflection rays, which are
+    traced in turn. Each ray carries the weight its color contributes to its pixel.
+    The hits of transparency rays are looked up in the list of all the hits along their
+    parents' rays, found once per chain of transparent layers, see TransparencyChains.
+    :param sources: An (N, 3) array of the rays' sources.
+    :param directions: An (N, 3) array of the rays' (normalized) directions.
+    :param rng: An optional random generator to draw the soft shadows' samples from,
+    instead of the global NumPy random state.
+    :param statistics: Optional counters of the spawned and pruned secondary rays.
+    :param shadow_sample_counts: An optional (N,) array, to which the number of shadow rays
+    cast for the whole tree of every ray is added.
+    :param pixel_indices: An optional (N,) array of the indices of the rays' pixels, which
+    select the light sample tables. Defaults to the rays' indices.
+    :param primary_hits: An optional G-buffer of the rays' hits, which were already found,
+    so that only the rays' shading and secondary rays are traced.
+    :returns: An (N, 3) array of the colors seen by the rays.
+    """
+    if pixel_indices is None:
+        pixel_indices = np.arange(len(sources))
+    stats.count("rays.primary", len(sources))
+    surfaces = as_surface_groups(surfaces)
+    materials = surfaces.materials
+    colors = np.zeros((len(sources), 3))
+
+    # Every batch is (ray indices, sources, directions, weights, source surfaces, iteration,
+    # transparency chains or None). The batches are kept on a stack, so the number of
+    # pending rays stays bounded by max_recursions * RAY_BATCH_SIZE.
+    batches = [
+        (
+            np.arange(len(sources)),
+            sources,
+            directions,
+            np.ones((len(sources), 3)),
+            np.full(len(sources), -1, dtype=np.int64),
+            0,
+            None,
+        )
+    ]
+    while batches:
+        (
+            indices,
+            sources,
+            directions,
+            weights,
+            source_indices,
+            iteration,
+            chains,
+        ) = batches.pop()
+        if len(indices) == 0:
+            continue
+        if len(indices) > RAY_BATCH_SIZE:
+            for start in range(0, len(indices), RAY_BATCH_SIZE):
+                batch = slice(start, start + RAY_BATCH_SIZE)
+                batches.append(
+                    (
+                        indices[batch],
+                        sources[batch],
+                        directions[batch],
+                        weights[batch],
+                        source_indices[batch],
+                        iteration,
+                        None if chains is None else chains.take(batch),
+                    )
+                )
+            continue
+
+        if iteration == scene_settings.max_recursions:
+            colors[indices] += weights * scene_settings.background_color
+            continue
+
+        # The first batch's rays are the given ones, whose hits may be known already.
+        known_hits = (
+            primary_hits.take(indices)
+            if iteration == 0 and primary_hits is not None
+            else None
+        )
+        if known_hits is not None:
+            surface_indices = known_hits.surface_indices
+        elif chains is not None:
+            surface_indices, t, chains = chains.next_hits(source_indices)
+        else:
+            surface_indices, t = get_closest_surfaces(
+                sources, directions, surfaces, source_indices=source_indices
+            )
+        miss = surface_indices == -1
+        colors[indices[miss]] += weights[miss] * scene_settings.background_color
+
+        hit = ~miss
+        indices = indices[hit]
+        sources = sources[hit]
+        directions = directions[hit]
+        weights = weights[hit]
+        parent_source_indices = source_indices[hit]
+        surface_indices = surface_indices[hit]
+        if known_hits is not None:
+            intersections = known_hits.positions[hit]
+        elif chains is not None:
+            chains = chains.take(hit)
+            intersections = chains.sources + t[hit, np.newaxis] * directions
+        else:
+            intersections = sources + t[hit, np.newaxis] * directions
+        # Like the scalar renderer's hit records, the faces are found from the rays' own
+        # sources, rather than their chains' first rays', which may be outside a cube that
+        # the rays leave.
+        faces = hit_faces(surfaces, surface_indices, sources, directions)
+
+        material_ids = surfaces.material_ids[surface_indices]
+        transparency = materials.transparency[material_ids]
+        sample_counts = np.zeros(len(indices))
+        color = calculate_phong_specularity_many(
+            intersections,
+            directions,
+            surface_indices,
+            surfaces,
+            lights,
+            scene_settings,
+            materials,
+            rng,
+            sample_counts,
+            pixel_indices[indices],
+            weights * (1 - transparency[:, np.newaxis]),
+            faces,
+        ) * (1 - transparency[:, np.newaxis])
+        if shadow_sample_counts is not None:
+            shadow_sample_counts[indices] += sample_counts
+        colors[indices] += weights * color
+
+        transparent = np.flatnonzero(transparency > 0)
+        transparency_weights = (
+            weights[transparent] * transparency[transparent, np.newaxis]
+        )
+        keep = prune_rays(transparency_weights, scene_settings, rng, statistics)
+        transparent = transparent[keep]
+        stats.count("rays.transparency", len(transparent))
+        if chains is not None:
+            transparent_chains = chains.take(transparent)
+        elif len(transparent) > 0 and iteration + 1 < scene_settings.max_recursions:
+            # Start the chains at the hits that were just found, which are the first hits
+            # along the rays.
+            offsets, hit_surfaces, hit_t = get_all_hits(
+                sources[transparent],
+                directions[transparent],
+                surfaces,
+                source_indices=parent_source_indices[transparent],
+            )
+            transparent_chains = TransparencyChains(
+                hit_surfaces,
+                hit_t,
+                offsets[1:],
+                offsets[:-1],
+                sources[transparent],
+            )
+        else:
+            transparent_chains = None
+        batches.append(
+            (
+                indices[transparent],
+                intersections[transparent],
+                directions[transparent],
+                transparency_weights[keep],
+                surface_indices[transparent],
+                iteration + 1,
+                transparent_chains,
+            )
+        )
+
+        reflective = np.flatnonzero(materials.reflective[material_ids])
+        reflection_weights = (
+            weights[reflective] * materials.reflection_colors[material_ids[reflective]]
+        )
+        keep = prune_rays(reflection_weights, scene_settings, rng, statistics)
+        reflective = reflective[keep]
+        stats.count("rays.reflection", len(reflective))
+        if known_hits is not None:
+            normals = known_hits.normals[hit][reflective]
+        else:
+            normals = normals_at_points(
+                surfaces,
+                surface_indices[reflective],
+                intersections[reflective],
+                directions[reflective],
+                faces[reflective],
+            )
+        batches.append(
+            (
+                indices[reflective],
+                intersections[reflective],
+                reflection_directions(directions[reflective], normals),
+                reflection_weights[keep],
+                surface_indices[reflective],
+                iteration + 1,
+                None,
+            )
+        )
+
+    return colors
+
+
+def calculate_phong_specularity_many(
+    points: np.ndarray,
+    directions: np.ndarray,
+    surface_indices: np.ndarray,
+    surfaces: SurfaceGroups,
+    lights: List[Light],
+    scene_settings: SceneSettings,
+    materials: MaterialArrays,
+    rng: Optional[np.random.Generator] = None,
+    shadow_sample_counts: Optional[np.ndarray] = None,
+    pixel_indices: Optional[np.ndarray] = None,
+    contributions: Optional[np.ndarray] = None,
+    faces: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    The batched version of calculate_phong_specularity.
+    If the scene settings enable light culling or light sampling, only the lights that
+    matter at every point are shaded, see light_selection.shade_selected_lights.
+    :param directions: An (N, 3) array of the directions of the rays that hit the points.
+    :param surface_indices: An (N,) array of the indices of the surfaces the points are on.
+    :param materials: The table of the surfaces' materials, indexed by their material ids.
+    :param shadow_sample_counts: An optional (N,) array, to which the number of shadow rays
+    cast for every point is added.
+    :param pixel_indices: An optional (N,) array of the indices of the points' pixels.
+    :param contributions: An optional (N, 3) array of the weights of the points' colors in
+    their pixels, which the light selection estimates the lights' contributions with.
+    :param faces: An optional (N,) array of the faces of the hits at the points, see
+    base_surface.hit_faces.
+    """
+    if scene_settings.light_culling or scene_settings.light_samples > 0:
+        return shade_selected_lights(
+            points,
+            directions,
+            surface_indices,
+            surfaces,
+            lights,
+            scene_settings,
+            materials,
+            np.ones_like(points) if contributions is None else contributions,
+            rng,
+            shadow_sample_counts,
+            pixel_indices,
+            faces,
+        )
+    material_ids = surfaces.material_ids[surface_indices]
+    color = np.zeros_like(points)
+    for light in lights:
+        color += light.calculate_phong_specularity_many(
+            points,
+            -directions,
+            surface_indices,
+            surfaces,
+            scene_settings.root_number_shadow_rays,
+            materials.diffuse_colors[material_ids],
+            materials.specular_colors[material_ids],
+            materials.shininess[material_ids],
+            rng,
+            scene_settings.adaptive_shadows,
+            shadow_sample_counts,
+            scene_settings.shadow_sampling,
+            pixel_indices,
+            scene_settings.transparent_shadows,
+            faces,
+        )
+    return color
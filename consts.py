@@ -2,3 +2,74 @@ COLOR_CHANNELS = 3
 COLOR_SCALE = 255
 
 EPSILON = 1e-5
+
+# The maximal number of rays traced together in a single batch by the wavefront renderer.
+RAY_BATCH_SIZE = 1 << 16
+# The side length, in pixels, of the tiles the image is split into for parallel rendering.
+TILE_SIZE = 32
+# The number of tiles per worker that a streaming render may render ahead of the tile being
+# written, so every worker has its next tile queued, but the finished tiles waiting for the
+# writer don't grow with the image.
+STREAMING_TILES_IN_FLIGHT_PER_WORKER = 2
+# The number of frames of an animation whose tiles may be rendered ahead of the frame being
+# assembled, so the rendered tiles waiting for the caller don't grow with the animation.
+ANIMATION_FRAMES_IN_FLIGHT = 2
+# The maximal number of ray-surface pairs intersected together in a single NumPy pass.
+INTERSECTION_BATCH_SIZE = 1 << 22
+
+# The maximal number of primitives in a leaf of the bounding volume hierarchy. Leaves are
+# intersected in one NumPy pass, so they're cheap to test compared to visiting more nodes.
+BVH_MAX_LEAF_SIZE = 16
+# The number of bins the primitives' centroids are sorted into when evaluating BVH splits.
+BVH_BIN_COUNT = 16
+# Scenes with fewer bounded primitives than this are traced without a BVH.
+BVH_MIN_PRIMITIVES = 16
+# The side length, in pixels, of the packets of primary rays whose frusta the surfaces are
+# culled against, with frustum culling.
+FRUSTUM_PACKET_SIZE = 8
+# The number of consecutive packets whose rays are intersected with the surfaces any of
+# their frusta may see together, with frustum culling. Consecutive packets are close on the
+# screen, so they mostly see the same surfaces.
+FRUSTUM_PACKETS_PER_CHUNK = 4
+# The maximal number of points whose shadow rays share a list of candidate occluders, with
+# occluder lists. Nearby points share most of their occluders, so small clusters keep the
+# lists short, at the cost of more NumPy passes.
+OCCLUDER_CLUSTER_SIZE = 64
+
+# The fraction of the shadow rays first cast per point by adaptive soft shadows, which are
+# spread evenly over the light's grid, and always include its corner and center cells.
+ADAPTIVE_SHADOW_INITIAL_FRACTION = 0.25
+# The number of precomputed light sample tables, the pixels cycle through them (each
+# rotated by a per pixel shift, so the pixels sharing a table get different samples).
+SAMPLE_TABLE_COUNT = 64
+# The number of bytes of a scene text file the streaming parser reads at a time.
+SCENE_PARSE_CHUNK_SIZE = 1 << 24
+# The minimal number of seconds between saves of a render checkpoint's list of done tiles.
+CHECKPOINT_INTERVAL = 1.0
+# The stride between the pixels rendered by the first, coarsest pass of a progressive render.
+PROGRESSIVE_INITIAL_STRIDE = 8
+# The number of pixels a progressive render traces between checks of its time budget.
+PROGRESSIVE_BATCH_SIZE = 1 << 10
+# The defaults of the adaptive anti-aliasing: the root of the number of sub-pixel samples of
+# every refined pixel, the edge score above which pixels are refined (see
+# antialiasing.edge_scores), and the average number of extra samples per pixel it may spend.
+ANTIALIAS_ROOT_SAMPLES = 2
+ANTIALIAS_THRESHOLD = 0.1
+ANTIALIAS_BUDGET = 1.0
+# The number of color levels below which a light's contribution to a pixel is too small to
+# cast shadow rays for, when light culling is enabled.
+LIGHT_CULL_THRESHOLD = 0.5
+# The maximal number of light-point pairs the light selection shades together.
+LIGHT_SELECTION_BATCH_SIZE = 1 << 20
+# The defaults of the render service: the port it listens on, the number of built scenes
+# every worker keeps for later jobs, and the number of finished jobs whose status and image
+# are kept for their clients to fetch.
+RENDER_SERVICE_PORT = 8765
+RENDER_SERVICE_SCENE_CACHE_SIZE = 8
+RENDER_SERVICE_JOB_HISTORY = 1000
+# The maximal size, in bytes, of a request to the render service, like a job with its scene's
+# text.
+RENDER_SERVICE_MAX_REQUEST_SIZE = 1 << 26
+# The maximal number of pixels of a render service job's image. A job's image takes 24 bytes
+# per pixel while it renders, so a worker rendering the largest job needs about 400 MB for it.
+RENDER_SERVICE_MAX_PIXELS = 1 << 24
@@ -1,8 +1,8 @@
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 import numpy as np
 
-from base_surface import Material, Surface
+from base_surface import HitRecord, Material, Surface
 from ray import Ray
 
 NORMALS = np.array(
@@ -18,9 +18,12 @@ NORMALS = np.array(
 
 
 class Cube(Surface):
+    __slots__ = ("position", "scale", "half_scale")
+
     def __init__(self, position: List[float], scale: float, material: Material):
         super().__init__(material)
-        self.position = np.array(position)
+        # A row of a float64 array is kept as a view, see scene_cache.CompiledScene.
+        self.position = np.asarray(position, dtype=np.float64)
         self.scale = scale
         self.half_scale = scale / 2.0
 
@@ -57,14 +60,173 @@ class Cube(Surface):
         t = t_near if t_near >= 0 else t_far
         return ray.at(t) if t >= 0 else None
 
+    @classmethod
+    def stack_parameters(cls, surfaces: List["Cube"]) -> Tuple[np.ndarray, ...]:
+        positions = np.array([cube.position for cube in surfaces]).reshape(-1, 3)
+        half_scales = np.array([cube.half_scale for cube in surfaces], dtype=np.float64)
+        return positions, half_scales
+
+    @classmethod
+    def unstack_parameters(
+        cls, parameters: Tuple[np.ndarray, ...], materials: List[Material]
+    ) -> List["Cube"]:
+        positions, half_scales = parameters
+        return [
+            cls(position, 2.0 * half_scale, material)
+            for position, half_scale, material in zip(
+                positions, half_scales.tolist(), materials
+            )
+        ]
+
+    @staticmethod
+    def stacked_bounding_boxes(
+        parameters: Tuple[np.ndarray, ...],
+    ) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        positions, half_scales = parameters
+        return (
+            positions - half_scales[:, np.newaxis],
+            positions + half_scales[:, np.newaxis],
+        )
+
+    @staticmethod
+    def intersect_stacked(
+        parameters: Tuple[np.ndarray, ...],
+        sources: np.ndarray,
+        directions: np.ndarray,
+    ) -> np.ndarray:
+        """
+        The batched version of intersect, using the slab method on all three axes of all the
+        cubes at once.
+        """
+        miss, t_near, t_far = Cube._stacked_slabs(parameters, sources, directions)
+        t = np.where(t_near >= 0, t_near, t_far)
+        return np.where(~miss & (t >= 0), t, np.inf)
+
+    @classmethod
+    def intersect_stacked_all(
+        cls,
+        parameters: Tuple[np.ndarray, ...],
+        sources: np.ndarray,
+        directions: np.ndarray,
+    ) -> np.ndarray:
+        miss, t_near, t_far = Cube._stacked_slabs(parameters, sources, directions)
+        t = np.stack([t_near, t_far], axis=2)
+        return np.where(~miss[:, :, np.newaxis] & (t >= 0), t, np.inf)
+
+    @staticmethod
+    def _stacked_slabs(
+        parameters: Tuple[np.ndarray, ...],
+        sources: np.ndarray,
+        directions: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Return (N, S) arrays of whether every ray misses every cube, and of the ray
+        parameters where its line enters and leaves the cube.
+        The arrays are computed shaped as (rays, cubes, axes).
+        """
+        positions, half_scales = parameters
+        outside, near, far = Cube._slab_distances(
+            (positions - half_scales[:, np.newaxis])[np.newaxis, :, :],
+            (positions + half_scales[:, np.newaxis])[np.newaxis, :, :],
+            sources[:, np.newaxis, :],
+            directions[:, np.newaxis, :],
+        )
+        t_near = near.max(axis=2)
+        t_far = far.min(axis=2)
+        miss = outside.any(axis=2) | (t_near > t_far) | (t_far < 0)
+        return miss, t_near, t_far
+
+    @staticmethod
+    def _slab_distances(
+        lows: np.ndarray,
+        highs: np.ndarray,
+        sources: np.ndarray,
+        directions: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Receive broadcastable arrays of the cubes' corners and the rays, whose last axis is
+        the axes of space, and return arrays of whether every ray's line is outside the slab
+        of every axis, and of the ray parameters where it enters and leaves it.
+        """
+        parallel = directions == 0
+        safe_directions = np.where(parallel, 1.0, directions)
+        t1 = (lows - sources) / safe_directions
+        t2 = (highs - sources) / safe_directions
+
+        # A ray parallel to a slab never enters or leaves it, so it either spans the whole
+        # line inside the slab, or misses the cube altogether.
+        outside = parallel & ((sources < lows) | (sources > highs))
+        near = np.where(parallel, -np.inf, np.minimum(t1, t2))
+        far = np.where(parallel, np.inf, np.maximum(t1, t2))
+        return outside, near, far
+
+    @staticmethod
+    def stacked_hit_faces(
+        parameters: Tuple[np.ndarray, ...],
+        rows: np.ndarray,
+        sources: np.ndarray,
+        directions: np.ndarray,
+    ) -> np.ndarray:
+        """
+        Return the indices in NORMALS of the faces the rays hit their cubes on, from the
+        slab test that found the hits: the face of the slab a ray enters last, or for a ray
+        from inside the cube, the face of the slab it leaves first.
+        """
+        positions, half_scales = parameters
+        _, near, far = Cube._slab_distances(
+            positions[rows] - half_scales[rows, np.newaxis],
+            positions[rows] + half_scales[rows, np.newaxis],
+            sources,
+            directions,
+        )
+        entering = near.max(axis=1) >= 0
+        axes = np.where(entering, near.argmax(axis=1), far.argmin(axis=1))
+        # A ray going towards the positive side of an axis enters through its negative face,
+        # and leaves through its positive one.
+        positive = directions[np.arange(len(rows)), axes] > 0
+        return 2 * axes + (positive == entering)
+
+    def hit_record(self, ray: Ray, t: float, index: int) -> HitRecord:
+        face = int(
+            self.stacked_hit_faces(
+                (self.position[np.newaxis, :], np.array([self.half_scale])),
+                np.zeros(1, dtype=np.int64),
+                ray.source[np.newaxis, :],
+                ray.direction[np.newaxis, :],
+            )[0]
+        )
+        return HitRecord(t, index, self, ray.at(t), NORMALS[face], face)
+
+    def face_at_point(self, point: np.ndarray) -> int:
+        """
+        Return the index in NORMALS of the face the given point is on, assuming it's on the
+        cube's surface: the face of the axis along which the point is farthest from the
+        cube's center, on the point's side of it. Hits know their faces from the slab test,
+        see stacked_hit_faces, so this is only for points without a ray, which are ambiguous
+        near the cube's edges.
+        """
+        offset = point - self.position
+        axis = int(np.argmax(np.abs(offset)))
+        return 2 * axis + int(offset[axis] < 0)
+
     def normal_at_point(self, point: np.ndarray, ray_vec: np.ndarray) -> np.ndarray:
         """
-        Calculate the normal at the given point, assuming it's on the cub's surface.
-        This calculation uses the fact that the face center closest to a point on the surface
-        of a cube is the center of the face the point is on.
+        Calculate the normal at the given point, assuming it's on the cube's surface.
         """
-        point_repeated = np.repeat(point[np.newaxis, :], len(NORMALS), axis=0)
-        centers = self.position + NORMALS * self.half_scale
-        point_to_centers_vectors = np.linalg.norm(point_repeated - centers, axis=1)
-        closest = np.argmin(point_to_centers_vectors)
-        return NORMALS[closest]
+        return NORMALS[self.face_at_point(point)]
+
+    @staticmethod
+    def stacked_normals_at_points(
+        parameters: Tuple[np.ndarray, ...],
+        rows: np.ndarray,
+        points: np.ndarray,
+        ray_vecs: np.ndarray,
+        faces: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        if faces is not None:
+            return NORMALS[faces]
+        positions, _ = parameters
+        offsets = points - positions[rows]
+        axes = np.argmax(np.abs(offsets), axis=1)
+        negative = offsets[np.arange(len(points)), axes] < 0
+        return NORMALS[2 * axes + negative]
@@ -0,0 +1,292 @@
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+import stats
+from base_surface import (
+    Surface,
+    SurfaceGroups,
+    as_surface_groups,
+    update_closest_surfaces,
+)
+from consts import (
+    EPSILON,
+    FRUSTUM_PACKET_SIZE,
+    FRUSTUM_PACKETS_PER_CHUNK,
+    INTERSECTION_BATCH_SIZE,
+)
+from tiles import morton_codes
+
+# The number of planes bounding every packet's frustum: its left, right, top and bottom.
+FRUSTUM_PLANE_COUNT = 4
+
+
+class RayPackets:
+    """
+    Rays shot from a common source (the camera), split into packets of rays through nearby
+    pixels, with the frustum bounding the rays of every packet: the planes through the source
+    and the edges of the packet's pixels on the screen.
+    A box which is entirely outside one of a frustum's planes can't be hit by any of its
+    packet's rays, so the surfaces' bounding boxes (and the BVH's nodes) are culled against
+    the frusta once per packet, and only the surviving ones are intersected with its rays.
+    :param source: The (3,) source of all the rays.
+    :param normals: A (K, FRUSTUM_PLANE_COUNT, 3) array of the unit normals of the packets'
+    planes, pointing into the frusta.
+    :param directions: A (K, 3) array of the directions of the frusta's centers.
+    :param packets: An (N,) array of the packet of every ray.
+    """
+
+    def __init__(
+        self,
+        source: np.ndarray,
+        normals: np.ndarray,
+        directions: np.ndarray,
+        packets: np.ndarray,
+    ):
+        self.source = source
+        self.normals = normals
+        self.plane_offsets = normals @ source
+        self.directions = directions
+        # The rays of every packet, in the order of the packets.
+        self._rays = np.argsort(packets, kind="stable")
+        self._starts = np.concatenate(
+            [[0], np.cumsum(np.bincount(packets, minlength=len(normals)))]
+        )
+
+    def __len__(self) -> int:
+        return len(self.normals)
+
+    def rays(self, packets: np.ndarray) -> np.ndarray:
+        """
+        Return the indices of the rays of the given packets.
+        """
+        return self._packet_rays(packets)[0]
+
+    def _packet_rays(self, packets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return a pair of arrays of the indices of the rays of the given packets, in the order
+        of the packets, and of the position in packets of every ray's packet.
+        """
+        counts = self._starts[packets + 1] - self._starts[packets]
+        positions = np.arange(counts.sum()) - np.repeat(
+            np.cumsum(counts) - counts, counts
+        )
+        return (
+            self._rays[np.repeat(self._starts[packets], counts) + positions],
+            np.repeat(np.arange(len(packets)), counts),
+        )
+
+    def overlap(
+        self, lows: np.ndarray, highs: np.ndarray, packets: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """
+        Return a (P, S) boolean array of whether the frusta of the given P packets (all of
+        them by default) may intersect the S boxes with the given (S, 3) minimal and maximal
+        corners. The test is conservative: a box is only culled if the corner that's
+        farthest into the frustum along one of its planes' normals is outside that plane.
+        """
+        normals = self.normals if packets is None else self.normals[packets]
+        offsets = self.plane_offsets if packets is None else self.plane_offsets[packets]
+        distances = -offsets[:, :, np.newaxis]
+        for axis in range(3):
+            axis_normals = normals[:, :, axis, np.newaxis]
+            distances = distances + np.maximum(
+                axis_normals * lows[:, axis], axis_normals * highs[:, axis]
+            )
+        return np.all(distances >= -EPSILON, axis=1)
+
+    def update_closest_surfaces(
+        self,
+        surface_type: type,
+        parameters: Tuple[np.ndarray, ...],
+        surface_indices: np.ndarray,
+        sources: np.ndarray,
+        directions: np.ndarray,
+        closest_indices: np.ndarray,
+        min_t: np.ndarray,
+        packets: Optional[np.ndarray] = None,
+        candidates: Optional[np.ndarray] = None,
+    ) -> int:
+        """
+        Cull the given bounded surfaces of a type against the frusta of the given packets
+        (all of them by default), intersect the rays of every FRUSTUM_PACKETS_PER_CHUNK
+        consecutive packets with the surfaces any of their frusta may see, in a single
+        intersect_stacked call, and update the closest hits found so far in place, see
+        base_surface.update_closest_surfaces. Return the number of intersection tests made,
+        including the ones of rays with surfaces outside their own packet's frustum, whose
+        hits are discarded.
+        :param parameters: The stacked parameters of the surfaces, see intersect_stacked.
+        :param surface_indices: The indices of the surfaces in the scene.
+        :param candidates: An optional (N,) boolean array of the rays that may be intersected,
+        the others are skipped.
+        """
+        if packets is None:
+            packets = np.arange(len(self))
+        if len(packets) == 0:
+            return 0
+        lows, highs = surface_type.stacked_bounding_boxes(parameters)
+        # The surfaces are culled in batches small enough for both their frustum tests and
+        # their intersections with every chunk's rays.
+        chunk_size = FRUSTUM_PACKETS_PER_CHUNK * int(
+            np.max(self._starts[packets + 1] - self._starts[packets])
+        )
+        batch_size = max(
+            1,
+            INTERSECTION_BATCH_SIZE
+            // max(FRUSTUM_PLANE_COUNT * len(packets), chunk_size),
+        )
+        tests = 0
+        for start in range(0, len(surface_indices), batch_size):
+            visible = self.overlap(
+                lows[start : start + batch_size],
+                highs[start : start + batch_size],
+                packets,
+            )
+            stats.count("frustum.culled", int(visible.size - visible.sum()))
+            # The rays of the packets that may see any of the surfaces, with the rows of
+            # visible of their packets.
+            seeing = np.flatnonzero(visible.any(axis=1))
+            rays, owners = self._packet_rays(packets[seeing])
+            owners = seeing[owners]
+            if candidates is not None:
+                kept = candidates[rays]
+                rays, owners = rays[kept], owners[kept]
+
+            # Every chunk of packets' rays is intersected with all the surfaces any of the
+            # packets may see at once, and the hits on surfaces outside a ray's own packet's
+            # frustum are discarded.
+            chunk_starts = np.searchsorted(owners, seeing[::FRUSTUM_PACKETS_PER_CHUNK])
+            chunk_ends = np.append(chunk_starts[1:], len(rays))
+            for chunk_start, chunk_end in zip(chunk_starts, chunk_ends):
+                if chunk_start == chunk_end:
+                    continue
+                chunk_rays = rays[chunk_start:chunk_end]
+                chunk_owners = owners[chunk_start:chunk_end]
+                columns = np.flatnonzero(visible[np.unique(chunk_owners)].any(axis=0))
+                t = surface_type.intersect_stacked(
+                    tuple(parameter[start + columns] for parameter in parameters),
+                    sources[chunk_rays],
+                    directions[chunk_rays],
+                )
+                stats.count("tests." + surface_type.__name__, t.size)
+                tests += t.size
+                t[~visible[np.ix_(chunk_owners, columns)]] = np.inf
+                update_closest_surfaces(
+                    closest_indices,
+                    min_t,
+                    chunk_rays,
+                    t,
+                    surface_indices[start + columns],
+                )
+        return tests
+
+
+def pixel_packets(
+    ray_tracer,
+    height: int,
+    width: int,
+    rows: np.ndarray,
+    cols: np.ndarray,
+    packet_size: int = FRUSTUM_PACKET_SIZE,
+) -> RayPackets:
+    """
+    Split the primary rays through the given pixels of an image of the given size into packets
+    of the rays in the same packet_size x packet_size block of pixels, ordered along a Z-order
+    curve over the blocks (see tiles.morton_codes).
+    The rows and columns may be fractional, for rays through points at offsets from the
+    pixels' centers of at most half a pixel.
+    """
+    block_rows = np.floor((rows + 0.5) / packet_size).astype(np.int64)
+    block_cols = np.floor((cols + 0.5) / packet_size).astype(np.int64)
+    _, packets = np.unique(morton_codes(block_rows, block_cols), return_inverse=True)
+    packets = packets.ravel()
+    order = np.argsort(packets, kind="stable")
+    starts = np.flatnonzero(np.diff(packets[order], prepend=-1))
+    packet_count = len(starts)
+
+    # Every packet's frustum goes through the edges of its rays' pixels, half a pixel away
+    # from the centers of the outermost ones, so it's never flat.
+    top = np.minimum.reduceat(rows[order], starts)
+    bottom = np.maximum.reduceat(rows[order], starts)
+    left = np.minimum.reduceat(cols[order], starts)
+    right = np.maximum.reduceat(cols[order], starts)
+    corner_rows = np.concatenate([top, top, bottom, bottom]) + np.repeat(
+        [-0.5, -0.5, 0.5, 0.5], packet_count
+    )
+    corner_cols = np.concatenate([left, right, right, left]) + np.repeat(
+        [-0.5, 0.5, 0.5, -0.5], packet_count
+    )
+    _, corners = ray_tracer.construct_rays_through_pixels(
+        height, width, corner_rows, corner_cols
+    )
+    corners = corners.reshape(FRUSTUM_PLANE_COUNT, packet_count, 3)
+
+    centers = corners.sum(axis=0)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    normals = np.stack(
+        [
+            np.cross(corners[i], corners[(i + 1) % FRUSTUM_PLANE_COUNT])
+            for i in range(FRUSTUM_PLANE_COUNT)
+        ],
+        axis=1,
+    )
+    normals *= np.where(np.einsum("kpi,ki->kp", normals, centers) < 0, -1.0, 1.0)[
+        :, :, np.newaxis
+    ]
+    normals /= np.linalg.norm(normals, axis=2, keepdims=True)
+    return RayPackets(ray_tracer.camera.position, normals, centers, packets)
+
+
+@stats.timed("intersection")
+def get_closest_surfaces_in_packets(
+    sources: np.ndarray,
+    directions: np.ndarray,
+    surfaces: Union[List[Surface], SurfaceGroups],
+    packets: RayPackets,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Like get_closest_surfaces, for rays split into packets with bounding frusta: the bounded
+    surfaces are culled against every packet's frustum (or the BVH's nodes are, for the
+    surfaces in the BVH), and are only intersected with the rays of the packets they may be
+    seen by. Unbounded surfaces, such as infinite planes, are intersected with all the rays.
+    """
+    surfaces = as_surface_groups(surfaces)
+    closest_indices = np.full(len(sources), -1, dtype=np.int64)
+    min_t = np.full(len(sources), np.inf)
+    rows = np.arange(len(sources))
+    stats.count("frustum.packets", len(packets))
+
+    for surface_type, group_indices, parameters in surfaces.groups:
+        if surfaces.bvh is not None and surface_type in surfaces.bvh.surface_types:
+            continue
+        if surface_type.stacked_bounding_boxes(parameters) is None:
+            group_batch_size = max(1, INTERSECTION_BATCH_SIZE // max(1, len(sources)))
+            for start in range(0, len(group_indices), group_batch_size):
+                batch = slice(start, start + group_batch_size)
+                t = surface_type.intersect_stacked(
+                    tuple(parameter[batch] for parameter in parameters),
+                    sources,
+                    directions,
+                )
+                stats.count("tests." + surface_type.__name__, t.size)
+                update_closest_surfaces(
+                    closest_indices, min_t, rows, t, group_indices[batch]
+                )
+            continue
+
+        packets.update_closest_surfaces(
+            surface_type,
+            parameters,
+            group_indices,
+            sources,
+            directions,
+            closest_indices,
+            min_t,
+        )
+
+    if surfaces.bvh is not None:
+        surfaces.bvh.update_closest_surfaces_in_packets(
+            sources, directions, packets, closest_indices, min_t
+        )
+
+    return closest_indices, min_t
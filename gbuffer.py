@@ -0,0 +1,173 @@
+import hashlib
+import os
+from typing import Optional
+
+import numpy as np
+
+from base_surface import (
+    SurfaceGroups,
+    get_closest_surfaces,
+    hit_faces,
+    normals_at_points,
+)
+from camera import Camera
+from consts import RAY_BATCH_SIZE
+
+# Bumped whenever the G-buffer's contents or key change, so old cache files aren't reused.
+GBUFFER_VERSION = 2
+
+
+class GBuffer:
+    """
+    The primary hits of an image's pixels: the index of the surface each pixel's ray hits
+    (-1 for misses), and the hit's position, the surface's normal there, and the ray's
+    direction (the opposite of the view direction). Rows of pixels that miss hold zeros.
+    They only depend on the camera, the image's size and the surfaces' geometry, so they can
+    be reused when only the lights or the materials change.
+    """
+
+    def __init__(
+        self,
+        surface_indices: np.ndarray,
+        positions: np.ndarray,
+        normals: np.ndarray,
+        directions: np.ndarray,
+    ):
+        self.surface_indices = surface_indices
+        self.positions = positions
+        self.normals = normals
+        self.directions = directions
+
+    def __len__(self) -> int:
+        return len(self.surface_indices)
+
+    @staticmethod
+    def from_hits(
+        surfaces: SurfaceGroups,
+        sources: np.ndarray,
+        directions: np.ndarray,
+        surface_indices: np.ndarray,
+        t: np.ndarray,
+    ) -> "GBuffer":
+        """
+        Return the G-buffer of rays with the given closest hits, see get_closest_surfaces.
+        """
+        hit = surface_indices != -1
+        positions = np.zeros_like(directions)
+        normals = np.zeros_like(directions)
+        positions[hit] = sources[hit] + t[hit, np.newaxis] * directions[hit]
+        faces = hit_faces(surfaces, surface_indices[hit], sources[hit], directions[hit])
+        normals[hit] = normals_at_points(
+            surfaces, surface_indices[hit], positions[hit], directions[hit], faces
+        )
+        return GBuffer(surface_indices, positions, normals, directions)
+
+    def take(self, pixel_indices: np.ndarray) -> "GBuffer":
+        """
+        Return the G-buffer of the given pixels, in their order.
+        """
+        return GBuffer(
+            self.surface_indices[pixel_indices],
+            self.positions[pixel_indices],
+            self.normals[pixel_indices],
+            self.directions[pixel_indices],
+        )
+
+    def save(self, path: str) -> None:
+        np.savez(
+            path,
+            surface_indices=self.surface_indices,
+            positions=self.positions,
+            normals=self.normals,
+            directions=self.directions,
+        )
+
+    @staticmethod
+    def load(path: str) -> "GBuffer":
+        with np.load(path) as arrays:
+            return GBuffer(
+                arrays["surface_indices"],
+                arrays["positions"],
+                arrays["normals"],
+                arrays["directions"],
+            )
+
+
+def gbuffer_key(
+    camera: Camera, surfaces: SurfaceGroups, height: int, width: int
+) -> str:
+    """
+    Return a hash of everything the primary hits depend on: the camera, the image's size,
+    and the type, order and geometry of the surfaces (but not their materials).
+    """
+    key = hashlib.sha256()
+    key.update(np.array([GBUFFER_VERSION, height, width], dtype=np.int64).tobytes())
+    key.update(
+        np.concatenate(
+            [
+                camera.position,
+                camera.look_at,
+                camera.up_vector,
+                [camera.screen_distance, camera.screen_width],
+            ]
+        )
+        .astype(np.float64)
+        .tobytes()
+    )
+    for surface_type, indices, parameters in surfaces.groups:
+        key.update(surface_type.__name__.encode())
+        key.update(indices.astype(np.int64).tobytes())
+        for parameter in parameters:
+            key.update(np.ascontiguousarray(parameter, dtype=np.float64).tobytes())
+    return key.hexdigest()
+
+
+def compute_gbuffer(ray_tracer, height: int, width: int) -> GBuffer:
+    """
+    Intersect the primary rays of all the image's pixels, in batches of RAY_BATCH_SIZE.
+    """
+    pixel_count = height * width
+    surface_indices = np.full(pixel_count, -1, dtype=np.int64)
+    positions = np.zeros((pixel_count, 3))
+    normals = np.zeros((pixel_count, 3))
+    directions = np.zeros((pixel_count, 3))
+    for start in range(0, pixel_count, RAY_BATCH_SIZE):
+        pixels = np.arange(start, min(start + RAY_BATCH_SIZE, pixel_count))
+        rows, cols = np.divmod(pixels, width)
+        sources, batch_directions = ray_tracer.construct_rays_through_pixels(
+            height, width, rows, cols
+        )
+        batch_indices, t = get_closest_surfaces(
+            sources, batch_directions, ray_tracer.surfaces
+        )
+        batch = GBuffer.from_hits(
+            ray_tracer.surfaces, sources, batch_directions, batch_indices, t
+        )
+        surface_indices[pixels] = batch.surface_indices
+        positions[pixels] = batch.positions
+        normals[pixels] = batch.normals
+        directions[pixels] = batch.directions
+    return GBuffer(surface_indices, positions, normals, directions)
+
+
+def load_or_compute_gbuffer(
+    ray_tracer, height: int, width: int, cache_dir: Optional[str] = None
+) -> GBuffer:
+    """
+    Return the G-buffer of the ray tracer's image, from the cache directory if it was already
+    computed for the same camera, image size and geometry, and otherwise compute it (and save
+    it into the cache directory, if there's one).
+    """
+    if cache_dir is None:
+        return compute_gbuffer(ray_tracer, height, width)
+    key = gbuffer_key(ray_tracer.camera, ray_tracer.surfaces, height, width)
+    path = os.path.join(cache_dir, f"gbuffer-{key}.npz")
+    if os.path.exists(path):
+        return GBuffer.load(path)
+    gbuffer = compute_gbuffer(ray_tracer, height, width)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Written aside and renamed, so that an interrupted write doesn't leave a broken cache.
+    temporary_path = path[: -len(".npz")] + f".{os.getpid()}.tmp.npz"
+    gbuffer.save(temporary_path)
+    os.replace(temporary_path, path)
+    return gbuffer
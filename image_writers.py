@@ -0,0 +1,157 @@
+import os
+import struct
+import zlib
+from typing import Optional
+
+import numpy as np
+
+from consts import COLOR_CHANNELS, COLOR_SCALE
+from tiles import Tile
+
+# The formats the images can be streamed into, by their files' extensions.
+STREAMING_IMAGE_FORMATS = (".png", ".npy", ".pfm", ".raw")
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# The PNG filter type of the "Sub" filter, which stores every byte's difference from the
+# same channel of the pixel before it.
+PNG_FILTER_SUB = 1
+
+
+class ImageWriter:
+    """
+    Writes an image to a file tile by tile, as the tiles are rendered, without ever holding
+    the whole image in memory. The tiles must be written in scanline order, see
+    tiles.split_into_tiles. The pixels are given in the range [0, COLOR_SCALE] (or beyond it,
+    for HDR images), and stored as uint8, like save_image does, or as float32 values where
+    1.0 is COLOR_SCALE.
+    """
+
+    def __init__(self, height: int, width: int):
+        self.height = height
+        self.width = width
+
+    def write_tile(self, tile: Tile, pixels: np.ndarray) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> "ImageWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class MemmapImageWriter(ImageWriter):
+    """
+    Writes the tiles into a memory-mapped (height, width, COLOR_CHANNELS) array, which is
+    flushed to the disk after every row of tiles, so the written pages can be evicted.
+    :param image: The memory-mapped image, uint8 or float (for HDR images).
+    :param flip_rows: Whether the image's rows are stored bottom to top.
+    """
+
+    def __init__(self, image: np.memmap, flip_rows: bool = False):
+        super().__init__(image.shape[0], image.shape[1])
+        self.image = image
+        self._rows = image[::-1] if flip_rows else image
+
+    def write_tile(self, tile: Tile, pixels: np.ndarray) -> None:
+        if self.image.dtype != np.uint8:
+            pixels = pixels / COLOR_SCALE
+        self._rows[tile.top : tile.bottom, tile.left : tile.right] = pixels
+        if tile.right == self.width:
+            self.image.flush()
+
+    def close(self) -> None:
+        self.image.flush()
+
+
+class PngImageWriter(ImageWriter):
+    """
+    Encodes the image into an 8-bit RGB PNG file as its rows of tiles are completed,
+    compressing every row of tiles into the file's data as soon as it's done, so only
+    a single row of tiles is kept in memory.
+    """
+
+    def __init__(self, path: str, height: int, width: int):
+        super().__init__(height, width)
+        self._file = open(path, "wb")
+        self._file.write(PNG_SIGNATURE)
+        self._write_chunk(
+            b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+        )
+        self._compressor = zlib.compressobj()
+        self._band: Optional[np.ndarray] = None
+
+    def _write_chunk(self, chunk_type: bytes, data: bytes) -> None:
+        self._file.write(struct.pack(">I", len(data)))
+        self._file.write(chunk_type)
+        self._file.write(data)
+        self._file.write(struct.pack(">I", zlib.crc32(chunk_type + data)))
+
+    def write_tile(self, tile: Tile, pixels: np.ndarray) -> None:
+        if tile.left == 0:
+            self._band = np.empty(
+                (tile.bottom - tile.top, self.width, COLOR_CHANNELS), dtype=np.uint8
+            )
+        self._band[:, tile.left : tile.right] = np.uint8(pixels)
+        if tile.right == self.width:
+            rows = self._band.reshape(len(self._band), -1)
+            filtered = np.empty((len(rows), rows.shape[1] + 1), dtype=np.uint8)
+            filtered[:, 0] = PNG_FILTER_SUB
+            filtered[:, 1 : 1 + COLOR_CHANNELS] = rows[:, :COLOR_CHANNELS]
+            # uint8 arithmetic wraps around, like the filter's differences modulo 256.
+            filtered[:, 1 + COLOR_CHANNELS :] = (
+                rows[:, COLOR_CHANNELS:] - rows[:, :-COLOR_CHANNELS]
+            )
+            data = self._compressor.compress(filtered.tobytes())
+            if data:
+                self._write_chunk(b"IDAT", data)
+            self._band = None
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        self._write_chunk(b"IDAT", self._compressor.flush())
+        self._write_chunk(b"IEND", b"")
+        self._file.close()
+
+
+def open_image_writer(
+    path: str, height: int, width: int, hdr: bool = False
+) -> ImageWriter:
+    """
+    Return a writer of an image of the given size into the given path, in the format of its
+    extension, one of STREAMING_IMAGE_FORMATS:
+    .png is an 8-bit PNG, .npy is a NumPy array, .pfm is a float32 Portable FloatMap, and .raw
+    is the array's bytes alone, in row-major order.
+    With hdr, the .npy and .raw images are stored as float32 values where 1.0 is white, which
+    can hold unclipped pixels, and otherwise as uint8 values, like save_image does.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in STREAMING_IMAGE_FORMATS:
+        raise ValueError(
+            f"Can't stream an image into {path}, the supported formats are "
+            + ", ".join(STREAMING_IMAGE_FORMATS)
+        )
+    if extension == ".png":
+        if hdr:
+            raise ValueError("PNG images can't hold HDR values")
+        return PngImageWriter(path, height, width)
+
+    shape = (height, width, COLOR_CHANNELS)
+    if extension == ".pfm":
+        # The scale's negative sign marks the values as little-endian.
+        header = f"PF\n{width} {height}\n-1.0\n".encode()
+        with open(path, "wb") as f:
+            f.write(header)
+            f.truncate(len(header) + 4 * height * width * COLOR_CHANNELS)
+        image = np.memmap(path, dtype="<f4", mode="r+", offset=len(header), shape=shape)
+        return MemmapImageWriter(image, flip_rows=True)
+
+    dtype = np.float32 if hdr else np.uint8
+    if extension == ".npy":
+        image = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+    else:
+        image = np.memmap(path, dtype=dtype, mode="w+", shape=shape)
+    return MemmapImageWriter(image)
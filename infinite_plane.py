@@ -1,13 +1,16 @@
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 import numpy as np
 
+import vector
 from base_surface import Material, Surface
 from consts import EPSILON
 from ray import Ray
 
 
 class InfinitePlane(Surface):
+    __slots__ = ("normal", "offset")
+
     def __init__(self, normal: List[float], offset: float, material: Material):
         super().__init__(material)
         self.normal = np.array(normal) / np.linalg.norm(normal)
@@ -24,6 +27,74 @@ class InfinitePlane(Surface):
         t = (self.offset - np.dot(ray.source, self.normal)) / denom
         return ray.at(t) if t >= 0 else None
 
+    @classmethod
+    def stack_parameters(
+        cls, surfaces: List["InfinitePlane"]
+    ) -> Tuple[np.ndarray, ...]:
+        normals = np.array([plane.normal for plane in surfaces]).reshape(-1, 3)
+        offsets = np.array([plane.offset for plane in surfaces], dtype=np.float64)
+        return normals, offsets
+
+    @classmethod
+    def unstack_parameters(
+        cls, parameters: Tuple[np.ndarray, ...], materials: List[Material]
+    ) -> List["InfinitePlane"]:
+        normals, offsets = parameters
+        planes = []
+        for normal, offset, material in zip(normals, offsets.tolist(), materials):
+            plane = cls(normal, offset, material)
+            # The stacked normals are already normalized, and normalizing them again could
+            # change their last bits.
+            plane.normal = normal
+            planes.append(plane)
+        return planes
+
+    @staticmethod
+    def intersect_stacked(
+        parameters: Tuple[np.ndarray, ...],
+        sources: np.ndarray,
+        directions: np.ndarray,
+    ) -> np.ndarray:
+        normals, offsets = parameters
+        denom = directions @ normals.T
+        parallel = np.abs(denom) < EPSILON
+        t = (offsets - sources @ normals.T) / np.where(parallel, 1.0, denom)
+        return np.where(~parallel & (t >= 0), t, np.inf)
+
+    @staticmethod
+    def stacked_near_segment(
+        parameters: Tuple[np.ndarray, ...],
+        start: np.ndarray,
+        end: np.ndarray,
+        radius: float,
+    ) -> np.ndarray:
+        # A plane comes within radius of a segment unless both of its ends are farther than
+        # radius from it, on the same side.
+        normals, offsets = parameters
+        lengths = np.linalg.norm(normals, axis=1)
+        start_distances = (normals @ start - offsets) / lengths
+        end_distances = (normals @ end - offsets) / lengths
+        return ~(
+            ((start_distances > radius) & (end_distances > radius))
+            | ((start_distances < -radius) & (end_distances < -radius))
+        )
+
     def normal_at_point(self, point: np.ndarray, ray_vec: np.ndarray) -> np.ndarray:
-        dot = self.normal @ ray_vec
-        return -self.normal if dot > 0 else self.normal
+        return self.orient_normal(self.normal, ray_vec)
+
+    def orient_normal(self, normal: np.ndarray, ray_vec: np.ndarray) -> np.ndarray:
+        dot = normal @ ray_vec
+        return -normal if dot > 0 else normal
+
+    @staticmethod
+    def stacked_normals_at_points(
+        parameters: Tuple[np.ndarray, ...],
+        rows: np.ndarray,
+        points: np.ndarray,
+        ray_vecs: np.ndarray,
+        faces: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        normals, _ = parameters
+        normals = normals[rows]
+        dots = vector.dot_rows(ray_vecs, normals)
+        return np.where((dots > 0)[:, np.newaxis], -normals, normals)
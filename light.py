@@ -1,14 +1,33 @@
-from typing import List
+import zlib
+from typing import List, Optional, Tuple
 
 import numpy as np
 
+import stats
 import vector
-from base_surface import Surface, get_closest_surface
-from consts import EPSILON
+from base_surface import (
+    Surface,
+    are_segments_occluded,
+    normals_at_points,
+    reflection_directions,
+    segment_transmittances,
+)
+from consts import ADAPTIVE_SHADOW_INITIAL_FRACTION, RAY_BATCH_SIZE
 from ray import Ray
+from sampling import SHADOW_SAMPLING_RANDOM, SampleTables, grid_cell_indices
 
 
 class Light:
+    __slots__ = (
+        "position",
+        "color",
+        "specular_intensity",
+        "shadow_intensity",
+        "radius",
+        "sample_tables",
+        "occluders",
+    )
+
     def __init__(
         self,
         position: List[float],
@@ -22,6 +41,16 @@ class Light:
         self.specular_intensity = specular_intensity
         self.shadow_intensity = shadow_intensity
         self.radius = radius
+        # The tables are seeded by the light's parameters, so that different lights don't
+        # share their sample patterns, but every process uses the same ones.
+        self.sample_tables = SampleTables(
+            zlib.crc32(
+                np.array([*position, *color, radius], dtype=np.float64).tobytes()
+            )
+        )
+        # The optional candidate occluders of the light's shadow rays, which the shadow rays
+        # are only intersected with, see occluders.LightOccluders.
+        self.occluders = None
 
     @staticmethod
     def is_path_clear(
@@ -34,70 +63,289 @@ class Light:
         any other surface on the way.
         This method expects the dest point to be on a surface and the source to be a light source.
         """
-        light_ray = Ray.ray_between_points(source, dest)
-        _, light_intersection = get_closest_surface(light_ray, surfaces)
-        return light_intersection is None or np.allclose(
-            dest, light_intersection, atol=EPSILON
-        )
+        stats.count("rays.shadow")
+        return not are_segments_occluded(
+            source[np.newaxis, :], dest[np.newaxis, :], surfaces
+        )[0]
+
+    @staticmethod
+    def is_path_clear_many(
+        sources: np.ndarray,
+        dests: np.ndarray,
+        surfaces: List[Surface],
+        groups: Optional[List[Tuple[type, np.ndarray, Tuple[np.ndarray, ...]]]] = None,
+    ) -> np.ndarray:
+        """
+        The batched version of is_path_clear, receive (N, 3) arrays of light source points and
+        destination points, and return an (N,) boolean array of the result of each path.
+        :param groups: Optional groups of the only surfaces that may block the paths, see
+        base_surface.are_segments_occluded.
+        """
+        stats.count("rays.shadow", len(sources))
+        return ~are_segments_occluded(sources, dests, surfaces, groups)
+
+    @staticmethod
+    def path_transmittances(
+        sources: np.ndarray,
+        dests: np.ndarray,
+        surfaces: List[Surface],
+        groups: Optional[List[Tuple[type, np.ndarray, Tuple[np.ndarray, ...]]]] = None,
+    ) -> np.ndarray:
+        """
+        Like is_path_clear_many, but the paths are also partially clear through transparent
+        surfaces: return an (N,) array of the fraction of the light that reaches each
+        destination point, see base_surface.segment_transmittances.
+        """
+        stats.count("rays.shadow", len(sources))
+        return segment_transmittances(sources, dests, surfaces, groups)
 
     def calculate_intensity(
         self,
         surfaces: List[Surface],
         root_number_shadow_rays: int,
         point: np.ndarray,
+        rng: Optional[np.random.Generator] = None,
+        adaptive: bool = False,
+        sampling: str = SHADOW_SAMPLING_RANDOM,
+        sample_index: int = 0,
+        transparent_shadows: bool = False,
     ) -> float:
         """
         Receive the list of surfaces, the number of shadow rays to case and a point, and
         return the light intensity value on the point measured as coefficient in the range [0, 1].
         The calculation is done according to the "soft shadows" algorithm.
         If the number of shadow rays is 1, we calculate "hard shadows" instead.
+        All the shadow rays of the point are traced together as a single packet.
+        The soft shadows' samples are drawn from the given random generator, or from the
+        global NumPy random state if it isn't given.
+        For adaptive, sampling and transparent_shadows, see calculate_intensity_many.
         """
+        return self.calculate_intensity_many(
+            surfaces,
+            root_number_shadow_rays,
+            point[np.newaxis, :],
+            rng,
+            adaptive,
+            sampling=sampling,
+            sample_indices=np.array([sample_index]),
+            transparent_shadows=transparent_shadows,
+        )[0]
+
+    @stats.timed("shadows")
+    def calculate_intensity_many(
+        self,
+        surfaces: List[Surface],
+        root_number_shadow_rays: int,
+        points: np.ndarray,
+        rng: Optional[np.random.Generator] = None,
+        adaptive: bool = False,
+        sample_counts: Optional[np.ndarray] = None,
+        sampling: str = SHADOW_SAMPLING_RANDOM,
+        sample_indices: Optional[np.ndarray] = None,
+        transparent_shadows: bool = False,
+    ) -> np.ndarray:
+        """
+        The batched version of calculate_intensity, receive an (N, 3) array of points and
+        return an (N,) array of their light intensity values.
+        If adaptive is True, only a stratified subset of the grid's cells is sampled at first,
+        and the rest of the grid is sampled only for points where the subset's samples
+        disagree, i.e. points in the penumbra. Points where they all agree are considered
+        fully lit or fully occluded.
+        :param sample_counts: An optional (N,) array, to which the number of shadow rays cast
+        for every point is added.
+        :param sampling: One of the sampling.SHADOW_SAMPLING_MODES. With "random", the samples
+        are drawn from rng, and otherwise they're looked up in the light's sample tables.
+        :param sample_indices: An optional (N,) array of the indices of the sample tables to
+        use for every point, usually the indices of the pixels they're shaded for.
+        :param transparent_shadows: Whether shadow rays pass partially through transparent
+        surfaces, attenuated by their transparency, instead of being blocked by any surface.
+        """
+        if sample_indices is None:
+            sample_indices = np.arange(len(points))
+        number_shadow_rays = root_number_shadow_rays * root_number_shadow_rays
+        points_per_batch = max(1, RAY_BATCH_SIZE // number_shadow_rays)
+        intensities = np.empty(len(points))
+        for start in range(0, len(points), points_per_batch):
+            batch = slice(start, start + points_per_batch)
+            intensities[batch], batch_sample_counts = self._calculate_intensity_batch(
+                surfaces,
+                root_number_shadow_rays,
+                points[batch],
+                rng,
+                adaptive,
+                sampling,
+                sample_indices[batch],
+                transparent_shadows,
+            )
+            if sample_counts is not None:
+                sample_counts[batch] += batch_sample_counts
+        return intensities
+
+    def _calculate_intensity_batch(
+        self,
+        surfaces: List[Surface],
+        root_number_shadow_rays: int,
+        points: np.ndarray,
+        rng: Optional[np.random.Generator] = None,
+        adaptive: bool = False,
+        sampling: str = SHADOW_SAMPLING_RANDOM,
+        sample_indices: Optional[np.ndarray] = None,
+        transparent_shadows: bool = False,
+    ) -> Tuple[np.ndarray, np.ndarray]:
         if root_number_shadow_rays == 1:
-            return 1.0 - self.shadow_intensity * (
-                not Light.is_path_clear(self.position, point, surfaces)
+            light_sources = np.repeat(
+                self.position[np.newaxis, np.newaxis, :], len(points), axis=0
+            )
+            blocked = (
+                1.0
+                - self._trace_shadow_rays(
+                    light_sources, points, surfaces, transparent_shadows
+                )[:, 0]
             )
+            return 1.0 - self.shadow_intensity * blocked, np.ones(len(points))
 
-        normal = Ray.ray_between_points(self.position, point)
-        vec1, vec2 = vector.orthonormal_vector_pair(normal.direction)
+        normals = vector.normalize_rows(points - self.position)
+        vec1, vec2 = vector.orthonormal_vector_pairs(normals)
 
-        row_indices = np.repeat(
-            np.arange(root_number_shadow_rays),
-            root_number_shadow_rays,
-        )[:, np.newaxis]
-        col_indices = np.tile(
-            np.arange(root_number_shadow_rays),
-            root_number_shadow_rays,
-        )[:, np.newaxis]
+        # Shape everything as (points, shadow rays, coordinates).
+        vec1 = vec1[:, np.newaxis, :]
+        vec2 = vec2[:, np.newaxis, :]
+        half_r = self.radius / 2.0
+        top_left = self.position - (half_r * vec1) - (half_r * vec2)
+
+        if sampling != SHADOW_SAMPLING_RANDOM:
+            # The tables' samples are in the unit square, so they only need to be mapped onto
+            # the light's square, in the plane perpendicular to the point's direction.
+            offsets = self.sample_tables.lookup(
+                sampling, root_number_shadow_rays, sample_indices
+            )
+            light_sources = (
+                top_left
+                + offsets[:, :, 0:1] * self.radius * vec1
+                + offsets[:, :, 1:2] * self.radius * vec2
+            )
+        else:
+            row_indices, col_indices = grid_cell_indices(root_number_shadow_rays)
+            row_indices = row_indices[np.newaxis, :, np.newaxis]
+            col_indices = col_indices[np.newaxis, :, np.newaxis]
+
+            grid_square_length = self.radius / root_number_shadow_rays
+            corners1 = (
+                top_left
+                + row_indices * grid_square_length * vec1
+                + col_indices * grid_square_length * vec2
+            )
+            corners2 = corners1 + grid_square_length * vec1 + grid_square_length * vec2
+
+            min_coords = np.minimum(corners1, corners2)
+            max_coords = np.maximum(corners1, corners2)
+            light_sources = (np.random if rng is None else rng).uniform(
+                min_coords, max_coords
+            )
 
         number_shadow_rays = root_number_shadow_rays * root_number_shadow_rays
-        vec1_repeated = np.repeat(vec1[np.newaxis, :], number_shadow_rays, axis=0)
-        vec2_repeated = np.repeat(vec2[np.newaxis, :], number_shadow_rays, axis=0)
+        if not adaptive:
+            clear = self._trace_shadow_rays(
+                light_sources, points, surfaces, transparent_shadows
+            )
+            light_hit_cnt = clear.sum(axis=1)
+            sample_counts = np.full(len(points), number_shadow_rays)
+        else:
+            initial_cells = Light._initial_adaptive_cells(root_number_shadow_rays)
+            other_cells = np.setdiff1d(np.arange(number_shadow_rays), initial_cells)
+            clear = self._trace_shadow_rays(
+                light_sources[:, initial_cells], points, surfaces, transparent_shadows
+            )
+            light_hit_cnt = clear.sum(axis=1) * (number_shadow_rays / len(clear[0]))
+            sample_counts = np.full(len(points), len(initial_cells))
 
-        half_r = self.radius / 2.0
-        top_left = self.position - (half_r * vec1) - (half_r * vec2)
-        grid_square_length = self.radius / root_number_shadow_rays
-        corners1 = (
-            top_left
-            + row_indices * grid_square_length * vec1_repeated
-            + col_indices * grid_square_length * vec2_repeated
+            penumbra = np.flatnonzero(np.any(clear != clear[:, :1], axis=1))
+            if len(penumbra) > 0 and len(other_cells) > 0:
+                other_clear = self._trace_shadow_rays(
+                    light_sources[penumbra][:, other_cells],
+                    points[penumbra],
+                    surfaces,
+                    transparent_shadows,
+                )
+                light_hit_cnt[penumbra] = clear[penumbra].sum(axis=1) + other_clear.sum(
+                    axis=1
+                )
+                sample_counts[penumbra] = number_shadow_rays
+
+        intensities = (1 - self.shadow_intensity) + self.shadow_intensity * (
+            light_hit_cnt / number_shadow_rays
+        )
+        return intensities, sample_counts
+
+    def _trace_shadow_rays(
+        self,
+        light_sources: np.ndarray,
+        points: np.ndarray,
+        surfaces: List[Surface],
+        transparent_shadows: bool = False,
+    ) -> np.ndarray:
+        """
+        Receive a (P, K, 3) array of K light source samples for each of P points, and return
+        a (P, K) boolean array of whether the path from each sample to its point is clear,
+        or with transparent_shadows, a (P, K) array of the fraction of light passing along it.
+        With occluders, the paths of every cluster of nearby points are only intersected with
+        the cluster's candidate occluders.
+        """
+        number_samples = light_sources.shape[1]
+        trace = (
+            Light.path_transmittances
+            if transparent_shadows
+            else Light.is_path_clear_many
         )
-        corners2 = (
-            corners1
-            + grid_square_length * vec1_repeated
-            + grid_square_length * vec2_repeated
+        if self.occluders is None:
+            clusters = [(slice(None), None)]
+        else:
+            clusters = self.occluders.clusters(points)
+        clear = np.empty(
+            (len(points), number_samples),
+            dtype=np.float64 if transparent_shadows else bool,
         )
+        for cluster, groups in clusters:
+            clear[cluster] = trace(
+                light_sources[cluster].reshape(-1, 3),
+                np.repeat(points[cluster], number_samples, axis=0),
+                surfaces,
+                groups,
+            ).reshape(-1, number_samples)
+        return clear
 
-        min_coords = np.minimum(corners1, corners2)
-        max_coords = np.maximum(corners1, corners2)
-        light_sources = np.random.uniform(min_coords, max_coords)
-        light_hit_cnt = sum(
-            Light.is_path_clear(light_source, point, surfaces)
-            for light_source in light_sources
+    @staticmethod
+    def _initial_adaptive_cells(root_number_shadow_rays: int) -> np.ndarray:
+        """
+        Return the indices of the grid cells sampled first by the adaptive soft shadows:
+        an evenly spread sub-grid of about ADAPTIVE_SHADOW_INITIAL_FRACTION of the cells,
+        which includes the corner cells of the full grid, and its center cell. So a 3x3 or 4x4
+        grid starts with 5 cells, and an 8x8 one with 17.
+        """
+        root_initial = max(
+            2,
+            int(
+                round(
+                    root_number_shadow_rays * np.sqrt(ADAPTIVE_SHADOW_INITIAL_FRACTION)
+                )
+            ),
+        )
+        picked = np.unique(
+            np.round(
+                np.linspace(
+                    0,
+                    root_number_shadow_rays - 1,
+                    min(root_initial, root_number_shadow_rays),
+                )
+            ).astype(np.int64)
         )
-        return (1 - self.shadow_intensity) + self.shadow_intensity * (
-            light_hit_cnt / (root_number_shadow_rays**2)
+        center = root_number_shadow_rays // 2
+        return np.union1d(
+            (picked[:, np.newaxis] * root_number_shadow_rays + picked).ravel(),
+            center * root_number_shadow_rays + center,
         )
 
+    @stats.timed("shading")
     def calculate_phong_specularity(
         self,
         point: np.ndarray,
@@ -105,6 +353,11 @@ class Light:
         surface: Surface,
         surfaces: List[Surface],
         root_number_shadow_rays: int,
+        adaptive_shadows: bool = False,
+        shadow_sampling: str = SHADOW_SAMPLING_RANDOM,
+        sample_index: int = 0,
+        transparent_shadows: bool = False,
+        normal: Optional[np.ndarray] = None,
     ) -> np.ndarray:
         """
         Calculate the phong specularity color at the given point, assuming that it's on a surface.
@@ -115,13 +368,28 @@ class Light:
         :param surface: The surface the point is on.
         :param surfaces: The list of all surfaces in the scene.
         :param root_number_shadow_rays: The root of the number of shadow rays to cast.
+        :param adaptive_shadows: Whether to sample the soft shadows adaptively.
+        :param shadow_sampling: The soft shadows' sampling mode, see calculate_intensity_many.
+        :param sample_index: The index of the sample table to use, usually the pixel's index.
+        :param transparent_shadows: Whether shadows are attenuated by transparent surfaces.
+        :param normal: The surface's normal at the point, if it's known already (see
+        HitRecord), so it isn't calculated again.
         """
         l = Ray.ray_between_points(point, self.position)
-        normal = surface.normal_at_point(point, -l.direction)
-        reflected_ray = surface.reflection_ray(-l, point)
+        if normal is None:
+            normal = surface.normal_at_point(point, -l.direction)
+        else:
+            normal = surface.orient_normal(normal, -l.direction)
+        reflected_ray = surface.reflection_ray(-l, point, normal)
 
         light_intensity = self.calculate_intensity(
-            surfaces, root_number_shadow_rays, point
+            surfaces,
+            root_number_shadow_rays,
+            point,
+            adaptive=adaptive_shadows,
+            sampling=shadow_sampling,
+            sample_index=sample_index,
+            transparent_shadows=transparent_shadows,
         )
         diffuse = surface.material.diffuse_color * (normal @ l.direction)
         specular = (
@@ -130,3 +398,100 @@ class Light:
             * (v.direction @ reflected_ray.direction) ** surface.material.shininess
         )
         return (diffuse + specular) * self.color * light_intensity
+
+    @stats.timed("shading")
+    def calculate_phong_specularity_many(
+        self,
+        points: np.ndarray,
+        view_directions: np.ndarray,
+        surface_indices: np.ndarray,
+        surfaces: List[Surface],
+        root_number_shadow_rays: int,
+        diffuse_colors: np.ndarray,
+        specular_colors: np.ndarray,
+        shininess: np.ndarray,
+        rng: Optional[np.random.Generator] = None,
+        adaptive_shadows: bool = False,
+        shadow_sample_counts: Optional[np.ndarray] = None,
+        shadow_sampling: str = SHADOW_SAMPLING_RANDOM,
+        sample_indices: Optional[np.ndarray] = None,
+        transparent_shadows: bool = False,
+        faces: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """
+        The batched version of calculate_phong_specularity.
+
+        :param points: An (N, 3) array of the points to calculate the colors of.
+        :param view_directions: An (N, 3) array of the directions towards the viewer.
+        :param surface_indices: An (N,) array of the indices of the surfaces the points are on.
+        :param surfaces: The list of all surfaces in the scene.
+        :param root_number_shadow_rays: The root of the number of shadow rays to cast.
+        :param diffuse_colors: An (N, 3) array of the diffuse colors of the points' materials.
+        :param specular_colors: An (N, 3) array of the specular colors of the points' materials.
+        :param shininess: An (N,) array of the phong coefficients of the points' materials.
+        :param rng: An optional random generator to draw the soft shadows' samples from.
+        :param adaptive_shadows: Whether to sample the soft shadows adaptively.
+        :param shadow_sample_counts: An optional (N,) array, to which the number of shadow rays
+        cast for every point is added.
+        :param shadow_sampling: The soft shadows' sampling mode, see calculate_intensity_many.
+        :param sample_indices: An optional (N,) array of the indices of the sample tables to
+        use for every point, usually the indices of the pixels they're shaded for.
+        :param transparent_shadows: Whether shadows are attenuated by transparent surfaces.
+        :param faces: An optional (N,) array of the faces of the hits at the points, which
+        the normals there are found from, see base_surface.hit_faces.
+        """
+        unshadowed, _ = self.unshadowed_phong_many(
+            points,
+            view_directions,
+            surface_indices,
+            surfaces,
+            diffuse_colors,
+            specular_colors,
+            shininess,
+            faces,
+        )
+        light_intensity = self.calculate_intensity_many(
+            surfaces,
+            root_number_shadow_rays,
+            points,
+            rng,
+            adaptive_shadows,
+            shadow_sample_counts,
+            shadow_sampling,
+            sample_indices,
+            transparent_shadows,
+        )
+        return unshadowed * light_intensity[:, np.newaxis]
+
+    def unshadowed_phong_many(
+        self,
+        points: np.ndarray,
+        view_directions: np.ndarray,
+        surface_indices: np.ndarray,
+        surfaces: List[Surface],
+        diffuse_colors: np.ndarray,
+        specular_colors: np.ndarray,
+        shininess: np.ndarray,
+        faces: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return the (N, 3) phong colors of calculate_phong_specularity_many before they're
+        scaled by the light's intensity (so without casting any shadow rays), and the (N,)
+        cosines of the angles between the surfaces' normals and the directions to the light,
+        which are negative where the light is behind the surface.
+        """
+        l_directions = vector.normalize_rows(self.position - points)
+        normals = normals_at_points(
+            surfaces, surface_indices, points, -l_directions, faces
+        )
+        reflected_directions = reflection_directions(-l_directions, normals)
+        cosines = vector.dot_rows(normals, l_directions)
+        diffuse = diffuse_colors * cosines[:, np.newaxis]
+        specular = (
+            specular_colors
+            * self.specular_intensity
+            * (vector.dot_rows(view_directions, reflected_directions) ** shininess)[
+                :, np.newaxis
+            ]
+        )
+        return (diffuse + specular) * self.color, cosines
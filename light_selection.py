@@ -0,0 +1,166 @@
+from typing import List, Optional
+
+import numpy as np
+
+import stats
+from base_surface import SurfaceGroups
+from consts import COLOR_SCALE, LIGHT_SELECTION_BATCH_SIZE
+from light import Light
+from material import MaterialArrays
+from scene import SceneSettings
+
+
+def select_lights(
+    bounds: np.ndarray,
+    candidates: np.ndarray,
+    light_samples: int,
+    rng: Optional[np.random.Generator] = None,
+) -> np.ndarray:
+    """
+    Pick light_samples of the candidate lights of every point at random, with replacement,
+    with probabilities proportional to the bounds of their contributions, and return an
+    (L, N) array of the weights of the lights' colors at the points: the number of times
+    each light was picked divided by light_samples times its probability, so the weighted
+    sum of the picked lights' colors is an unbiased estimate of the sum of all of them.
+    Points with at most light_samples candidates keep all of them, with a weight of 1.
+    :param bounds: An (L, N) array of the bounds of the lights' contributions to the points.
+    :param candidates: An (L, N) boolean array of the lights that may light every point.
+    """
+    weights = candidates.astype(np.float64)
+    sampled = np.flatnonzero(candidates.sum(axis=0) > light_samples)
+    if len(sampled) == 0:
+        return weights
+
+    probabilities = np.where(candidates[:, sampled], bounds[:, sampled], 0.0)
+    totals = probabilities.sum(axis=0)
+    # Candidates whose bounds are all 0 contribute nothing, so any of them can be picked.
+    probabilities[:, totals == 0] = candidates[:, sampled[totals == 0]]
+    probabilities /= probabilities.sum(axis=0)
+    cdf = np.cumsum(probabilities, axis=0)
+    # Scaled by the last cumulative probability, which rounding can leave just below 1, so
+    # lights without any probability are never picked.
+    picks = (np.random if rng is None else rng).random(
+        (len(sampled), light_samples)
+    ) * cdf[-1][:, np.newaxis]
+    picked_lights = (cdf.T[:, np.newaxis, :] <= picks[:, :, np.newaxis]).sum(axis=2)
+
+    counts = np.zeros((len(bounds), len(sampled)))
+    np.add.at(
+        counts,
+        (picked_lights.ravel(), np.repeat(np.arange(len(sampled)), light_samples)),
+        1,
+    )
+    weights[:, sampled] = np.divide(
+        counts,
+        light_samples * probabilities,
+        out=np.zeros_like(counts),
+        where=counts > 0,
+    )
+    return weights
+
+
+def shade_selected_lights(
+    points: np.ndarray,
+    directions: np.ndarray,
+    surface_indices: np.ndarray,
+    surfaces: SurfaceGroups,
+    lights: List[Light],
+    scene_settings: SceneSettings,
+    materials: MaterialArrays,
+    contributions: np.ndarray,
+    rng: Optional[np.random.Generator] = None,
+    shadow_sample_counts: Optional[np.ndarray] = None,
+    pixel_indices: Optional[np.ndarray] = None,
+    faces: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Like colors.calculate_phong_specularity_many, but only cast shadow rays towards the
+    lights that matter at every point. The lights' colors are first calculated without
+    shadows, which is cheap, and then:
+    With scene_settings.light_culling, lights that add nothing to the points' colors even
+    unshadowed are skipped, and lights whose contribution to the points' pixels is below
+    light_cull_threshold color levels get the middle of their shadow range as their
+    intensity, without shadow rays. A light behind a surface can still add specular (and on
+    spheres, negative diffuse) color, so it's only culled by its bound like any other, and
+    a threshold of 0 doesn't change the image.
+    With scene_settings.light_samples, only that many of the remaining lights are shaded at
+    every point, picked at random by their contributions, see select_lights.
+    :param contributions: An (N, 3) array of the weights of the points' colors in their
+    pixels.
+    For the other parameters, see colors.calculate_phong_specularity_many.
+    """
+    if pixel_indices is None:
+        pixel_indices = np.arange(len(points))
+    color = np.zeros_like(points)
+    # Without lights, there's nothing to select, and the points are only lit by the ambient
+    # light, like with calculate_phong_specularity_many.
+    if not lights:
+        return color
+    points_per_batch = max(1, LIGHT_SELECTION_BATCH_SIZE // len(lights))
+    for start in range(0, len(points), points_per_batch):
+        batch = slice(start, start + points_per_batch)
+        batch_color = color[batch]
+        batch_indices = surface_indices[batch]
+        material_ids = surfaces.material_ids[batch_indices]
+        unshadowed, _ = zip(
+            *(
+                light.unshadowed_phong_many(
+                    points[batch],
+                    -directions[batch],
+                    batch_indices,
+                    surfaces,
+                    materials.diffuse_colors[material_ids],
+                    materials.specular_colors[material_ids],
+                    materials.shininess[material_ids],
+                    None if faces is None else faces[batch],
+                )
+                for light in lights
+            )
+        )
+        unshadowed = np.stack(unshadowed)
+        bounds = np.abs(unshadowed * contributions[batch]).max(axis=2) * COLOR_SCALE
+        candidates = np.ones(bounds.shape, dtype=bool)
+
+        if scene_settings.light_culling:
+            unlit = bounds == 0
+            negligible = ~unlit & (bounds < scene_settings.light_cull_threshold)
+            stats.count("lights.unlit", int(unlit.sum()))
+            stats.count("lights.negligible", int(negligible.sum()))
+            for index, light in enumerate(lights):
+                batch_color[negligible[index]] += unshadowed[index][
+                    negligible[index]
+                ] * (1 - light.shadow_intensity / 2)
+            candidates &= ~unlit & ~negligible
+
+        if scene_settings.light_samples > 0:
+            weights = select_lights(
+                bounds, candidates, scene_settings.light_samples, rng
+            )
+        else:
+            weights = candidates.astype(np.float64)
+
+        for index, light in enumerate(lights):
+            shaded = np.flatnonzero(weights[index] > 0)
+            if len(shaded) == 0:
+                continue
+            stats.count("lights.shadowed", len(shaded))
+            shaded_points = start + shaded
+            sample_counts = np.zeros(len(shaded))
+            intensities = light.calculate_intensity_many(
+                surfaces,
+                scene_settings.root_number_shadow_rays,
+                points[shaded_points],
+                rng,
+                scene_settings.adaptive_shadows,
+                sample_counts,
+                scene_settings.shadow_sampling,
+                pixel_indices[shaded_points],
+                scene_settings.transparent_shadows,
+            )
+            color[shaded_points] += (
+                unshadowed[index][shaded]
+                * (intensities * weights[index][shaded])[:, np.newaxis]
+            )
+            if shadow_sample_counts is not None:
+                shadow_sample_counts[shaded_points] += sample_counts
+    return color
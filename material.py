@@ -4,6 +4,14 @@ import numpy as np
 
 
 class Material:
+    __slots__ = (
+        "diffuse_color",
+        "specular_color",
+        "reflection_color",
+        "shininess",
+        "transparency",
+    )
+
     def __init__(
         self,
         diffuse_color: List[float],
@@ -12,9 +20,10 @@ class Material:
         shininess: float,
         transparency: float,
     ):
-        self.diffuse_color = np.array(diffuse_color)
-        self.specular_color = np.array(specular_color)
-        self.reflection_color = np.array(reflection_color)
+        # Rows of float64 arrays are kept as views, see scene_cache.CompiledScene.
+        self.diffuse_color = np.asarray(diffuse_color, dtype=np.float64)
+        self.specular_color = np.asarray(specular_color, dtype=np.float64)
+        self.reflection_color = np.asarray(reflection_color, dtype=np.float64)
         self.shininess = shininess
         self.transparency = transparency
 
@@ -24,3 +33,63 @@ class Material:
         A material is considered reflective, if its reflection color isn't black.
         """
         return np.any(self.reflection_color != 0.0)
+
+
+class MaterialArrays:
+    """
+    The properties of a list of materials, stacked into arrays so that they can be looked up
+    for many rays at once, by the index of each ray's material in the list.
+    """
+
+    def __init__(self, materials: List[Material]):
+        self.diffuse_colors = np.array([m.diffuse_color for m in materials]).reshape(
+            -1, 3
+        )
+        self.specular_colors = np.array([m.specular_color for m in materials]).reshape(
+            -1, 3
+        )
+        self.reflection_colors = np.array(
+            [m.reflection_color for m in materials]
+        ).reshape(-1, 3)
+        self.shininess = np.array([m.shininess for m in materials], dtype=np.float64)
+        self.transparency = np.array(
+            [m.transparency for m in materials], dtype=np.float64
+        )
+        self.reflective = np.any(self.reflection_colors != 0.0, axis=1)
+
+    @classmethod
+    def from_arrays(
+        cls,
+        diffuse_colors: np.ndarray,
+        specular_colors: np.ndarray,
+        reflection_colors: np.ndarray,
+        shininess: np.ndarray,
+        transparency: np.ndarray,
+    ) -> "MaterialArrays":
+        """
+        Return the MaterialArrays of the materials with the given stacked properties, like the
+        tables of a compiled scene, which are kept as they are, without a Material per row.
+        """
+        material_arrays = cls([])
+        material_arrays.diffuse_colors = diffuse_colors
+        material_arrays.specular_colors = specular_colors
+        material_arrays.reflection_colors = reflection_colors
+        material_arrays.shininess = shininess
+        material_arrays.transparency = transparency
+        material_arrays.reflective = np.any(reflection_colors != 0.0, axis=1)
+        return material_arrays
+
+    def unstack(self) -> List[Material]:
+        """
+        Return the materials, one per row.
+        """
+        return [
+            Material(*properties)
+            for properties in zip(
+                self.diffuse_colors,
+                self.specular_colors,
+                self.reflection_colors,
+                self.shininess.tolist(),
+                self.transparency.tolist(),
+            )
+        ]
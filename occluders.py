@@ -0,0 +1,121 @@
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+import stats
+from base_surface import SurfaceGroups
+from consts import EPSILON, OCCLUDER_CLUSTER_SIZE
+from light import Light
+
+
+class LightOccluders:
+    """
+    The candidate occluders of a light's shadow rays, so that every shadow ray is only
+    intersected with the surfaces that may lie between the light and its point, instead of
+    with all of them.
+    All of the light's samples are within a ball around its position, and the shadow rays of
+    a cluster of nearby points end within a ball around their center, so every segment of the
+    cluster lies within the capsule around the segment between the balls' centers, whose radius
+    is the larger of theirs. Only the surfaces that may intersect this capsule are candidates,
+    and their list is shared by all the shadow rays of the cluster's points. The surfaces'
+    bounding boxes are computed once per light, and reused by all its clusters.
+    The lists replace the BVH, which already skips the distant surfaces and is faster with
+    many surfaces, so they're meant for the scenes that are traced without one.
+    :param surfaces: The surfaces of the scene.
+    :param light: The light whose shadow rays are traced.
+    """
+
+    def __init__(self, surfaces: SurfaceGroups, light: Light):
+        self.position = light.position
+        # The light's samples are on a square of side radius, centered at its position.
+        self.extent = light.radius * np.sqrt(0.5)
+        self.groups = [
+            (
+                surface_type,
+                group_indices,
+                parameters,
+                surface_type.stacked_bounding_boxes(parameters),
+            )
+            for surface_type, group_indices, parameters in surfaces.groups
+        ]
+
+    def clusters(
+        self, points: np.ndarray
+    ) -> Iterator[
+        Tuple[np.ndarray, List[Tuple[type, np.ndarray, Tuple[np.ndarray, ...]]]]
+    ]:
+        """
+        Split the given (N, 3) array of points, the shadow rays' end points, into clusters of
+        nearby points (see cluster_points), and yield the indices of every cluster's points
+        with the groups of its candidate occluders, in the format of SurfaceGroups.groups.
+        """
+        for cluster in cluster_points(points, OCCLUDER_CLUSTER_SIZE):
+            center = points[cluster].mean(axis=0)
+            radius = (
+                max(self.extent, np.linalg.norm(points[cluster] - center, axis=1).max())
+                + EPSILON
+            )
+            groups = []
+            for surface_type, group_indices, parameters, bounding_boxes in self.groups:
+                if bounding_boxes is None:
+                    near = surface_type.stacked_near_segment(
+                        parameters, self.position, center, radius
+                    )
+                else:
+                    near = boxes_near_segment(
+                        *bounding_boxes, self.position, center, radius
+                    )
+                candidates = np.flatnonzero(near)
+                stats.count("occluders.candidates", len(candidates))
+                stats.count("occluders.culled", len(near) - len(candidates))
+                if len(candidates) > 0:
+                    groups.append(
+                        (
+                            surface_type,
+                            group_indices[candidates],
+                            tuple(parameter[candidates] for parameter in parameters),
+                        )
+                    )
+            yield cluster, groups
+
+
+def cluster_points(points: np.ndarray, size: int) -> List[np.ndarray]:
+    """
+    Split the given (N, 3) array of points into clusters of at most size nearby points, by
+    halving them along the axis they're spread the most on, recursively, and return the
+    arrays of the indices of the clusters' points.
+    """
+    clusters = []
+    stack = [np.arange(len(points))]
+    while stack:
+        indices = stack.pop()
+        if len(indices) <= size:
+            clusters.append(indices)
+            continue
+        axis = np.argmax(np.ptp(points[indices], axis=0))
+        half = len(indices) // 2
+        order = np.argpartition(points[indices, axis], half)
+        stack.append(indices[order[half:]])
+        stack.append(indices[order[:half]])
+    return clusters
+
+
+def boxes_near_segment(
+    lows: np.ndarray,
+    highs: np.ndarray,
+    start: np.ndarray,
+    end: np.ndarray,
+    radius: float,
+) -> np.ndarray:
+    """
+    Return an (S,) boolean array of whether the boxes with the given (S, 3) minimal and
+    maximal corners may come within radius of the segment from start to end. The test is
+    conservative: it's whether the segment intersects the boxes grown by radius on every side.
+    """
+    direction = end - start
+    inverse_direction = 1.0 / np.where(direction == 0, 1e-300, direction)
+    t1 = (lows - radius - start) * inverse_direction
+    t2 = (highs + radius - start) * inverse_direction
+    t_enter = np.minimum(t1, t2).max(axis=1)
+    t_exit = np.maximum(t1, t2).min(axis=1)
+    return (t_enter <= t_exit) & (t_exit >= 0) & (t_enter <= 1)
@@ -1,6 +1,10 @@
 import sys
+import time
 from typing import IO, Any, Iterator, Optional, Sized, cast
 
+# The minimal number of seconds between two updates of a progress bar.
+PROGRESS_INTERVAL = 0.1
+
 
 def progressbar(
     it: Iterator[Any],
@@ -8,8 +12,14 @@ def progressbar(
     count: Optional[int] = None,
     prefix: Optional[str] = "",
     size: int = 60,
-    out: IO = sys.stdout,
+    out: Optional[IO] = None,
+    interval: float = PROGRESS_INTERVAL,
 ):
+    """
+    Yield the items of the iterator, while showing a progress bar of them on out (the current
+    sys.stdout by default). The bar is redrawn at most once per interval seconds, and when
+    the iteration ends, rather than after every item.
+    """
     if count is None:
         if isinstance(it, Sized):
             count = len(it)
@@ -17,9 +27,12 @@ def progressbar(
             raise ValueError(
                 "The iterator should have the len function implemented if count=0"
             )
+    if out is None:
+        out = sys.stdout
 
     def show_progress(j: int):
-        x = int(size * j / cast(int, count))
+        # An empty iterator is complete from the start.
+        x = int(size * j / cast(int, count)) if count else size
         print(
             f"{prefix}[{'#' * x}{'.' * (size - x)}] {j}/{count}",
             end="\r",
@@ -28,7 +41,13 @@ def progressbar(
         )
 
     show_progress(0)
+    next_update = time.monotonic() + interval
+    i = -1
     for i, item in enumerate(it):
         yield item
-        show_progress(i + 1)
+        now = time.monotonic()
+        if now >= next_update:
+            show_progress(i + 1)
+            next_update = now + interval
+    show_progress(i + 1)
     print("\n", flush=True, file=out)
@@ -0,0 +1,106 @@
+from typing import Iterator, Tuple
+
+import numpy as np
+
+from consts import COLOR_CHANNELS, COLOR_SCALE, PROGRESSIVE_INITIAL_STRIDE
+
+
+class ProgressivePass:
+    """
+    A pass of a progressive render.
+    The first passes are coarse: they render a single hard shadow ray per pixel, for every
+    stride-th pixel of every stride-th row, starting at PROGRESSIVE_INITIAL_STRIDE and halving
+    the stride (skipping the pixels of the previous passes) until every pixel is rendered.
+    They only serve as a preview. The passes that follow render every pixel with the scene's
+    shadow rays, with new samples every pass, and their colors are averaged.
+    """
+
+    def __init__(self, index: int, stride: int):
+        self.index = index
+        self.stride = stride
+
+    @property
+    def coarse(self) -> bool:
+        return self.stride > 0
+
+    def pixels(self, height: int, width: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return the arrays of the rows and columns of the pixels the pass renders, in scanline
+        order.
+        """
+        rows, cols = np.divmod(np.arange(height * width), width)
+        if not self.coarse:
+            return rows, cols
+        selected = (rows % self.stride == 0) & (cols % self.stride == 0)
+        if self.stride < PROGRESSIVE_INITIAL_STRIDE:
+            # The pixels on the coarser grid were rendered by the previous passes.
+            coarser = 2 * self.stride
+            selected &= (rows % coarser != 0) | (cols % coarser != 0)
+        return rows[selected], cols[selected]
+
+
+def progressive_passes() -> Iterator[ProgressivePass]:
+    """
+    Yield the passes of a progressive render, without end: the coarse passes, and then the
+    passes over all the pixels (with a stride of 0).
+    """
+    stride = PROGRESSIVE_INITIAL_STRIDE
+    index = 0
+    while stride >= 1:
+        yield ProgressivePass(index, stride)
+        index += 1
+        stride //= 2
+    while True:
+        yield ProgressivePass(index, 0)
+        index += 1
+
+
+class ProgressiveImage:
+    """
+    The colors a progressive render accumulated so far: the coarse passes' colors, and the
+    running sums and counts of the full passes' colors of every pixel.
+    The colors are accumulated unclipped, and only clipped when the image is resolved, so
+    that the average of the passes converges to the colors of a render with more samples.
+    """
+
+    def __init__(self, height: int, width: int):
+        self.preview = np.zeros((height, width, COLOR_CHANNELS))
+        self.previewed = np.zeros((height, width), dtype=bool)
+        self.sums = np.zeros((height, width, COLOR_CHANNELS))
+        self.counts = np.zeros((height, width), dtype=np.int64)
+
+    def add(
+        self,
+        progressive_pass: ProgressivePass,
+        rows: np.ndarray,
+        cols: np.ndarray,
+        colors: np.ndarray,
+    ) -> None:
+        if progressive_pass.coarse:
+            self.preview[rows, cols] = colors
+            self.previewed[rows, cols] = True
+        else:
+            self.sums[rows, cols] += colors
+            self.counts[rows, cols] += 1
+
+    def resolve(self, img_mat: np.ndarray) -> None:
+        """
+        Write the current image into img_mat: the average of the full passes where there
+        are any, and otherwise the closest previewed pixel above and to the left of every
+        pixel, on the finest grid of the coarse passes that has one.
+        """
+        height, width = self.counts.shape
+        rows, cols = np.indices((height, width))
+        image = np.zeros((height, width, COLOR_CHANNELS))
+        resolved = np.zeros((height, width), dtype=bool)
+        stride = 1
+        while stride <= PROGRESSIVE_INITIAL_STRIDE:
+            source_rows = rows // stride * stride
+            source_cols = cols // stride * stride
+            found = ~resolved & self.previewed[source_rows, source_cols]
+            image[found] = self.preview[source_rows[found], source_cols[found]]
+            resolved |= found
+            stride *= 2
+        sampled = self.counts > 0
+        image[sampled] = self.sums[sampled] / self.counts[sampled, np.newaxis]
+        img_mat[:] = np.clip(image, 0, COLOR_SCALE)
@@ -2,6 +2,8 @@ import numpy as np
 
 
 class Ray:
+    __slots__ = ("source", "direction")
+
     def __init__(self, source: np.ndarray, direction: np.ndarray):
         self.source = source
         self.direction = direction
@@ -1,18 +1,55 @@
 import argparse
+import copy
 import itertools
-from typing import List
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple, Union
 
 import numpy as np
 from PIL import Image
 
-from base_surface import Surface
+import stats
+import vector
+from animation import frame_path, parse_camera_path
+from antialiasing import edge_scores, select_pixels, stratified_pixel_offsets
+from base_surface import Surface, SurfaceGroups, as_surface_groups
+from bvh import BVH
 from camera import Camera
-from colors import calculate_color
-from consts import COLOR_CHANNELS, COLOR_SCALE
+from checkpoint import RenderCheckpoint, checkpoint_key
+from colors import RayTreeStatistics, calculate_color, calculate_colors
+from consts import (
+    ANTIALIAS_BUDGET,
+    ANTIALIAS_ROOT_SAMPLES,
+    ANTIALIAS_THRESHOLD,
+    BVH_MIN_PRIMITIVES,
+    COLOR_CHANNELS,
+    COLOR_SCALE,
+    LIGHT_CULL_THRESHOLD,
+    PROGRESSIVE_BATCH_SIZE,
+    RAY_BATCH_SIZE,
+    TILE_SIZE,
+)
+from frustum import get_closest_surfaces_in_packets, pixel_packets
+from gbuffer import GBuffer, load_or_compute_gbuffer
+from image_writers import ImageWriter, open_image_writer
 from light import Light
+from occluders import LightOccluders
 from progressbar import progressbar
+from progressive import ProgressiveImage, ProgressivePass, progressive_passes
 from ray import Ray
+from sampling import SHADOW_SAMPLING_MODES, SHADOW_SAMPLING_RANDOM
 from scene import SceneSettings, parse_scene_file
+from scene_cache import load_compiled_scene, load_scene
+from tiles import (
+    Tile,
+    morton_order,
+    render_tiles,
+    split_into_tiles,
+    stream_frames,
+    stream_tiles,
+)
 
 
 class RayTracer:
@@ -20,13 +57,43 @@ class RayTracer:
         self,
         camera: Camera,
         scene_settings: SceneSettings,
-        surfaces: List[Surface],
+        surfaces: Union[List[Surface], SurfaceGroups],
         lights: List[Light],
+        use_bvh: bool = True,
+        frustum_culling: bool = False,
+        occluder_lists: bool = False,
     ):
-        self.camera = camera
         self.scene_settings = scene_settings
-        self.surfaces = surfaces
+        self.surfaces = as_surface_groups(surfaces)
         self.lights = lights
+        self.ray_tree_statistics = RayTreeStatistics()
+        # Whether the batched renderers cull the surfaces against the frusta of packets of
+        # primary rays, see find_primary_hits.
+        self.frustum_culling = frustum_culling
+
+        bvh = BVH(self.surfaces) if use_bvh else None
+        if bvh is not None and bvh.primitive_count >= BVH_MIN_PRIMITIVES:
+            self.surfaces.bvh = bvh
+        # With occluder lists, the shadow rays of every light are only intersected with the
+        # surfaces that may lie between it and their points, see occluders.LightOccluders.
+        # A BVH already skips the distant surfaces, so they're only used in scenes without one.
+        use_occluders = occluder_lists and self.surfaces.bvh is None
+        for light in self.lights:
+            light.occluders = (
+                LightOccluders(self.surfaces, light) if use_occluders else None
+            )
+        self.set_camera(camera)
+
+    def set_camera(self, camera: Camera) -> None:
+        """
+        Look at the scene through the given camera. Everything that only depends on the
+        scene, like the BVH and the lights' occluder lists, is kept, so rendering it from
+        another camera (like the frames of an animation) doesn't build them again.
+        """
+        self.camera = camera
+        # The primary hits of the pixels of images of gbuffer_shape, see use_gbuffer.
+        self.gbuffer: Optional[GBuffer] = None
+        self.gbuffer_shape: Optional[Tuple[int, int]] = None
 
         self.v = Ray.ray_between_points(self.camera.position, self.camera.look_at)
         self.p_c = self.v.at(self.camera.screen_distance)
@@ -46,6 +113,22 @@ class RayTracer:
         )
         return Ray.ray_between_points(self.camera.position, p)
 
+    def construct_rays_through_pixels(
+        self, height: int, width: int, rows: np.ndarray, cols: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The batched version of construct_ray_through_pixel, receive arrays of pixel rows and
+        columns, and return the (N, 3) arrays of the sources and directions of their rays.
+        """
+        ratio = self.camera.screen_width / width
+        points = (
+            self.p_c
+            + ((cols - width // 2) * ratio)[:, np.newaxis] * self.v_right
+            - ((rows - height // 2) * ratio)[:, np.newaxis] * self.v_up
+        )
+        sources = np.repeat(self.camera.position[np.newaxis, :], len(points), axis=0)
+        return sources, vector.normalize_rows(points - sources)
+
     def ray_trace(self, img_mat: np.ndarray) -> None:
         height, width, _ = img_mat.shape
 
@@ -61,8 +144,441 @@ class RayTracer:
                 self.surfaces,
                 self.lights,
                 self.scene_settings,
+                statistics=self.ray_tree_statistics,
+                pixel_index=i * width + j,
             )
             img_mat[i][j] = np.clip(color, 0, 1) * COLOR_SCALE
+        stats.notify("render")
+
+    def use_gbuffer(
+        self, height: int, width: int, cache_dir: Optional[str] = None
+    ) -> None:
+        """
+        Find the primary hits of all the pixels of an image of the given size up front, and
+        reuse them when rendering it, instead of intersecting the primary rays.
+        With a cache directory, the hits are saved there, keyed by a hash of the camera and
+        the geometry, so later runs that only change the lights or materials load them.
+        The G-buffer is only used by the batched renderers.
+        """
+        self.gbuffer = load_or_compute_gbuffer(self, height, width, cache_dir)
+        self.gbuffer_shape = (height, width)
+
+    def find_primary_hits(
+        self,
+        height: int,
+        width: int,
+        rows: np.ndarray,
+        cols: np.ndarray,
+        sources: np.ndarray,
+        directions: np.ndarray,
+    ) -> GBuffer:
+        """
+        Find the hits of the primary rays through the given pixels (the rows and columns may
+        be fractional, for rays through points at offsets from the pixels' centers), culling
+        the surfaces against the frusta of packets of rays through nearby pixels first,
+        see frustum.pixel_packets.
+        """
+        surface_indices, t = get_closest_surfaces_in_packets(
+            sources,
+            directions,
+            self.surfaces,
+            pixel_packets(self, height, width, rows, cols),
+        )
+        return GBuffer.from_hits(self.surfaces, sources, directions, surface_indices, t)
+
+    def render_pixels(
+        self,
+        height: int,
+        width: int,
+        rows: np.ndarray,
+        cols: np.ndarray,
+        rng: Optional[np.random.Generator] = None,
+        shadow_sample_counts: Optional[np.ndarray] = None,
+        clip: bool = True,
+        sample_offset: Union[int, np.ndarray] = 0,
+        offsets: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """
+        Trace the rays through the given pixels together, and return an (N, COLOR_CHANNELS)
+        array of their values in the range [0, COLOR_SCALE].
+        If shadow_sample_counts is given, the number of shadow rays cast for every pixel is
+        added to it.
+        With clip=False, values brighter than COLOR_SCALE are kept, for HDR output.
+        The sample_offset (a number, or an (N,) array) is added to the pixels' indices when
+        selecting their light sample tables, so that renders of the same pixels with
+        different offsets use different ones.
+        The rays go through the pixels' centers, or if an (N, 2) array of offsets is given,
+        through the points at these (row, column) offsets from them, in pixels.
+        """
+        if offsets is None:
+            ray_rows, ray_cols = rows, cols
+        else:
+            ray_rows, ray_cols = rows + offsets[:, 0], cols + offsets[:, 1]
+        sources, directions = self.construct_rays_through_pixels(
+            height, width, ray_rows, ray_cols
+        )
+        if (
+            self.gbuffer is not None
+            and self.gbuffer_shape == (height, width)
+            and offsets is None
+        ):
+            primary_hits = self.gbuffer.take(rows * width + cols)
+        elif self.frustum_culling:
+            primary_hits = self.find_primary_hits(
+                height, width, ray_rows, ray_cols, sources, directions
+            )
+        else:
+            primary_hits = None
+        colors = calculate_colors(
+            sources,
+            directions,
+            self.surfaces,
+            self.lights,
+            self.scene_settings,
+            rng,
+            self.ray_tree_statistics,
+            shadow_sample_counts,
+            rows * width + cols + sample_offset,
+            primary_hits,
+        )
+        if not clip:
+            return colors * COLOR_SCALE
+        return np.clip(colors, 0, 1) * COLOR_SCALE
+
+    def ray_trace_wavefront(
+        self, img_mat: np.ndarray, shadow_sample_map: Optional[np.ndarray] = None
+    ) -> None:
+        """
+        Render the image like ray_trace, but trace the rays of whole batches of pixels
+        together, instead of one pixel at a time.
+        If a (height, width) shadow_sample_map is given, it's filled with the number of
+        shadow rays cast for every pixel.
+        """
+        height, width, _ = img_mat.shape
+        pixels = img_mat.reshape(height * width, COLOR_CHANNELS)
+        shadow_sample_counts = (
+            None
+            if shadow_sample_map is None
+            else shadow_sample_map.reshape(height * width)
+        )
+
+        for start in progressbar(
+            range(0, height * width, RAY_BATCH_SIZE),
+            prefix="Computing: ",
+        ):
+            rows, cols = np.divmod(
+                np.arange(start, min(start + RAY_BATCH_SIZE, height * width)), width
+            )
+            pixels[start : start + len(rows)] = self.render_pixels(
+                height,
+                width,
+                rows,
+                cols,
+                shadow_sample_counts=(
+                    None
+                    if shadow_sample_counts is None
+                    else shadow_sample_counts[start : start + len(rows)]
+                ),
+            )
+        stats.notify("render")
+
+    def ray_trace_antialiased(
+        self,
+        img_mat: np.ndarray,
+        root_number_samples: int = ANTIALIAS_ROOT_SAMPLES,
+        threshold: float = ANTIALIAS_THRESHOLD,
+        budget: float = ANTIALIAS_BUDGET,
+        seed: int = 0,
+        shadow_sample_map: Optional[np.ndarray] = None,
+    ) -> int:
+        """
+        Render the image with adaptive anti-aliasing: every pixel is first rendered with the
+        ray through its center, and then the pixels on edges, whose color differs from their
+        neighbors' or whose neighbors' primary rays hit another surface (see
+        antialiasing.edge_scores), are rendered again with root_number_samples^2 stratified
+        sub-pixel rays, which replace their first color.
+        The primary hits are found up front with use_gbuffer, if they weren't already.
+        Return the number of refined pixels.
+        :param threshold: The edge score above which pixels are refined.
+        :param budget: The average number of extra rays per pixel to spend at most. If more
+        pixels are above the threshold, the ones with the highest scores are refined.
+        :param seed: The seed of the sub-pixel rays' jitter and of the soft shadows.
+        :param shadow_sample_map: An optional (height, width) array to fill with the number
+        of shadow rays cast for every pixel.
+        """
+        height, width, _ = img_mat.shape
+        if self.gbuffer is None or self.gbuffer_shape != (height, width):
+            self.use_gbuffer(height, width)
+        rng = np.random.default_rng(seed)
+        pixels = img_mat.reshape(height * width, COLOR_CHANNELS)
+        shadow_sample_counts = (
+            np.zeros(height * width)
+            if shadow_sample_map is None
+            else shadow_sample_map.reshape(height * width)
+        )
+        for start in progressbar(
+            range(0, height * width, RAY_BATCH_SIZE), prefix="Computing: "
+        ):
+            rows, cols = np.divmod(
+                np.arange(start, min(start + RAY_BATCH_SIZE, height * width)), width
+            )
+            pixels[start : start + len(rows)] = self.render_pixels(
+                height,
+                width,
+                rows,
+                cols,
+                rng,
+                shadow_sample_counts[start : start + len(rows)],
+            )
+
+        number_samples = root_number_samples * root_number_samples
+        refined = select_pixels(
+            edge_scores(img_mat, self.gbuffer.surface_indices.reshape(height, width)),
+            threshold,
+            int(budget * height * width / number_samples),
+        )
+        if len(refined) == 0:
+            stats.notify("render")
+            return 0
+        pixels_per_batch = max(1, RAY_BATCH_SIZE // number_samples)
+        for start in progressbar(
+            range(0, len(refined), pixels_per_batch), prefix="Refining: "
+        ):
+            batch = refined[start : start + pixels_per_batch]
+            rows, cols = np.divmod(np.repeat(batch, number_samples), width)
+            sample_counts = np.zeros(len(rows))
+            colors = self.render_pixels(
+                height,
+                width,
+                rows,
+                cols,
+                rng,
+                sample_counts,
+                sample_offset=np.tile(np.arange(1, number_samples + 1), len(batch)),
+                offsets=stratified_pixel_offsets(
+                    rng, len(batch), root_number_samples
+                ).reshape(-1, 2),
+            )
+            pixels[batch] = colors.reshape(
+                len(batch), number_samples, COLOR_CHANNELS
+            ).mean(axis=1)
+            shadow_sample_counts[batch] += sample_counts.reshape(
+                len(batch), number_samples
+            ).sum(axis=1)
+        stats.notify("render")
+        return len(refined)
+
+    def ray_trace_progressive(
+        self,
+        img_mat: np.ndarray,
+        time_budget: float,
+        seed: int = 0,
+        on_pass_done: Optional[Callable[[ProgressivePass], None]] = None,
+        max_passes: Optional[int] = None,
+    ) -> int:
+        """
+        Render the image in progressive passes until time_budget seconds pass: coarse
+        passes with a single shadow ray, which refine the resolution until every pixel is
+        rendered, followed by passes over all the pixels whose colors are averaged, see
+        progressive.ProgressivePass. Every pass draws new shadow samples, from its own random
+        generator or sample tables.
+        The pixels are traced in batches of PROGRESSIVE_BATCH_SIZE, and the budget is checked
+        between them, so the render stops within a batch of the deadline. A pass that is cut
+        short contributes the pixels it finished.
+        After every pass, and when the render stops, the current image is written into
+        img_mat, and on_pass_done is called with every finished pass.
+        Return the number of finished passes.
+        """
+        deadline = time.monotonic() + time_budget
+        height, width, _ = img_mat.shape
+        image = ProgressiveImage(height, width)
+        scene_settings = self.scene_settings
+        coarse_settings = copy.copy(scene_settings)
+        coarse_settings.root_number_shadow_rays = 1
+        finished_passes = 0
+        try:
+            for progressive_pass in progressive_passes():
+                if max_passes is not None and finished_passes >= max_passes:
+                    break
+                # With a single shadow ray, the coarse passes already rendered the final
+                # image.
+                if (
+                    not progressive_pass.coarse
+                    and scene_settings.root_number_shadow_rays == 1
+                ):
+                    break
+                self.scene_settings = (
+                    coarse_settings if progressive_pass.coarse else scene_settings
+                )
+                rows, cols = progressive_pass.pixels(height, width)
+                rng = np.random.default_rng((seed, progressive_pass.index))
+                for start in range(0, len(rows), PROGRESSIVE_BATCH_SIZE):
+                    if time.monotonic() >= deadline:
+                        break
+                    batch = slice(start, start + PROGRESSIVE_BATCH_SIZE)
+                    colors = self.render_pixels(
+                        height,
+                        width,
+                        rows[batch],
+                        cols[batch],
+                        rng,
+                        clip=False,
+                        sample_offset=progressive_pass.index,
+                    )
+                    image.add(progressive_pass, rows[batch], cols[batch], colors)
+                else:
+                    finished_passes += 1
+                    image.resolve(img_mat)
+                    if on_pass_done is not None:
+                        on_pass_done(progressive_pass)
+                if time.monotonic() >= deadline:
+                    break
+        finally:
+            self.scene_settings = scene_settings
+        image.resolve(img_mat)
+        stats.notify("render")
+        return finished_passes
+
+    def render_tile(self, img_mat: np.ndarray, tile: Tile, seed: int) -> np.ndarray:
+        """
+        Render a single tile of the image into img_mat with the wavefront renderer, drawing
+        the soft shadows' samples from the tile's own random generator.
+        Return a (tile height, tile width) array of the number of shadow rays cast per pixel.
+        """
+        height, width, _ = img_mat.shape
+        pixels, shadow_sample_counts = self.render_tile_pixels(
+            height, width, tile, seed
+        )
+        img_mat[tile.top : tile.bottom, tile.left : tile.right] = pixels
+        return shadow_sample_counts
+
+    def render_tile_pixels(
+        self, height: int, width: int, tile: Tile, seed: int, clip: bool = True
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Render a single tile of an image of the given size like render_tile, and return
+        a pair of its (tile height, tile width, COLOR_CHANNELS) pixels, and its
+        (tile height, tile width) array of the number of shadow rays cast per pixel.
+        """
+        rows, cols = tile.pixels()
+        shadow_sample_counts = np.zeros(len(rows))
+        pixels = self.render_pixels(
+            height, width, rows, cols, tile.rng(seed), shadow_sample_counts, clip
+        )
+        return (
+            pixels.reshape(*tile.shape, COLOR_CHANNELS),
+            shadow_sample_counts.reshape(tile.shape),
+        )
+
+    def ray_trace_tiles(
+        self,
+        img_mat: np.ndarray,
+        workers: int = 1,
+        seed: int = 0,
+        shadow_sample_map: Optional[np.ndarray] = None,
+        checkpoint: Optional[RenderCheckpoint] = None,
+    ) -> None:
+        """
+        Render the image tile by tile, using the given number of processes.
+        The result only depends on the seed, and not on the number of workers.
+        With a checkpoint, the tiles it has are copied from it instead of being rendered, and
+        the rendered tiles are saved into it as they're done.
+        """
+        height, width, _ = img_mat.shape
+        tiles = morton_order(split_into_tiles(height, width))
+        if checkpoint is None:
+            render_tiles(
+                self,
+                img_mat,
+                tiles,
+                workers,
+                seed,
+                shadow_sample_map=shadow_sample_map,
+            )
+            stats.notify("render")
+            return
+
+        img_mat[:] = checkpoint.image
+        try:
+            render_tiles(
+                self,
+                img_mat,
+                checkpoint.pending(tiles),
+                workers,
+                seed,
+                on_tile_rendered=checkpoint.tile_rendered,
+                shadow_sample_map=checkpoint.shadow_sample_map,
+            )
+        finally:
+            checkpoint.save()
+        if shadow_sample_map is not None:
+            shadow_sample_map[:] = checkpoint.shadow_sample_map
+        stats.notify("render")
+
+    def ray_trace_streaming(
+        self,
+        writer: ImageWriter,
+        workers: int = 1,
+        seed: int = 0,
+        clip: bool = True,
+    ) -> Tuple[float, float]:
+        """
+        Render the image tile by tile like ray_trace_tiles, but write every tile into the
+        writer as soon as it's rendered, instead of into an image in memory, so the memory
+        used doesn't grow with the image's size.
+        Return the mean and the maximal numbers of shadow rays cast per pixel.
+        :param clip: Whether to clip the pixels' values, see render_pixels.
+        """
+        shadow_samples_total = 0.0
+        shadow_samples_max = 0.0
+        for tile, pixels, shadow_sample_counts in stream_tiles(
+            self,
+            writer.height,
+            writer.width,
+            split_into_tiles(writer.height, writer.width),
+            workers,
+            seed,
+            clip,
+        ):
+            writer.write_tile(tile, pixels)
+            shadow_samples_total += shadow_sample_counts.sum()
+            shadow_samples_max = max(shadow_samples_max, shadow_sample_counts.max())
+        stats.notify("render")
+        return (
+            shadow_samples_total / (writer.height * writer.width),
+            shadow_samples_max,
+        )
+
+    def ray_trace_animation(
+        self,
+        cameras: List[Camera],
+        height: int,
+        width: int,
+        output_pattern: str,
+        workers: int = 1,
+        seed: int = 0,
+    ) -> None:
+        """
+        Render a frame of the given size through every one of the given cameras, tile by
+        tile like ray_trace_tiles, and save them to the paths of output_pattern, see
+        animation.frame_path. The scene's BVH is only built once, see tiles.stream_frames.
+        Every frame is encoded and saved by a background thread while the next one renders;
+        at most one frame waits to be saved at a time, so the memory used doesn't grow with
+        the number of frames.
+        """
+        with ThreadPoolExecutor(max_workers=1) as encoder:
+            saving = None
+            for frame, img_mat in stream_frames(
+                self, cameras, height, width, workers, seed
+            ):
+                if saving is not None:
+                    saving.result()
+                saving = encoder.submit(
+                    save_image, img_mat, frame_path(output_pattern, frame)
+                )
+            if saving is not None:
+                saving.result()
+        stats.notify("render")
 
 
 def save_image(image_array: np.ndarray, save_path: str) -> None:
@@ -72,17 +588,449 @@ def save_image(image_array: np.ndarray, save_path: str) -> None:
 
 def main():
     parser = argparse.ArgumentParser(description="Python Ray Tracer")
-    parser.add_argument("scene_file", type=str, help="Path to the scene file")
+    parser.add_argument(
+        "scene_file",
+        type=str,
+        help="Path to the scene file, or to a compiled scene directory",
+    )
     parser.add_argument("output_image", type=str, help="Name of the output image file")
     parser.add_argument("--width", type=int, default=500, help="Image width")
     parser.add_argument("--height", type=int, default=500, help="Image height")
+    parser.add_argument(
+        "--wavefront",
+        action="store_true",
+        help="Trace the rays in NumPy batches instead of one pixel at a time",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Render the image in tiles with the given number of processes",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="The random seed of the soft shadows when rendering in tiles",
+    )
+    parser.add_argument(
+        "--min-ray-weight",
+        type=float,
+        default=0.0,
+        help="Prune secondary rays whose contribution to their pixel is below this weight",
+    )
+    parser.add_argument(
+        "--russian-roulette",
+        action="store_true",
+        help="Keep rays below --min-ray-weight at random instead of always pruning them",
+    )
+    parser.add_argument(
+        "--adaptive-shadows",
+        action="store_true",
+        help="Cast the full grid of shadow rays only where a first subset of them disagree",
+    )
+    parser.add_argument(
+        "--shadow-sampling",
+        choices=SHADOW_SAMPLING_MODES,
+        default=SHADOW_SAMPLING_RANDOM,
+        help="Draw the soft shadows' samples at random, or look them up in precomputed "
+        "stratified or Halton tables",
+    )
+    parser.add_argument(
+        "--transparent-shadows",
+        action="store_true",
+        help="Let shadow rays pass through transparent surfaces, attenuated by their "
+        "transparency, instead of being blocked by them",
+    )
+    parser.add_argument(
+        "--light-culling",
+        action="store_true",
+        help="Skip the lights that add nothing to the shaded points, and don't cast shadow "
+        "rays towards lights that add less than --light-cull-threshold color levels to a "
+        "pixel (not used by the scalar renderer)",
+    )
+    parser.add_argument(
+        "--light-cull-threshold",
+        type=float,
+        default=LIGHT_CULL_THRESHOLD,
+        help="The number of color levels below which --light-culling skips shadow rays",
+    )
+    parser.add_argument(
+        "--light-samples",
+        type=int,
+        default=0,
+        help="Shade only this many lights per point, picked at random by their estimated "
+        "contributions, for scenes with many lights (not used by the scalar renderer)",
+    )
+    parser.add_argument(
+        "--scene-cache",
+        action="store_true",
+        help="Load the scene from its compiled binary cache, compiling it first if the "
+        "cache is missing or older than the scene file",
+    )
+    parser.add_argument(
+        "--gbuffer-cache",
+        type=str,
+        default=None,
+        help="A directory to cache the primary hits in, so they're reused while only the "
+        "lights and materials change (with --wavefront or --workers)",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        default=None,
+        help="A directory to save the finished tiles into as the image renders, so an "
+        "interrupted render can be resumed (renders in tiles, see --workers)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the tiles already in the --checkpoint directory (by default, the output "
+        "image's path with a .checkpoint suffix). A checkpoint of a different scene file "
+        "or different settings is started over",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Write every tile to the output image as soon as it's rendered, instead of "
+        "keeping the whole image in memory (renders in tiles, see --workers). The output "
+        "can be a .png, .npy, .pfm or .raw file",
+    )
+    parser.add_argument(
+        "--hdr",
+        action="store_true",
+        help="With --stream, keep the pixels brighter than white, and store the .npy and "
+        ".raw images as float32 values instead of uint8",
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        default=None,
+        help="Render progressively for this many seconds: coarse passes first, then passes "
+        "that add shadow samples, saving the output image after every pass",
+    )
+    parser.add_argument(
+        "--antialias",
+        action="store_true",
+        help="Render every pixel once, and then again with stratified sub-pixel rays "
+        "where it differs from its neighbors or is on an edge of a surface",
+    )
+    parser.add_argument(
+        "--aa-samples",
+        type=int,
+        default=ANTIALIAS_ROOT_SAMPLES,
+        help="The root of the number of sub-pixel rays of the --antialias pixels",
+    )
+    parser.add_argument(
+        "--aa-threshold",
+        type=float,
+        default=ANTIALIAS_THRESHOLD,
+        help="The fraction of the color range by which a pixel has to differ from a "
+        "neighbor to be refined by --antialias",
+    )
+    parser.add_argument(
+        "--aa-budget",
+        type=float,
+        default=ANTIALIAS_BUDGET,
+        help="The average number of extra rays per pixel --antialias may cast at most",
+    )
+    parser.add_argument(
+        "--camera-path",
+        type=str,
+        default=None,
+        help="Render an animation along the keyframes in this file, one image per frame, "
+        "named after the output image with the frame's number (renders in tiles, see "
+        "--workers)",
+    )
+    parser.add_argument(
+        "--frames",
+        type=int,
+        default=None,
+        help="The number of frames of the --camera-path animation (by default, up to its "
+        "last keyframe)",
+    )
+    parser.add_argument(
+        "--frustum-culling",
+        action="store_true",
+        help="Cull the surfaces against the frusta of small packets of primary rays before "
+        "intersecting them (not used by the scalar renderer)",
+    )
+    parser.add_argument(
+        "--occluder-lists",
+        action="store_true",
+        help="Only intersect the shadow rays of every cluster of nearby points with the "
+        "surfaces that may lie between them and the light, in scenes traced without a BVH",
+    )
+    parser.add_argument(
+        "--no-bvh",
+        action="store_true",
+        help="Test every ray against every surface instead of using a BVH",
+    )
+    parser.add_argument(
+        "--bvh-stats",
+        action="store_true",
+        help="Print the BVH build and traversal statistics after rendering",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Count the rays and intersection tests, and time the rendering's phases",
+    )
+    parser.add_argument(
+        "--stats-json",
+        type=str,
+        default=None,
+        help="Write the --stats statistics to this JSON file instead of printing them",
+    )
     args = parser.parse_args()
+    if args.stream and (args.checkpoint is not None or args.resume):
+        parser.error("--stream can't be combined with --checkpoint or --resume")
+    if args.hdr and not args.stream:
+        parser.error("--hdr requires --stream")
+    if args.time_budget is not None and (
+        args.stream or args.checkpoint is not None or args.resume
+    ):
+        parser.error(
+            "--time-budget can't be combined with --stream, --checkpoint or --resume"
+        )
+    if args.antialias and (
+        args.workers is not None
+        or args.stream
+        or args.checkpoint is not None
+        or args.resume
+        or args.time_budget is not None
+    ):
+        parser.error(
+            "--antialias can't be combined with --workers, --stream, --checkpoint, "
+            "--resume or --time-budget"
+        )
+    if args.camera_path is not None and (
+        args.stream
+        or args.checkpoint is not None
+        or args.resume
+        or args.time_budget is not None
+        or args.antialias
+        or args.gbuffer_cache is not None
+    ):
+        parser.error(
+            "--camera-path can't be combined with --stream, --checkpoint, --resume, "
+            "--time-budget, --antialias or --gbuffer-cache"
+        )
+    if args.frames is not None and args.camera_path is None:
+        parser.error("--frames requires --camera-path")
+
+    if os.path.isdir(args.scene_file):
+        scene = load_compiled_scene(args.scene_file).to_objects()
+    elif args.scene_cache:
+        scene = load_scene(args.scene_file).to_objects()
+    else:
+        scene = parse_scene_file(args.scene_file)
+    camera, scene_settings, surfaces, lights = scene
+    scene_settings.min_ray_weight = args.min_ray_weight
+    scene_settings.russian_roulette = args.russian_roulette
+    scene_settings.adaptive_shadows = args.adaptive_shadows
+    scene_settings.shadow_sampling = args.shadow_sampling
+    scene_settings.transparent_shadows = args.transparent_shadows
+    scene_settings.light_culling = args.light_culling
+    scene_settings.light_cull_threshold = args.light_cull_threshold
+    scene_settings.light_samples = args.light_samples
+    ray_tracer = RayTracer(
+        camera,
+        scene_settings,
+        surfaces,
+        lights,
+        use_bvh=not args.no_bvh,
+        frustum_culling=args.frustum_culling,
+        occluder_lists=args.occluder_lists,
+    )
+    if args.gbuffer_cache is not None:
+        ray_tracer.use_gbuffer(args.height, args.width, args.gbuffer_cache)
+    render_statistics = (
+        stats.enable() if args.stats or args.stats_json is not None else None
+    )
+    if args.camera_path is not None:
+        camera_path = parse_camera_path(args.camera_path, camera)
+        frame_count = camera_path.frame_count if args.frames is None else args.frames
+        start = time.perf_counter()
+        ray_tracer.ray_trace_animation(
+            camera_path.cameras(frame_count),
+            args.height,
+            args.width,
+            args.output_image,
+            1 if args.workers is None else args.workers,
+            args.seed,
+        )
+        render_time = time.perf_counter() - start
+        print(
+            f"Rendered {frame_count} frames in {render_time:.1f}s "
+            f"({render_time / max(1, frame_count):.2f}s per frame)"
+        )
+        print_render_report(args, ray_tracer, render_statistics, render_time, None)
+        return
+
+    if args.stream:
+        try:
+            writer = open_image_writer(
+                args.output_image, args.height, args.width, args.hdr
+            )
+        except ValueError as e:
+            parser.error(str(e))
+        start = time.perf_counter()
+        with writer:
+            shadow_samples_mean, shadow_samples_max = ray_tracer.ray_trace_streaming(
+                writer,
+                1 if args.workers is None else args.workers,
+                args.seed,
+                clip=not args.hdr,
+            )
+        print_render_report(
+            args,
+            ray_tracer,
+            render_statistics,
+            time.perf_counter() - start,
+            (
+                (shadow_samples_mean, shadow_samples_max)
+                if args.adaptive_shadows
+                else None
+            ),
+        )
+        return
 
-    camera, scene_settings, surfaces, lights = parse_scene_file(args.scene_file)
-    ray_tracer = RayTracer(camera, scene_settings, surfaces, lights)
     img_mat = np.zeros((args.height, args.width, COLOR_CHANNELS))
-    ray_tracer.ray_trace(img_mat)
+    shadow_sample_map = (
+        np.zeros((args.height, args.width))
+        if args.adaptive_shadows and args.time_budget is None
+        else None
+    )
+    checkpoint = None
+    checkpoint_path = args.checkpoint
+    if checkpoint_path is None and args.resume:
+        checkpoint_path = args.output_image + ".checkpoint"
+    if checkpoint_path is not None:
+        key = checkpoint_key(
+            args.scene_file,
+            {
+                "height": args.height,
+                "width": args.width,
+                "seed": args.seed,
+                "tile_size": TILE_SIZE,
+                "scene_cache": args.scene_cache,
+                "bvh": not args.no_bvh,
+                "scene_settings": vars(scene_settings),
+            },
+        )
+        tile_count = len(split_into_tiles(args.height, args.width))
+        try:
+            checkpoint = RenderCheckpoint.open(
+                checkpoint_path, key, args.height, args.width, tile_count, args.resume
+            )
+        except ValueError as e:
+            parser.error(str(e))
+        if checkpoint.done.any():
+            print(
+                f"Resuming from {checkpoint_path}: "
+                f"{checkpoint.done.sum()} of {tile_count} tiles are done"
+            )
+    start = time.perf_counter()
+    if args.time_budget is not None:
+
+        def save_pass(progressive_pass: ProgressivePass) -> None:
+            # Saved aside and renamed, so the output is never a half written image.
+            root, extension = os.path.splitext(args.output_image)
+            partial_path = f"{root}.partial{extension}"
+            save_image(img_mat, partial_path)
+            os.replace(partial_path, args.output_image)
+            print(
+                f"Pass {progressive_pass.index + 1} "
+                f"({'coarse' if progressive_pass.coarse else 'full'}) "
+                f"done after {time.perf_counter() - start:.1f}s"
+            )
+
+        ray_tracer.ray_trace_progressive(
+            img_mat, args.time_budget, args.seed, save_pass
+        )
+    elif args.antialias:
+        refined = ray_tracer.ray_trace_antialiased(
+            img_mat,
+            args.aa_samples,
+            args.aa_threshold,
+            args.aa_budget,
+            args.seed,
+            shadow_sample_map,
+        )
+        print(
+            f"Anti-aliased {refined} of {args.height * args.width} pixels "
+            f"({refined / (args.height * args.width):.1%})"
+        )
+    elif args.workers is not None or checkpoint is not None:
+        ray_tracer.ray_trace_tiles(
+            img_mat,
+            1 if args.workers is None else args.workers,
+            args.seed,
+            shadow_sample_map=shadow_sample_map,
+            checkpoint=checkpoint,
+        )
+    elif args.wavefront:
+        ray_tracer.ray_trace_wavefront(img_mat, shadow_sample_map=shadow_sample_map)
+    else:
+        ray_tracer.ray_trace(img_mat)
+    render_time = time.perf_counter() - start
     save_image(img_mat, args.output_image)
+    if checkpoint is not None:
+        checkpoint.remove()
+    print_render_report(
+        args,
+        ray_tracer,
+        render_statistics,
+        render_time,
+        (
+            None
+            if shadow_sample_map is None
+            else (shadow_sample_map.mean(), shadow_sample_map.max())
+        ),
+    )
+
+
+def print_render_report(
+    args: argparse.Namespace,
+    ray_tracer: RayTracer,
+    render_statistics: Optional[stats.RenderStatistics],
+    render_time: float,
+    shadow_samples: Optional[Tuple[float, float]],
+) -> None:
+    """
+    Print the statistics the command line arguments asked for, after a render.
+    :param shadow_samples: The mean and the maximal numbers of shadow rays cast per pixel,
+    if they were counted.
+    """
+    if shadow_samples is not None:
+        print(
+            f"Shadow rays per pixel: mean {shadow_samples[0]:.1f}, "
+            f"max {shadow_samples[1]:.0f}"
+        )
+
+    if args.min_ray_weight > 0:
+        statistics = ray_tracer.ray_tree_statistics
+        print(
+            f"Pruned {statistics.pruned} of {statistics.spawned} secondary rays "
+            f"({statistics.pruned / max(1, statistics.spawned):.1%})"
+        )
+
+    if args.bvh_stats:
+        if ray_tracer.surfaces.bvh is None:
+            print("The scene was rendered without a BVH")
+        else:
+            for name, value in ray_tracer.surfaces.bvh.statistics().items():
+                print(f"{name}: {value}")
+
+    if render_statistics is not None:
+        stats.disable()
+        render_statistics.timers["render"] = render_time
+        if args.stats_json is not None:
+            with open(args.stats_json, "w") as f:
+                json.dump(render_statistics.as_dict(), f, indent=2)
+        else:
+            print(render_statistics.format_table())
 
 
 if __name__ == "__main__":
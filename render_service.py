@@ -0,0 +1,646 @@
+import argparse
+import asyncio
+import collections
+import contextlib
+import copy
+import hashlib
+import io
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+import numpy as np
+from PIL import Image
+
+from colors import RayTreeStatistics
+from consts import (
+    COLOR_CHANNELS,
+    RENDER_SERVICE_JOB_HISTORY,
+    RENDER_SERVICE_MAX_PIXELS,
+    RENDER_SERVICE_MAX_REQUEST_SIZE,
+    RENDER_SERVICE_PORT,
+    RENDER_SERVICE_SCENE_CACHE_SIZE,
+)
+from ray_tracer import RayTracer, save_image
+from sampling import SHADOW_SAMPLING_MODES
+from scene import SceneSettings
+from scene_cache import compile_scene_stream
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+# The fields of a job request, see parse_job_request.
+JOB_FIELDS = {
+    "scene",
+    "scene_text",
+    "width",
+    "height",
+    "seed",
+    "bvh",
+    "settings",
+    "output",
+    "wait",
+}
+# The scene settings a job may override, with their types, and their minimal values or their
+# choices, like the command line's arguments.
+JOB_SETTINGS = {
+    "root_number_shadow_rays": (int, 1),
+    "max_recursions": (int, 0),
+    "min_ray_weight": (float, 0.0),
+    "russian_roulette": (bool, None),
+    "adaptive_shadows": (bool, None),
+    "shadow_sampling": (str, SHADOW_SAMPLING_MODES),
+    "transparent_shadows": (bool, None),
+    "light_culling": (bool, None),
+    "light_cull_threshold": (float, 0.0),
+    "light_samples": (int, 0),
+}
+
+HTTP_REASONS = {
+    200: "OK",
+    202: "Accepted",
+    400: "Bad Request",
+    404: "Not Found",
+    409: "Conflict",
+    413: "Payload Too Large",
+}
+
+# The scenes a worker process built for its previous jobs, least recently used first, keyed by
+# the hash of their text and whether they use a BVH, with their settings before any job's
+# overrides.
+_scene_cache = collections.OrderedDict()
+_worker_state = {}
+
+
+def _init_render_worker(scene_cache_size: int) -> None:
+    _worker_state["scene_cache_size"] = scene_cache_size
+
+
+def _cached_ray_tracer(
+    scene_name: str, scene_key: str, scene_data: bytes, use_bvh: bool
+) -> Tuple[RayTracer, SceneSettings, bool]:
+    # Return the scene's ray tracer, its settings without overrides, and whether it was
+    # cached.
+    key = (scene_key, use_bvh)
+    if key in _scene_cache:
+        _scene_cache.move_to_end(key)
+        return (*_scene_cache[key], True)
+    camera, scene_settings, surfaces, lights = compile_scene_stream(
+        io.BytesIO(scene_data), scene_name
+    ).to_objects()
+    ray_tracer = RayTracer(camera, scene_settings, surfaces, lights, use_bvh=use_bvh)
+    _scene_cache[key] = (ray_tracer, scene_settings)
+    while len(_scene_cache) > _worker_state["scene_cache_size"]:
+        _scene_cache.popitem(last=False)
+    return ray_tracer, scene_settings, False
+
+
+def _render_job(
+    scene_name: str, scene_key: str, scene_data: bytes, job: Dict[str, Any]
+) -> Tuple[Optional[bytes], bool, float]:
+    # Render a job in a worker process, and return its PNG image (or None if it was saved to
+    # the job's output path), whether its scene was cached, and the rendering's duration.
+    ray_tracer, scene_settings, cached = _cached_ray_tracer(
+        scene_name, scene_key, scene_data, job["bvh"]
+    )
+    ray_tracer.scene_settings = copy.copy(scene_settings)
+    for name, value in job["settings"].items():
+        setattr(ray_tracer.scene_settings, name, value)
+    ray_tracer.ray_tree_statistics = RayTreeStatistics()
+
+    start = time.perf_counter()
+    img_mat = np.zeros((job["height"], job["width"], COLOR_CHANNELS))
+    # The progress bars would interleave in the service's output.
+    with contextlib.redirect_stdout(io.StringIO()):
+        ray_tracer.ray_trace_tiles(img_mat, 1, job["seed"])
+    render_time = time.perf_counter() - start
+
+    if job["output"] is not None:
+        save_image(img_mat, job["output"])
+        return None, cached, render_time
+    png = io.BytesIO()
+    Image.fromarray(np.uint8(img_mat)).save(png, format="PNG")
+    return png.getvalue(), cached, render_time
+
+
+def _read_scene(file_path: str) -> Tuple[bytes, str]:
+    with open(file_path, "rb") as f:
+        scene_data = f.read()
+    return scene_data, hashlib.sha256(scene_data).hexdigest()
+
+
+def _is_integer(value: Any) -> bool:
+    # JSON's true and false are Python bools, which are ints too.
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def parse_setting(name: str, value: Any) -> Any:
+    """
+    Validate the value of a scene setting a job overrides against its type and its minimal
+    value or choices in JOB_SETTINGS, and return it (integers are accepted for numbers),
+    or raise a ValueError.
+    """
+    setting_type, limit = JOB_SETTINGS[name]
+    if setting_type is bool:
+        valid = isinstance(value, bool)
+    elif setting_type is int:
+        valid = _is_integer(value) and value >= limit
+    elif setting_type is float:
+        valid = (_is_integer(value) or isinstance(value, float)) and value >= limit
+    else:
+        valid = value in limit
+    if not valid:
+        if setting_type is str:
+            expected = "one of " + ", ".join(limit)
+        elif setting_type is bool:
+            expected = "true or false"
+        elif setting_type is int:
+            expected = f"an integer of at least {limit}"
+        else:
+            expected = f"a number of at least {limit}"
+        raise ValueError(f"The setting {name} must be {expected}")
+    return float(value) if setting_type is float else value
+
+
+def _resolve_within(directory: str, path: str, name: str) -> str:
+    # Resolved with its symbolic links, so it can't lead out of the directory.
+    directory = os.path.realpath(directory)
+    resolved = os.path.realpath(os.path.join(directory, path))
+    if os.path.commonpath([directory, resolved]) != directory:
+        raise ValueError(f"The job's {name} must be within the {name} directory")
+    return resolved
+
+
+def parse_job_request(
+    request: Any, output_dir: Optional[str] = None, scene_dir: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Validate a job request, a JSON object with the fields:
+    scene: The path of a scene text file within scene_dir, or scene_text: the text of a
+    scene. Without a scene_dir, jobs can only send their scenes' text.
+    width, height: The image's size, 500 x 500 by default, of at most
+    RENDER_SERVICE_MAX_PIXELS pixels.
+    seed: The random seed of the soft shadows, 0 by default.
+    bvh: Whether to trace the scene with a BVH, true by default.
+    settings: An object of scene settings to override, of the names in JOB_SETTINGS.
+    output: A path within output_dir to save the image to, instead of keeping it for the
+    client to fetch. Without an output_dir, jobs can't save their images.
+    wait: Whether to reply once the job is finished, with its image, instead of right away.
+    Return the request with the defaults of its missing fields, its settings validated (see
+    parse_setting) and its scene and output paths resolved, or raise a ValueError.
+    """
+    if not isinstance(request, dict):
+        raise ValueError("A job must be a JSON object")
+    unknown = set(request) - JOB_FIELDS
+    if unknown:
+        raise ValueError("Unknown job fields: {}".format(", ".join(sorted(unknown))))
+    if ("scene" in request) == ("scene_text" in request):
+        raise ValueError("A job needs either a scene or a scene_text")
+    job = {
+        "width": 500,
+        "height": 500,
+        "seed": 0,
+        "bvh": True,
+        "settings": {},
+        "output": None,
+        "wait": False,
+        **request,
+    }
+    for name in ("width", "height"):
+        if not _is_integer(job[name]):
+            raise ValueError(f"The job's {name} must be an integer")
+        if job[name] <= 0:
+            raise ValueError(f"The job's {name} must be positive")
+    if job["width"] * job["height"] > RENDER_SERVICE_MAX_PIXELS:
+        raise ValueError(
+            f"The job's image can't have more than {RENDER_SERVICE_MAX_PIXELS} pixels"
+        )
+    if not _is_integer(job["seed"]):
+        raise ValueError("The job's seed must be an integer")
+    for name in ("bvh", "wait"):
+        if not isinstance(job[name], bool):
+            raise ValueError(f"The job's {name} must be true or false")
+    for name in ("scene", "scene_text", "output"):
+        if job.get(name) is not None and not isinstance(job[name], str):
+            raise ValueError(f"The job's {name} must be a string")
+    if not isinstance(job["settings"], dict):
+        raise ValueError("The job's settings must be a JSON object")
+    unknown = set(job["settings"]) - set(JOB_SETTINGS)
+    if unknown:
+        raise ValueError(
+            "Unknown scene settings: {}".format(", ".join(sorted(unknown)))
+        )
+    job["settings"] = {
+        name: parse_setting(name, value) for name, value in job["settings"].items()
+    }
+    if "scene" in job:
+        if scene_dir is None:
+            raise ValueError("The service has no scene directory to read scenes from")
+        job["scene"] = _resolve_within(scene_dir, job["scene"], "scene")
+    if job["output"] is not None:
+        if output_dir is None:
+            raise ValueError("The service has no output directory to save images to")
+        job["output"] = _resolve_within(output_dir, job["output"], "output")
+    return job
+
+
+class RenderJob:
+    """
+    A job of the render service, and its status: queued, running, and then done, failed or
+    cancelled. A finished job keeps its image, if it wasn't saved to an output path.
+    """
+
+    def __init__(
+        self, job_id: str, job: Dict[str, Any], scene_name: str, scene_key: str
+    ):
+        self.id = job_id
+        self.job = job
+        self.scene_name = scene_name
+        self.scene_key = scene_key
+        # The scene's text, until a worker got it.
+        self.scene_data: Optional[bytes] = None
+        self.status = JOB_QUEUED
+        self.error: Optional[str] = None
+        self.png: Optional[bytes] = None
+        self.cached_scene: Optional[bool] = None
+        self.render_time: Optional[float] = None
+        self.submitted = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.done = asyncio.Event()
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "scene": self.scene_name,
+            "scene_hash": self.scene_key,
+            "width": self.job["width"],
+            "height": self.job["height"],
+            "output": self.job["output"],
+            "error": self.error,
+            "cached_scene": self.cached_scene,
+            "render_seconds": self.render_time,
+            "queued_seconds": (
+                None if self.started is None else self.started - self.submitted
+            ),
+        }
+
+
+class RenderService:
+    """
+    A long running render service, which saves the start up of a render, importing the ray
+    tracer and parsing and building its scene, for every one of many small renders of a few
+    scenes.
+    The jobs are queued, and rendered in turn by a pool of worker processes. Every worker keeps
+    the last scene_cache_size scenes it built, keyed by the hash of their text, so jobs of the
+    same scene skip parsing it and building its BVH, and a changed scene file is built again.
+    Jobs are rendered tile by tile with their seed, so their images are the same as the ones
+    of ray_tracer.py with --workers and --seed.
+    The service answers HTTP requests, on a local port or Unix socket:
+    POST /jobs: Submit a job, see parse_job_request, and reply with its status (or its image,
+    if it waits for it).
+    GET /jobs/<id>: The job's status.
+    GET /jobs/<id>/image: The finished job's PNG image.
+    DELETE /jobs/<id>: Cancel the job, if it's still queued.
+    GET /metrics: The queue's depth, and the counts of jobs, scene cache hits and restarts of
+    the worker pool.
+    When a worker process dies, the jobs running in the pool fail, and the pool is replaced.
+    :param workers: The number of worker processes.
+    :param scene_cache_size: The number of scenes every worker keeps.
+    :param job_history: The number of finished jobs that are kept, with their images, until
+    the oldest of them are forgotten.
+    :param output_dir: The directory jobs may save their images in, or None if they can only
+    return them.
+    :param scene_dir: The directory jobs may read their scenes from, or None if they can only
+    send their text.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        scene_cache_size: int = RENDER_SERVICE_SCENE_CACHE_SIZE,
+        job_history: int = RENDER_SERVICE_JOB_HISTORY,
+        output_dir: Optional[str] = None,
+        scene_dir: Optional[str] = None,
+    ):
+        self.workers = workers
+        self.output_dir = output_dir
+        self.scene_dir = scene_dir
+        self.scene_cache_size = scene_cache_size
+        self.job_history = job_history
+        self.jobs: Dict[str, RenderJob] = {}
+        self.finished_jobs = collections.deque()
+        self.job_ids = itertools.count(1)
+        self.queue: Optional[asyncio.Queue] = None
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.queued = 0
+        self.running = 0
+        self.counters = {
+            "submitted": 0,
+            JOB_DONE: 0,
+            JOB_FAILED: 0,
+            JOB_CANCELLED: 0,
+            "scene_cache_hits": 0,
+            "scene_cache_misses": 0,
+            "pool_restarts": 0,
+        }
+        self.render_time = 0.0
+
+    async def serve(
+        self,
+        host: str = "127.0.0.1",
+        port: int = RENDER_SERVICE_PORT,
+        socket_path: Optional[str] = None,
+    ) -> None:
+        """
+        Serve requests on the given host and port, or Unix socket, until cancelled.
+        """
+        self.pool = self._start_pool()
+        self.queue = asyncio.Queue()
+        dispatchers = [
+            asyncio.create_task(self._dispatch()) for _ in range(self.workers)
+        ]
+        try:
+            if socket_path is not None:
+                server = await asyncio.start_unix_server(
+                    self.handle_connection, socket_path
+                )
+                address = socket_path
+            else:
+                server = await asyncio.start_server(self.handle_connection, host, port)
+                address = f"http://{host}:{port}"
+            print(f"Render service listening on {address} with {self.workers} workers")
+            async with server:
+                await server.serve_forever()
+        finally:
+            for dispatcher in dispatchers:
+                dispatcher.cancel()
+            self.pool.shutdown(cancel_futures=True)
+
+    def _start_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            self.workers,
+            initializer=_init_render_worker,
+            initargs=(self.scene_cache_size,),
+        )
+
+    async def submit(self, request: Any) -> RenderJob:
+        """
+        Queue a job, or raise a ValueError if the request is invalid.
+        """
+        job = parse_job_request(request, self.output_dir, self.scene_dir)
+        if "scene" in job:
+            # Named by their path within the scene directory, which doesn't reveal where it
+            # is.
+            scene_name = request["scene"]
+            try:
+                (
+                    scene_data,
+                    scene_key,
+                ) = await asyncio.get_running_loop().run_in_executor(
+                    None, _read_scene, job["scene"]
+                )
+            except OSError as e:
+                raise ValueError(f"Can't read the scene {scene_name}: {e.strerror}")
+        else:
+            scene_data = job["scene_text"].encode()
+            scene_key = hashlib.sha256(scene_data).hexdigest()
+            scene_name = "<scene_text>"
+        render_job = RenderJob(str(next(self.job_ids)), job, scene_name, scene_key)
+        render_job.scene_data = scene_data
+        self.jobs[render_job.id] = render_job
+        self.counters["submitted"] += 1
+        self.queued += 1
+        self.queue.put_nowait(render_job)
+        return render_job
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancel a queued job, and return whether it was queued. A running job can't be stopped,
+        since it's rendering in a worker process.
+        """
+        render_job = self.jobs[job_id]
+        if render_job.status != JOB_QUEUED:
+            return False
+        self.queued -= 1
+        self._finish(render_job, JOB_CANCELLED)
+        return True
+
+    def metrics(self) -> Dict[str, Union[int, float]]:
+        rendered = self.counters[JOB_DONE]
+        return {
+            "workers": self.workers,
+            "queue_depth": self.queued,
+            "running": self.running,
+            **self.counters,
+            "render_seconds": self.render_time,
+            "mean_render_seconds": self.render_time / rendered if rendered else 0.0,
+        }
+
+    async def _dispatch(self) -> None:
+        # Every dispatcher renders one job at a time, so there are as many running jobs as
+        # workers, and the rest wait in the queue, where they can be cancelled.
+        loop = asyncio.get_running_loop()
+        while True:
+            render_job = await self.queue.get()
+            if render_job.status != JOB_QUEUED:
+                continue
+            self.queued -= 1
+            self.running += 1
+            render_job.status = JOB_RUNNING
+            render_job.started = time.time()
+            scene_data, render_job.scene_data = render_job.scene_data, None
+            pool = self.pool
+            try:
+                png, cached, render_time = await loop.run_in_executor(
+                    pool,
+                    _render_job,
+                    render_job.scene_name,
+                    render_job.scene_key,
+                    scene_data,
+                    render_job.job,
+                )
+            except BrokenProcessPool:
+                # A worker process died, like when the system ran out of memory, which
+                # fails all the jobs running in the pool, and any later ones. The pool is
+                # replaced once, by the first of the jobs that failed with it.
+                render_job.error = "A worker process died while rendering the job"
+                self._finish(render_job, JOB_FAILED)
+                if pool is self.pool:
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    self.pool = self._start_pool()
+                    self.counters["pool_restarts"] += 1
+            except Exception as e:
+                render_job.error = str(e) or type(e).__name__
+                self._finish(render_job, JOB_FAILED)
+            else:
+                render_job.png = png
+                render_job.cached_scene = cached
+                render_job.render_time = render_time
+                self.counters[
+                    "scene_cache_hits" if cached else "scene_cache_misses"
+                ] += 1
+                self.render_time += render_time
+                self._finish(render_job, JOB_DONE)
+            finally:
+                self.running -= 1
+
+    def _finish(self, render_job: RenderJob, status: str) -> None:
+        render_job.status = status
+        render_job.finished = time.time()
+        render_job.scene_data = None
+        render_job.done.set()
+        self.counters[status] += 1
+        self.finished_jobs.append(render_job.id)
+        while len(self.finished_jobs) > self.job_history:
+            del self.jobs[self.finished_jobs.popleft()]
+
+    async def handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        # A single request per connection, which is closed after the response.
+        try:
+            status, body = await self._handle_request(reader)
+        except (
+            ValueError,
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+        ) as e:
+            status, body = 400, {"error": str(e) or "Bad request"}
+        if isinstance(body, bytes):
+            content_type = "image/png"
+        else:
+            content_type = "application/json"
+            body = json.dumps(body).encode()
+        writer.write(
+            (
+                f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode()
+            + body
+        )
+        try:
+            await writer.drain()
+            # The worker processes forked while the connection was open share its socket, so
+            # closing it doesn't end it, and the end of the response is sent explicitly.
+            writer.write_eof()
+            writer.close()
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    async def _handle_request(
+        self, reader: asyncio.StreamReader
+    ) -> Tuple[int, Union[bytes, Dict[str, Any]]]:
+        head = await reader.readuntil(b"\r\n\r\n")
+        request_line, *header_lines = (
+            head.decode("latin-1").rstrip("\r\n").split("\r\n")
+        )
+        method, target, _ = request_line.split(" ", 2)
+        headers = {}
+        for line in header_lines:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length > RENDER_SERVICE_MAX_REQUEST_SIZE:
+            return 413, {"error": "The request is too large"}
+        body = await reader.readexactly(length)
+
+        path = [part for part in urlsplit(target).path.split("/") if part]
+        if method == "GET" and path == ["metrics"]:
+            return 200, self.metrics()
+        if method == "POST" and path == ["jobs"]:
+            render_job = await self.submit(json.loads(body or b"{}"))
+            if not render_job.job["wait"]:
+                return 202, render_job.as_dict()
+            await render_job.done.wait()
+            if render_job.png is not None:
+                return 200, render_job.png
+            return 200, render_job.as_dict()
+        if len(path) < 2 or path[0] != "jobs" or path[1] not in self.jobs:
+            return 404, {"error": "Not found"}
+        render_job = self.jobs[path[1]]
+        if method == "GET" and len(path) == 2:
+            return 200, render_job.as_dict()
+        if method == "DELETE" and len(path) == 2:
+            return 200, {"id": render_job.id, "cancelled": self.cancel(render_job.id)}
+        if method == "GET" and path[2:] == ["image"]:
+            if render_job.png is None:
+                return 409, {"error": "The job has no image", **render_job.as_dict()}
+            return 200, render_job.png
+        return 404, {"error": "Not found"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Python Ray Tracer render service")
+    parser.add_argument(
+        "--host", type=str, default="127.0.0.1", help="The host to listen on"
+    )
+    parser.add_argument(
+        "--port", type=int, default=RENDER_SERVICE_PORT, help="The port to listen on"
+    )
+    parser.add_argument(
+        "--socket",
+        type=str,
+        default=None,
+        help="Listen on this Unix socket instead of on a port",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="The number of processes to render the jobs with",
+    )
+    parser.add_argument(
+        "--scene-cache-size",
+        type=int,
+        default=RENDER_SERVICE_SCENE_CACHE_SIZE,
+        help="The number of built scenes every worker keeps for later jobs",
+    )
+    parser.add_argument(
+        "--job-history",
+        type=int,
+        default=RENDER_SERVICE_JOB_HISTORY,
+        help="The number of finished jobs whose status and image are kept",
+    )
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        default=None,
+        help="A directory jobs may save their images in, with their output field, instead "
+        "of returning them (by default, jobs can only return them)",
+    )
+    parser.add_argument(
+        "--scene-dir",
+        type=str,
+        default=None,
+        help="A directory jobs may read their scenes from, with their scene field (by "
+        "default, jobs can only send their scenes' text)",
+    )
+    args = parser.parse_args()
+    service = RenderService(
+        args.workers,
+        args.scene_cache_size,
+        args.job_history,
+        args.output_dir,
+        args.scene_dir,
+    )
+    try:
+        asyncio.run(service.serve(args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import functools
+from typing import Dict, Tuple
+
+import numpy as np
+
+from consts import SAMPLE_TABLE_COUNT
+
+# The ways of choosing the soft shadows' sample points on a light: "random" draws them from a
+# random generator for every shading point, while the others look them up in tables of unit
+# square samples that are precomputed per light, by the index of the shaded pixel.
+SHADOW_SAMPLING_RANDOM = "random"
+SHADOW_SAMPLING_STRATIFIED = "stratified"
+SHADOW_SAMPLING_HALTON = "halton"
+SHADOW_SAMPLING_MODES = (
+    SHADOW_SAMPLING_RANDOM,
+    SHADOW_SAMPLING_STRATIFIED,
+    SHADOW_SAMPLING_HALTON,
+)
+
+
+@functools.lru_cache(maxsize=None)
+def grid_cell_indices(root_number_samples: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return the arrays of the row and column indices of the cells of a square grid with
+    root_number_samples cells on every side, in row major order.
+    The arrays are cached, and shouldn't be modified.
+    """
+    return np.divmod(
+        np.arange(root_number_samples * root_number_samples), root_number_samples
+    )
+
+
+def radical_inverse(indices: np.ndarray, base: int) -> np.ndarray:
+    """
+    Return the radical inverses of the given non-negative integers in the given base,
+    which are the coordinates of the Halton sequence.
+    """
+    indices = indices.copy()
+    inverses = np.zeros(len(indices))
+    scale = 1.0 / base
+    while np.any(indices > 0):
+        indices, digits = np.divmod(indices, base)
+        inverses += digits * scale
+        scale /= base
+    return inverses
+
+
+def stratified_tables(
+    root_number_samples: int, count: int, rng: np.random.Generator
+) -> np.ndarray:
+    """
+    Return a (count, root_number_samples^2, 2) array of tables of jittered samples in the
+    unit square, with a single sample in every cell of the root_number_samples^2 grid.
+    """
+    rows, cols = grid_cell_indices(root_number_samples)
+    cells = np.stack([rows, cols], axis=1)
+    jitter = rng.uniform(size=(count, len(cells), 2))
+    return (cells + jitter) / root_number_samples
+
+
+def halton_tables(
+    root_number_samples: int, count: int, rng: np.random.Generator
+) -> np.ndarray:
+    """
+    Return a (count, root_number_samples^2, 2) array of tables of low discrepancy samples in
+    the unit square: the first points of the 2D Halton sequence, each table rotated by
+    a different random shift (modulo 1), so that neighbouring pixels don't share samples.
+    """
+    indices = np.arange(root_number_samples * root_number_samples)
+    points = np.stack(
+        [radical_inverse(indices, 2), radical_inverse(indices, 3)], axis=1
+    )
+    shifts = rng.uniform(size=(count, 1, 2))
+    return (points + shifts) % 1.0
+
+
+def hash_rotations(seed: int, indices: np.ndarray) -> np.ndarray:
+    """
+    Return an (N, 2) array of pseudo random shifts in the unit square, one per index, by
+    hashing the indices with the seed (with the SplitMix64 finalizer), so they're the same
+    in every process and don't repeat like the tables do.
+    """
+    offset = (seed * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    hashes = np.asarray(indices).astype(np.uint64) + np.uint64(offset)
+    hashes = (hashes ^ (hashes >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    hashes = (hashes ^ (hashes >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    hashes ^= hashes >> np.uint64(31)
+    # The high and low 32 bits of the hashes are the two coordinates.
+    halves = np.stack([hashes >> np.uint64(32), hashes & np.uint64(0xFFFFFFFF)], axis=1)
+    return halves / float(1 << 32)
+
+
+class SampleTables:
+    """
+    A lazily built cache of unit square sample tables, one set of SAMPLE_TABLE_COUNT tables
+    for every sampling mode and number of samples, generated from a fixed seed, so they're
+    the same in every process. Every lookup rotates its table by a per index shift (modulo
+    1, a Cranley-Patterson rotation), so the pixels that share a table still get different
+    samples, and the tables keep their even spread (a stratified table is still stratified,
+    over the shifted grid).
+    """
+
+    def __init__(self, seed: int):
+        self.seed = seed
+        self._tables: Dict[Tuple[str, int], np.ndarray] = {}
+
+    def get(self, sampling: str, root_number_samples: int) -> np.ndarray:
+        key = (sampling, root_number_samples)
+        if key not in self._tables:
+            rng = np.random.default_rng(
+                (self.seed, SHADOW_SAMPLING_MODES.index(sampling), root_number_samples)
+            )
+            if sampling == SHADOW_SAMPLING_STRATIFIED:
+                tables = stratified_tables(root_number_samples, SAMPLE_TABLE_COUNT, rng)
+            elif sampling == SHADOW_SAMPLING_HALTON:
+                tables = halton_tables(root_number_samples, SAMPLE_TABLE_COUNT, rng)
+            else:
+                raise ValueError("Unknown sample table mode: {}".format(sampling))
+            self._tables[key] = tables
+        return self._tables[key]
+
+    def lookup(
+        self, sampling: str, root_number_samples: int, sample_indices: np.ndarray
+    ) -> np.ndarray:
+        """
+        Return a (P, root_number_samples^2, 2) array of the tables of the given sample indices
+        (usually the indices of the shaded pixels), each rotated by its index's shift.
+        """
+        tables = self.get(sampling, root_number_samples)
+        rotations = hash_rotations(self.seed, sample_indices)
+        return (
+            tables[sample_indices % len(tables)] + rotations[:, np.newaxis, :]
+        ) % 1.0
@@ -3,10 +3,12 @@ from typing import List
 import numpy as np
 
 from camera import Camera
+from consts import LIGHT_CULL_THRESHOLD
 from cube import Cube
 from infinite_plane import InfinitePlane
 from light import Light
 from material import Material
+from sampling import SHADOW_SAMPLING_RANDOM
 from sphere import Sphere
 
 
@@ -16,10 +18,36 @@ class SceneSettings:
         background_color: List[float],
         root_number_shadow_rays: float,
         max_recursions: float,
+        min_ray_weight: float = 0.0,
+        russian_roulette: bool = False,
+        adaptive_shadows: bool = False,
+        shadow_sampling: str = SHADOW_SAMPLING_RANDOM,
+        transparent_shadows: bool = False,
+        light_culling: bool = False,
+        light_cull_threshold: float = LIGHT_CULL_THRESHOLD,
+        light_samples: int = 0,
     ):
         self.background_color = np.array(background_color)
         self.root_number_shadow_rays = int(root_number_shadow_rays)
         self.max_recursions = max_recursions
+        # Secondary rays whose weight (their largest color channel's contribution to their
+        # pixel) is below min_ray_weight are pruned. With russian_roulette, they're instead
+        # kept at random, with a probability proportional to their weight.
+        self.min_ray_weight = min_ray_weight
+        self.russian_roulette = russian_roulette
+        # Whether to cast the full grid of shadow rays only in penumbra regions.
+        self.adaptive_shadows = adaptive_shadows
+        # How the soft shadows' samples are chosen, one of sampling.SHADOW_SAMPLING_MODES.
+        self.shadow_sampling = shadow_sampling
+        # Whether shadow rays pass through transparent surfaces, attenuated by them.
+        self.transparent_shadows = transparent_shadows
+        # Whether to skip the lights that add nothing to the shaded points, and the shadow rays
+        # of lights that add less than light_cull_threshold color levels to their pixels. With
+        # light_samples, only that many lights are shaded per point, picked at random by their
+        # contributions. Both are only used by the batched renderers.
+        self.light_culling = light_culling
+        self.light_cull_threshold = light_cull_threshold
+        self.light_samples = light_samples
 
 
 def parse_scene_file(file_path):
@@ -0,0 +1,480 @@
+import os
+import warnings
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from base_surface import SurfaceGroups
+from camera import Camera
+from consts import SCENE_PARSE_CHUNK_SIZE
+from cube import Cube
+from infinite_plane import InfinitePlane
+from light import Light
+from material import MaterialArrays
+from scene import SceneSettings
+from sphere import Sphere
+
+# A compiled scene is a directory of .npy files, one per array, which are memory mapped when
+# it's loaded. The version is bumped whenever the layout changes, so old caches get rebuilt.
+SCENE_CACHE_VERSION = 3
+SCENE_CACHE_SUFFIX = ".cache"
+
+# The kinds of the surfaces, in the order they appear in the scene.
+SURFACE_KIND_SPHERE = 0
+SURFACE_KIND_PLANE = 1
+SURFACE_KIND_CUBE = 2
+
+# The arrays of a compiled scene, and their dtypes and shapes (-1 stands for the row count).
+# The primitives' geometry, which is most of a big scene, is stored in float32, halving the
+# cache and the pages it maps, and upcast to float64 once per table when the scene is loaded,
+# since shading and the EPSILON offsets need the precision. So values of the scene text that
+# float32 can't represent exactly, like 0.1, are rounded to the nearest float32 value, which
+# moves the surfaces by less than 1e-7 of their coordinates.
+SCENE_ARRAYS = {
+    "version": (np.int64, (1,)),
+    "camera": (np.float64, (11,)),
+    "settings": (np.float64, (5,)),
+    "material_diffuse_colors": (np.float64, (-1, 3)),
+    "material_specular_colors": (np.float64, (-1, 3)),
+    "material_reflection_colors": (np.float64, (-1, 3)),
+    "material_shininess": (np.float64, (-1,)),
+    "material_transparency": (np.float64, (-1,)),
+    "surface_kinds": (np.int8, (-1,)),
+    "sphere_positions": (np.float32, (-1, 3)),
+    "sphere_radii": (np.float32, (-1,)),
+    "sphere_materials": (np.int32, (-1,)),
+    "plane_normals": (np.float32, (-1, 3)),
+    "plane_offsets": (np.float32, (-1,)),
+    "plane_materials": (np.int32, (-1,)),
+    "cube_positions": (np.float32, (-1, 3)),
+    "cube_scales": (np.float32, (-1,)),
+    "cube_materials": (np.int32, (-1,)),
+    "light_positions": (np.float64, (-1, 3)),
+    "light_colors": (np.float64, (-1, 3)),
+    "light_specular_intensities": (np.float64, (-1,)),
+    "light_shadow_intensities": (np.float64, (-1,)),
+    "light_radii": (np.float64, (-1,)),
+}
+
+
+def _upcast(table: np.ndarray) -> np.ndarray:
+    return np.asarray(table, dtype=np.float64)
+
+
+class CompiledScene:
+    """
+    A scene stored as a struct of arrays: a table of materials, a table per primitive type,
+    whose material columns are 0-based indices into the materials table, and a table of
+    lights. The arrays are usually read-only memory maps of a compiled scene directory.
+    """
+
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        missing = set(SCENE_ARRAYS) - set(arrays)
+        if missing:
+            raise ValueError(
+                "The compiled scene is missing: {}".format(", ".join(sorted(missing)))
+            )
+        for name, (dtype, shape) in SCENE_ARRAYS.items():
+            array = arrays[name]
+            if array.dtype != dtype or array.ndim != len(shape):
+                raise ValueError("Bad array in the compiled scene: {}".format(name))
+            setattr(self, name, array)
+
+    def to_objects(
+        self,
+    ) -> Tuple[Camera, SceneSettings, SurfaceGroups, List[Light]]:
+        """
+        Return the scene in the format of scene.parse_scene_file, except that the surfaces
+        are already grouped into SurfaceGroups, straight from the tables, without an object
+        per surface or material: the materials' arrays are views of the (usually memory
+        mapped) tables, and the groups' parameters are the float32 geometry tables upcast to
+        float64, one NumPy pass per table. The surfaces' objects are only built if the scalar
+        renderer needs them, see SurfaceGroups.
+        """
+        camera = self.camera.tolist()
+        camera = Camera(camera[:3], camera[3:6], camera[6:9], camera[9], camera[10])
+        settings = self.settings.tolist()
+        scene_settings = SceneSettings(settings[:3], settings[3], settings[4])
+
+        # np.asarray views the memory maps as plain arrays, without copying them.
+        materials = MaterialArrays.from_arrays(
+            np.asarray(self.material_diffuse_colors),
+            np.asarray(self.material_specular_colors),
+            np.asarray(self.material_reflection_colors),
+            np.asarray(self.material_shininess),
+            np.asarray(self.material_transparency),
+        )
+        plane_normals = _upcast(self.plane_normals)
+        groups_by_kind = {
+            SURFACE_KIND_SPHERE: (
+                Sphere,
+                (_upcast(self.sphere_positions), _upcast(self.sphere_radii)),
+                self.sphere_materials,
+            ),
+            SURFACE_KIND_PLANE: (
+                InfinitePlane,
+                (
+                    plane_normals
+                    / np.linalg.norm(plane_normals, axis=1)[:, np.newaxis],
+                    _upcast(self.plane_offsets),
+                ),
+                self.plane_materials,
+            ),
+            SURFACE_KIND_CUBE: (
+                Cube,
+                (_upcast(self.cube_positions), _upcast(self.cube_scales) / 2.0),
+                self.cube_materials,
+            ),
+        }
+
+        kinds = np.asarray(self.surface_kinds)
+        surface_material_ids = np.empty(len(kinds), dtype=np.int64)
+        groups = []
+        # The groups are ordered by the first surface of every kind, like SurfaceGroups
+        # orders them.
+        _, first_indices = np.unique(kinds, return_index=True)
+        for kind in kinds[np.sort(first_indices)].tolist():
+            surface_type, parameters, material_ids = groups_by_kind[kind]
+            indices = np.flatnonzero(kinds == kind)
+            surface_material_ids[indices] = material_ids
+            groups.append((surface_type, indices.astype(np.int64), parameters))
+        surfaces = SurfaceGroups(None, groups, materials, surface_material_ids)
+
+        lights = [
+            Light(*parameters)
+            for parameters in zip(
+                self.light_positions.tolist(),
+                self.light_colors.tolist(),
+                self.light_specular_intensities.tolist(),
+                self.light_shadow_intensities.tolist(),
+                self.light_radii.tolist(),
+            )
+        ]
+        return camera, scene_settings, surfaces, lights
+
+
+# The number of values of every record type of the scene text format, after its keyword.
+RECORD_VALUE_COUNTS = {
+    b"cam": 11,
+    b"set": 5,
+    b"mtl": 11,
+    b"sph": 5,
+    b"pln": 5,
+    b"box": 5,
+    b"lgt": 9,
+}
+RECORD_SURFACE_KINDS = {
+    b"sph": SURFACE_KIND_SPHERE,
+    b"pln": SURFACE_KIND_PLANE,
+    b"box": SURFACE_KIND_CUBE,
+}
+# A lookup table of the blank bytes.
+_IS_BLANK = np.zeros(256, dtype=bool)
+_IS_BLANK[np.frombuffer(b" \t\r\n\v\f", dtype=np.uint8)] = True
+
+
+def _keyword_code(keyword: bytes) -> int:
+    return (keyword[0] << 16) | (keyword[1] << 8) | keyword[2]
+
+
+class _SceneTextChunk:
+    """
+    The lines of a chunk of a scene text file, located in bulk: the chunk is scanned as
+    a byte array, and every line is described by its first non blank byte, its end, and
+    a code of its 3 bytes keyword, so that the lines can be grouped by record type without
+    looking at them one at a time.
+    """
+
+    def __init__(self, data: bytes, file_path: str, first_line_number: int):
+        self.file_path = file_path
+        self.first_line_number = first_line_number
+        # The chunk always ends with a newline, the padding keeps the keywords in bounds.
+        self.buffer = np.frombuffer(data + b"   ", dtype=np.uint8)
+        self.ends = np.flatnonzero(self.buffer == ord("\n"))
+        starts = np.concatenate([[0], self.ends[:-1] + 1])
+
+        # The first non blank byte at or after every line's start, the buffer's length
+        # standing for none. Lines where it's past the line's end are blank.
+        non_blank = np.append(np.flatnonzero(~_IS_BLANK[self.buffer]), len(self.buffer))
+        first = non_blank[np.searchsorted(non_blank, starts)]
+        content = first < self.ends
+        content[content] = self.buffer[first[content]] != ord("#")
+        self.lines = np.flatnonzero(content)
+        self.first = first[self.lines]
+        self.ends = self.ends[self.lines]
+
+        keyword_bytes = self.buffer[self.first[:, np.newaxis] + np.arange(4)].astype(
+            np.int64
+        )
+        self.codes = (
+            (keyword_bytes[:, 0] << 16)
+            | (keyword_bytes[:, 1] << 8)
+            | keyword_bytes[:, 2]
+        )
+        # A keyword must be followed by a blank, or the line is an unknown record.
+        self.codes[~_IS_BLANK[keyword_bytes[:, 3]]] = -1
+
+        known = np.isin(self.codes, [_keyword_code(k) for k in RECORD_VALUE_COUNTS])
+        if not np.all(known):
+            line = np.flatnonzero(~known)[0]
+            raise self.error(
+                line, "Unknown object type: {}".format(self.line_text(line).split()[0])
+            )
+
+    def line_text(self, line: int) -> str:
+        return bytes(self.buffer[self.first[line] : self.ends[line]]).decode(
+            errors="replace"
+        )
+
+    def error(self, line: int, message: str) -> ValueError:
+        """
+        Return an error about the given line of the chunk, with the file's line number.
+        """
+        return ValueError(
+            "{}:{}: {}".format(
+                self.file_path, self.first_line_number + self.lines[line], message
+            )
+        )
+
+    def records(self, keyword: bytes) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return the indices of the chunk's lines of the given record type, and a
+        (lines, values) array of their values, parsed in a single pass.
+        """
+        lines = np.flatnonzero(self.codes == _keyword_code(keyword))
+        value_count = RECORD_VALUE_COUNTS[keyword]
+        if len(lines) == 0:
+            return lines, np.empty((0, value_count))
+
+        # Gather the lines' bytes after their keywords, including their newlines,
+        # which separate the values of consecutive lines.
+        starts = self.first[lines] + len(keyword)
+        lengths = self.ends[lines] + 1 - starts
+        offsets = np.cumsum(lengths) - lengths
+        gathered = self.buffer[
+            np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+        ]
+
+        # Every line must have exactly value_count values, so that a short line can't be
+        # made up for by a long one. A value starts wherever a blank is followed by a non
+        # blank, and every gathered line starts with the blank after its keyword.
+        non_blank = ~_IS_BLANK[gathered]
+        value_starts = non_blank[1:] & ~non_blank[:-1]
+        counts = np.add.reduceat(np.append(value_starts, False), offsets)
+        if np.any(counts != value_count):
+            self._raise_bad_record(lines, value_count)
+
+        values = None
+        with warnings.catch_warnings():
+            # Older NumPy versions only warn about text that isn't a number.
+            warnings.simplefilter("error", DeprecationWarning)
+            try:
+                values = np.fromstring(gathered.tobytes(), sep=" ")
+            except (ValueError, DeprecationWarning):
+                pass
+        if values is None or len(values) != len(lines) * value_count:
+            self._raise_bad_record(lines, value_count)
+        return lines, values.reshape(len(lines), value_count)
+
+    def _raise_bad_record(self, lines: np.ndarray, value_count: int) -> None:
+        # Only reached when the file is broken, so the lines are checked one at a time.
+        for line in lines:
+            text = self.line_text(line)
+            parts = text.split()[1:]
+            try:
+                [float(part) for part in parts]
+            except ValueError:
+                raise self.error(line, "Bad number in line: {}".format(text))
+            if len(parts) != value_count:
+                raise self.error(
+                    line,
+                    "Expected {} values, got {}: {}".format(
+                        value_count, len(parts), text
+                    ),
+                )
+        raise ValueError("{}: Bad scene file".format(self.file_path))
+
+
+def compile_scene_text(
+    file_path: str, chunk_size: int = SCENE_PARSE_CHUNK_SIZE
+) -> CompiledScene:
+    """
+    Parse a scene text file straight into the arrays of a CompiledScene, without building
+    an object per line.
+    The file is streamed in chunks of about chunk_size bytes, whose lines are grouped by
+    record type, and every group is parsed into an array in a single NumPy pass.
+    """
+    with open(file_path, "rb") as f:
+        return compile_scene_stream(f, file_path, chunk_size)
+
+
+def compile_scene_stream(
+    f: BinaryIO, file_path: str, chunk_size: int = SCENE_PARSE_CHUNK_SIZE
+) -> CompiledScene:
+    """
+    Like compile_scene_text, but read the scene's text from a binary file object, like an
+    io.BytesIO of a scene that isn't in a file. The file_path only names it in errors.
+    """
+    tables = {name: [] for name in SCENE_ARRAYS}
+    camera = settings = None
+    material_count = 0
+    line_number = 1
+    remainder = b""
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            if not remainder:
+                break
+            data, remainder = remainder + b"\n", b""
+        else:
+            data = remainder + data
+            cut = data.rfind(b"\n") + 1
+            if cut == 0:
+                remainder = data
+                continue
+            data, remainder = data[:cut], data[cut:]
+
+        chunk = _SceneTextChunk(data, file_path, line_number)
+        line_number += data.count(b"\n")
+
+        lines, values = chunk.records(b"cam")
+        if len(lines) > 0:
+            camera = values[-1]
+        lines, values = chunk.records(b"set")
+        if len(lines) > 0:
+            settings = values[-1]
+
+        material_lines, values = chunk.records(b"mtl")
+        tables["material_diffuse_colors"].append(values[:, 0:3])
+        tables["material_specular_colors"].append(values[:, 3:6])
+        tables["material_reflection_colors"].append(values[:, 6:9])
+        tables["material_shininess"].append(values[:, 9])
+        tables["material_transparency"].append(values[:, 10])
+
+        surface_lines = []
+        for keyword, prefix, columns in (
+            (b"sph", "sphere", ("positions", "radii")),
+            (b"pln", "plane", ("normals", "offsets")),
+            (b"box", "cube", ("positions", "scales")),
+        ):
+            lines, values = chunk.records(keyword)
+            # Like the text parser, a surface can only use the materials defined before
+            # it, which are numbered from 1.
+            materials = values[:, 4].astype(np.int64)
+            defined = material_count + np.searchsorted(material_lines, lines)
+            bad = (materials < 1) | (materials > defined)
+            if np.any(bad):
+                line = lines[np.argmax(bad)]
+                raise chunk.error(
+                    line,
+                    "Undefined material index: {}".format(
+                        chunk.line_text(line).split()[5]
+                    ),
+                )
+            tables[f"{prefix}_{columns[0]}"].append(values[:, 0:3])
+            tables[f"{prefix}_{columns[1]}"].append(values[:, 3])
+            tables[f"{prefix}_materials"].append(materials - 1)
+            surface_lines.append(
+                (lines, np.full(len(lines), RECORD_SURFACE_KINDS[keyword]))
+            )
+        # The surfaces' kinds are kept in the order their lines appear in the file.
+        lines = np.concatenate([lines for lines, _ in surface_lines])
+        kinds = np.concatenate([kinds for _, kinds in surface_lines])
+        tables["surface_kinds"].append(kinds[np.argsort(lines, kind="stable")])
+
+        lines, values = chunk.records(b"lgt")
+        tables["light_positions"].append(values[:, 0:3])
+        tables["light_colors"].append(values[:, 3:6])
+        tables["light_specular_intensities"].append(values[:, 6])
+        tables["light_shadow_intensities"].append(values[:, 7])
+        tables["light_radii"].append(values[:, 8])
+
+        material_count += len(material_lines)
+
+    if camera is None or settings is None:
+        raise ValueError("{}: The scene has no camera or settings".format(file_path))
+    tables["version"] = [np.array([SCENE_CACHE_VERSION])]
+    tables["camera"] = [camera]
+    tables["settings"] = [settings]
+    arrays = {}
+    for name, (dtype, shape) in SCENE_ARRAYS.items():
+        parts = [np.asarray(part, dtype=dtype).reshape(shape) for part in tables[name]]
+        arrays[name] = (
+            np.concatenate(parts) if parts else np.empty((0,) + shape[1:], dtype=dtype)
+        )
+    return CompiledScene(arrays)
+
+
+def default_cache_path(file_path: str) -> str:
+    return file_path + SCENE_CACHE_SUFFIX
+
+
+def save_compiled_scene(scene: CompiledScene, cache_path: str) -> None:
+    """
+    Write the scene's arrays into the cache directory. The version is written last, so that
+    an interrupted write leaves a cache that isn't considered valid.
+    """
+    os.makedirs(cache_path, exist_ok=True)
+    version_path = os.path.join(cache_path, "version.npy")
+    if os.path.exists(version_path):
+        os.remove(version_path)
+    for name in SCENE_ARRAYS:
+        if name != "version":
+            np.save(os.path.join(cache_path, name + ".npy"), getattr(scene, name))
+    np.save(version_path, scene.version)
+
+
+def load_compiled_scene(cache_path: str) -> CompiledScene:
+    """
+    Load a compiled scene, memory mapping its arrays instead of reading them.
+    """
+    arrays = {}
+    for name in SCENE_ARRAYS:
+        array_path = os.path.join(cache_path, name + ".npy")
+        if not os.path.exists(array_path):
+            raise ValueError("{}: Not a compiled scene".format(cache_path))
+        # Empty arrays can't be memory mapped.
+        array = np.load(array_path, mmap_mode="r")
+        arrays[name] = array if array.size > 0 else np.load(array_path)
+    if int(arrays["version"][0]) != SCENE_CACHE_VERSION:
+        raise ValueError("{}: Unsupported compiled scene version".format(cache_path))
+    return CompiledScene(arrays)
+
+
+def is_cache_fresh(file_path: str, cache_path: str) -> bool:
+    """
+    Return True iff the cache was compiled with the current version, after the scene text
+    was last modified.
+    """
+    version_path = os.path.join(cache_path, "version.npy")
+    if not os.path.exists(version_path):
+        return False
+    if os.path.getmtime(version_path) < os.path.getmtime(file_path):
+        return False
+    return int(np.load(version_path)[0]) == SCENE_CACHE_VERSION
+
+
+def load_scene(
+    file_path: str, cache_path: Optional[str] = None, update_cache: bool = True
+) -> CompiledScene:
+    """
+    Return the compiled version of a scene text file, loaded from its cache if it's fresh,
+    and otherwise compiled from the text (and written to the cache, if update_cache is True).
+    A cache that can't be written, like one next to a read-only scene, is skipped with a
+    warning, and the scene compiled from the text is returned.
+    """
+    if cache_path is None:
+        cache_path = default_cache_path(file_path)
+    if is_cache_fresh(file_path, cache_path):
+        return load_compiled_scene(cache_path)
+    scene = compile_scene_text(file_path)
+    if update_cache:
+        try:
+            save_compiled_scene(scene, cache_path)
+        except OSError as e:
+            warnings.warn(
+                "Can't save the compiled scene to {}: {}".format(cache_path, e)
+            )
+            return scene
+        return load_compiled_scene(cache_path)
+    return scene
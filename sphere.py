@@ -1,15 +1,19 @@
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 import numpy as np
 
+import vector
 from base_surface import Material, Surface
 from ray import Ray
 
 
 class Sphere(Surface):
+    __slots__ = ("position", "radius")
+
     def __init__(self, position: List[int], radius: float, material: Material):
         super().__init__(material)
-        self.position = np.array(position)
+        # A row of a float64 array is kept as a view, see scene_cache.CompiledScene.
+        self.position = np.asarray(position, dtype=np.float64)
         self.radius = radius
 
     def intersect(self, ray: Ray) -> Optional[np.ndarray]:
@@ -34,6 +38,86 @@ class Sphere(Surface):
         t = max(t1, t2)
         return ray.at(t) if t >= 0 else None
 
+    @classmethod
+    def stack_parameters(cls, surfaces: List["Sphere"]) -> Tuple[np.ndarray, ...]:
+        positions = np.array([sphere.position for sphere in surfaces]).reshape(-1, 3)
+        radii = np.array([sphere.radius for sphere in surfaces], dtype=np.float64)
+        return positions, radii
+
+    @classmethod
+    def unstack_parameters(
+        cls, parameters: Tuple[np.ndarray, ...], materials: List[Material]
+    ) -> List["Sphere"]:
+        positions, radii = parameters
+        return [
+            cls(position, radius, material)
+            for position, radius, material in zip(positions, radii.tolist(), materials)
+        ]
+
+    @staticmethod
+    def stacked_bounding_boxes(
+        parameters: Tuple[np.ndarray, ...],
+    ) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        positions, radii = parameters
+        return positions - radii[:, np.newaxis], positions + radii[:, np.newaxis]
+
+    @staticmethod
+    def intersect_stacked(
+        parameters: Tuple[np.ndarray, ...],
+        sources: np.ndarray,
+        directions: np.ndarray,
+    ) -> np.ndarray:
+        hit, t1, t2 = Sphere._stacked_roots(parameters, sources, directions)
+        # Since a > 0, t1 <= t2, so t1 is the closer intersection whenever it's in front of
+        # the ray's source.
+        t = np.where(t1 >= 0, t1, t2)
+        return np.where(hit & (t >= 0), t, np.inf)
+
+    @classmethod
+    def intersect_stacked_all(
+        cls,
+        parameters: Tuple[np.ndarray, ...],
+        sources: np.ndarray,
+        directions: np.ndarray,
+    ) -> np.ndarray:
+        hit, t1, t2 = Sphere._stacked_roots(parameters, sources, directions)
+        t = np.stack([t1, t2], axis=2)
+        return np.where(hit[:, :, np.newaxis] & (t >= 0), t, np.inf)
+
+    @staticmethod
+    def _stacked_roots(
+        parameters: Tuple[np.ndarray, ...],
+        sources: np.ndarray,
+        directions: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Return (N, S) arrays of whether every ray's line hits every sphere, and of the
+        smaller and larger roots of the intersection equation.
+        """
+        positions, radii = parameters
+        oc = sources[:, np.newaxis, :] - positions[np.newaxis, :, :]
+        a = vector.dot_rows(directions, directions)[:, np.newaxis]
+        b = 2.0 * np.einsum("nsk,nk->ns", oc, directions)
+        c = np.einsum("nsk,nsk->ns", oc, oc) - radii**2
+
+        discriminant = b**2 - 4 * a * c
+        hit = discriminant >= 0
+        sqrt_discriminant = np.sqrt(np.where(hit, discriminant, 0.0))
+        t1 = (-b - sqrt_discriminant) / (2 * a)
+        t2 = (-b + sqrt_discriminant) / (2 * a)
+        return hit, t1, t2
+
     def normal_at_point(self, point: np.ndarray, ray_vec: np.ndarray) -> np.ndarray:
         normal = point - self.position
         return normal / np.linalg.norm(normal)
+
+    @staticmethod
+    def stacked_normals_at_points(
+        parameters: Tuple[np.ndarray, ...],
+        rows: np.ndarray,
+        points: np.ndarray,
+        ray_vecs: np.ndarray,
+        faces: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        positions, _ = parameters
+        return vector.normalize_rows(points - positions[rows])
@@ -0,0 +1,120 @@
+import functools
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional
+
+# The statistics collected in this process, or None when they're disabled.
+# The instrumented functions check it on every call, so disabled statistics cost one global
+# lookup, and the counting and timing only happens when they're enabled.
+_active: Optional["RenderStatistics"] = None
+# The callbacks called with the statistics as the rendering progresses, see add_hook.
+_hooks: List[Callable[[str, "RenderStatistics"], None]] = []
+
+
+class RenderStatistics:
+    """
+    Counters and timers of a render.
+    The counters are named by dotted paths, like "rays.shadow" for the number of shadow rays
+    cast, or "tests.Sphere" for the number of ray-sphere intersection tests. The timers add up
+    the seconds spent in the instrumented functions. Timers of nested functions overlap:
+    the time of "shadows" is also a part of "shading".
+    """
+
+    def __init__(self):
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.timers: Dict[str, float] = defaultdict(float)
+
+    def merge(self, other: "RenderStatistics") -> None:
+        for name, value in other.counters.items():
+            self.counters[name] += value
+        for name, value in other.timers.items():
+            self.timers[name] += value
+
+    def as_dict(self) -> Dict[str, Dict[str, float]]:
+        return {
+            "counters": dict(sorted(self.counters.items())),
+            "timers": dict(sorted(self.timers.items())),
+        }
+
+    def format_table(self) -> str:
+        rows = [(name, f"{value}") for name, value in sorted(self.counters.items())]
+        rows += [(name, f"{value:.3f}s") for name, value in sorted(self.timers.items())]
+        if not rows:
+            return ""
+        name_width = max(len(name) for name, _ in rows)
+        value_width = max(len(value) for _, value in rows)
+        return "\n".join(
+            f"{name:<{name_width}}  {value:>{value_width}}" for name, value in rows
+        )
+
+
+def enable(statistics: Optional[RenderStatistics] = None) -> RenderStatistics:
+    """
+    Start collecting statistics in this process, into the given statistics or new ones,
+    and return them.
+    """
+    global _active
+    _active = RenderStatistics() if statistics is None else statistics
+    return _active
+
+
+def disable() -> Optional[RenderStatistics]:
+    """
+    Stop collecting statistics, and return the statistics that were collected, if any.
+    """
+    global _active
+    statistics, _active = _active, None
+    return statistics
+
+
+def active() -> Optional[RenderStatistics]:
+    return _active
+
+
+def count(name: str, amount: int = 1) -> None:
+    if _active is not None:
+        _active.counters[name] += amount
+
+
+def timed(name: str) -> Callable:
+    """
+    A decorator that adds the time spent in the function to the timer of the given name,
+    while statistics are enabled.
+    """
+
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return function(*args, **kwargs)
+            statistics = _active
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                statistics.timers[name] += time.perf_counter() - start
+
+        return wrapper
+
+    return decorator
+
+
+def add_hook(hook: Callable[[str, RenderStatistics], None]) -> None:
+    """
+    Register a callback to be called with an event name and the statistics collected so
+    far: "tile" after every rendered tile, and "render" when a render is done.
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook: Callable[[str, RenderStatistics], None]) -> None:
+    _hooks.remove(hook)
+
+
+def notify(event: str) -> None:
+    """
+    Call the hooks with the given event, if statistics are enabled.
+    """
+    if _active is not None:
+        for hook in _hooks:
+            hook(event, _active)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The ray tracer's modules live at the repository's root, next to ray_tracer.py.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
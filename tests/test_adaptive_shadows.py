@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from base_surface import SurfaceGroups
+from light import Light
+from material import Material
+from sampling import SHADOW_SAMPLING_HALTON
+from sphere import Sphere
+
+ROOT = 4
+SHADOW_INTENSITY = 0.8
+
+
+@pytest.fixture
+def scene():
+    # A light of radius 1 above the origin, and a sphere between them that hides the light
+    # from the points right below it, and half of it from the points below its edge.
+    light = Light([0, 10, 0], [1, 1, 1], 1, SHADOW_INTENSITY, 1)
+    material = Material([1, 1, 1], [1, 1, 1], [0, 0, 0], 10, 0)
+    surfaces = SurfaceGroups([Sphere([0, 5, 0], 1, material)])
+    return light, surfaces
+
+
+def intensities(light, surfaces, points, adaptive):
+    sample_counts = np.zeros(len(points))
+    result = light.calculate_intensity_many(
+        surfaces,
+        ROOT,
+        np.array(points, dtype=np.float64),
+        adaptive=adaptive,
+        sample_counts=sample_counts,
+        sampling=SHADOW_SAMPLING_HALTON,
+        sample_indices=np.arange(len(points)),
+    )
+    return result, sample_counts
+
+
+@pytest.mark.parametrize("root, count", [(2, 4), (3, 5), (4, 5), (5, 5), (8, 17)])
+def test_initial_cells_are_spread_over_the_grid(root, count):
+    cells = Light._initial_adaptive_cells(root)
+    assert len(cells) == count
+    corners = {0, root - 1, root * (root - 1), root * root - 1}
+    center = (root // 2) * root + root // 2
+    assert corners | {center} <= set(cells.tolist())
+
+
+def test_lit_and_shadowed_points_stop_early(scene):
+    light, surfaces = scene
+    result, sample_counts = intensities(light, surfaces, [[5, 0, 0], [0, 0, 0]], True)
+    initial = len(Light._initial_adaptive_cells(ROOT))
+    assert initial < ROOT * ROOT
+    assert np.array_equal(sample_counts, [initial, initial])
+    np.testing.assert_allclose(result, [1.0, 1.0 - SHADOW_INTENSITY])
+
+
+def test_penumbra_points_match_the_full_grid(scene):
+    light, surfaces = scene
+    # The sphere's silhouette, as seen from the light, passes over these points.
+    points = [[x, 0, 0] for x in np.linspace(1.7, 2.3, 7)]
+    adaptive, sample_counts = intensities(light, surfaces, points, True)
+    full, full_counts = intensities(light, surfaces, points, False)
+    assert np.all(full_counts == ROOT * ROOT)
+    # Points whose first samples disagree are sampled like the full grid, and the others
+    # are taken as fully lit or fully shadowed.
+    refined = sample_counts == ROOT * ROOT
+    assert np.sum(refined) >= 3
+    np.testing.assert_allclose(adaptive[refined], full[refined])
+    assert np.all(np.isin(adaptive[~refined], [1.0, 1.0 - SHADOW_INTENSITY]))
@@ -0,0 +1,124 @@
+import contextlib
+import io
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from animation import CameraPath, frame_path, parse_camera_path
+from camera import Camera
+from ray_tracer import RayTracer
+from scene import parse_scene_file
+from tiles import stream_frames
+
+SCENE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "scenes", "pool.txt")
+HEIGHT, WIDTH = 24, 36
+
+
+def camera(x, distance=1.0, width=2.0):
+    return Camera([x, 1.0, -10.0], [x, 0.0, 0.0], [0.0, 1.0, 0.0], distance, width)
+
+
+def load():
+    camera, scene_settings, surfaces, lights = parse_scene_file(SCENE)
+    scene_settings.root_number_shadow_rays = 2
+    return RayTracer(camera, scene_settings, surfaces, lights)
+
+
+def test_cameras_are_interpolated_between_keyframes():
+    path = CameraPath([(4, camera(4.0, 3.0)), (0, camera(0.0, 1.0))])
+    assert path.frame_count == 5
+    middle = path.camera_at(1)
+    np.testing.assert_allclose(middle.position, [1.0, 1.0, -10.0])
+    np.testing.assert_allclose(middle.look_at, [1.0, 0.0, 0.0])
+    assert middle.screen_distance == pytest.approx(1.5)
+    # The frames after the last keyframe keep its camera.
+    cameras = path.cameras(7)
+    assert len(cameras) == 7
+    np.testing.assert_allclose(cameras[6].position, [4.0, 1.0, -10.0])
+    np.testing.assert_allclose(cameras[0].position, [0.0, 1.0, -10.0])
+
+
+@pytest.mark.parametrize(
+    "keyframes, message",
+    [
+        ([], "at least one keyframe"),
+        ([(1, camera(0.0))], "first keyframe must be frame 0"),
+        ([(0, camera(0.0)), (0, camera(1.0))], "two keyframes of the same frame"),
+    ],
+)
+def test_bad_camera_paths(keyframes, message):
+    with pytest.raises(ValueError, match=message):
+        CameraPath(keyframes)
+
+
+def test_parse_camera_path(tmp_path):
+    path_file = tmp_path / "path.txt"
+    path_file.write_text(
+        "# A comment\n"
+        "key 0 0 1 -10 0 0 0 0 1 0\n"
+        "\n"
+        "key 2 2 1 -10 2 0 0 0 1 0 3 4\n"
+    )
+    path = parse_camera_path(str(path_file), camera(0.0, 1.5, 2.5))
+    assert path.frame_count == 3
+    first, last = path.keyframes[0][1], path.keyframes[1][1]
+    # Keyframes without a screen keep the given camera's.
+    assert (first.screen_distance, first.screen_width) == (1.5, 2.5)
+    assert (last.screen_distance, last.screen_width) == (3, 4)
+    np.testing.assert_allclose(path.camera_at(1).position, [1.0, 1.0, -10.0])
+
+
+@pytest.mark.parametrize(
+    "line, message",
+    [("cam 0 0 0 0 0 1 0 1 0 1 1", "Unknown object type"), ("key 0 1 2", "10 or 12")],
+)
+def test_parse_bad_camera_paths(tmp_path, line, message):
+    path_file = tmp_path / "path.txt"
+    path_file.write_text(line + "\n")
+    with pytest.raises(ValueError, match=message):
+        parse_camera_path(str(path_file), camera(0.0))
+
+
+def test_frame_path():
+    assert frame_path("frames/{frame:04d}.png", 7) == "frames/0007.png"
+    assert frame_path("frames/fly.png", 7) == "frames/fly_0007.png"
+
+
+@pytest.fixture(scope="module")
+def cameras():
+    return CameraPath([(0, camera(-1.0)), (2, camera(1.0))]).cameras(3)
+
+
+@pytest.fixture(scope="module")
+def standalone_frames(cameras):
+    frames = []
+    for frame_camera in cameras:
+        tracer = load()
+        tracer.set_camera(frame_camera)
+        img_mat = np.zeros((HEIGHT, WIDTH, 3))
+        with contextlib.redirect_stdout(io.StringIO()):
+            tracer.ray_trace_tiles(img_mat, seed=3)
+        frames.append(img_mat)
+    return frames
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_streamed_frames_match_standalone_renders(cameras, standalone_frames, workers):
+    with contextlib.redirect_stdout(io.StringIO()):
+        frames = list(stream_frames(load(), cameras, HEIGHT, WIDTH, workers, seed=3))
+    assert [frame for frame, _ in frames] == [0, 1, 2]
+    for (_, img_mat), expected in zip(frames, standalone_frames):
+        np.testing.assert_array_equal(img_mat, expected)
+    assert not np.array_equal(frames[0][1], frames[2][1])
+
+
+def test_animation_saves_every_frame(tmp_path, cameras, standalone_frames):
+    with contextlib.redirect_stdout(io.StringIO()):
+        load().ray_trace_animation(
+            cameras, HEIGHT, WIDTH, str(tmp_path / "{frame}.png"), seed=3
+        )
+    for frame, expected in enumerate(standalone_frames):
+        image = np.asarray(Image.open(tmp_path / f"{frame}.png"))
+        assert np.array_equal(image, np.uint8(expected))
@@ -0,0 +1,77 @@
+import contextlib
+import io
+import os
+
+import numpy as np
+
+from antialiasing import edge_scores, select_pixels, stratified_pixel_offsets
+from ray_tracer import RayTracer
+from scene import parse_scene_file
+
+SCENE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "scenes", "pool.txt")
+HEIGHT, WIDTH = 24, 30
+
+
+def render_antialiased(**kwargs):
+    camera, scene_settings, surfaces, lights = parse_scene_file(SCENE)
+    scene_settings.root_number_shadow_rays = 2
+    tracer = RayTracer(camera, scene_settings, surfaces, lights)
+    img_mat = np.zeros((HEIGHT, WIDTH, 3))
+    shadow_sample_map = np.zeros((HEIGHT, WIDTH))
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        refined = tracer.ray_trace_antialiased(
+            img_mat, seed=2, shadow_sample_map=shadow_sample_map, **kwargs
+        )
+    return img_mat, shadow_sample_map, refined, output.getvalue()
+
+
+def test_edge_scores():
+    img_mat = np.zeros((3, 4, 3))
+    img_mat[:, 2:] = 255 * 0.5
+    surface_indices = np.zeros((3, 4), dtype=int)
+    surface_indices[2] = 1
+    scores = edge_scores(img_mat, surface_indices)
+    # The color edge between columns 1 and 2, and the surface edge between rows 1 and 2.
+    assert np.allclose(scores[0], [0, 0.5, 0.5, 0])
+    assert np.allclose(scores[1], [1, 1, 1, 1])
+    assert np.allclose(scores[2], [1, 1, 1, 1])
+
+
+def test_select_pixels_keeps_the_highest_scores():
+    scores = np.array([[0.1, 0.9, 0.5], [0.7, 0.0, 0.3]])
+    assert np.array_equal(select_pixels(scores, 0.2, 10), [1, 2, 3, 5])
+    assert np.array_equal(select_pixels(scores, 0.2, 2), [1, 3])
+    assert len(select_pixels(scores, 1, 10)) == 0
+
+
+def test_stratified_pixel_offsets_cover_the_pixel():
+    offsets = stratified_pixel_offsets(np.random.default_rng(0), 5, 3)
+    assert offsets.shape == (5, 9, 2)
+    cells = np.floor((offsets + 0.5) * 3).astype(int)
+    for pixel_cells in cells:
+        assert len({tuple(cell) for cell in pixel_cells}) == 9
+
+
+def test_nothing_to_refine():
+    plain, plain_samples, refined, _ = render_antialiased(budget=0)
+    assert refined == 0
+    image, samples, refined, output = render_antialiased(threshold=100)
+    assert refined == 0
+    assert "Refining" not in output
+    assert np.array_equal(image, plain)
+    assert np.array_equal(samples, plain_samples)
+
+
+def test_refined_pixels_are_within_the_budget():
+    plain, plain_samples, _, _ = render_antialiased(budget=0)
+    budget = 0.5
+    image, samples, refined, _ = render_antialiased(
+        threshold=0.05, budget=budget, root_number_samples=2
+    )
+    assert 0 < refined <= budget * HEIGHT * WIDTH / 4
+    # The first pass is the same, so only the refined pixels change.
+    changed = np.any(image != plain, axis=2)
+    assert 0 < np.count_nonzero(changed) <= refined
+    assert np.array_equal(samples[~changed], plain_samples[~changed])
+    assert np.all(samples >= plain_samples)
@@ -0,0 +1,56 @@
+import numpy as np
+from PIL import Image
+
+from benchmark import compare, render_case, save_images
+
+
+def results(rays_per_second, calls_per_second=1000.0):
+    return {
+        "scenes": [{"name": "pool_8_1", "rays_per_second": rays_per_second}],
+        "microbenchmarks": [
+            {"name": "intersect", "calls_per_second": calls_per_second}
+        ],
+    }
+
+
+def test_slowdowns_beyond_the_tolerance_are_regressions():
+    baseline = results(100.0)
+    assert compare(results(95.0), {}, baseline, 0.1, 1) == []
+    regressions = compare(results(80.0, 500.0), {}, baseline, 0.1, 1)
+    assert regressions == [
+        "pool_8_1: rays_per_second dropped to 80.0% of the baseline",
+        "intersect: calls_per_second dropped to 50.0% of the baseline",
+    ]
+
+
+def test_cases_missing_from_the_baseline_are_skipped():
+    baseline = {"scenes": [], "microbenchmarks": []}
+    assert compare(results(1.0, 1.0), {}, baseline, 0.1, 1) == []
+
+
+def test_images_are_compared_with_the_baseline(tmp_path):
+    image = np.full((4, 4, 3), 100, dtype=np.uint8)
+    save_images({"same": image, "changed": image, "resized": image}, str(tmp_path))
+    baseline = {**results(100.0), "image_dir": str(tmp_path)}
+    changed = image.copy()
+    changed[0, 0] = 103
+    images = {
+        "same": image + 1,
+        "changed": changed,
+        "resized": np.zeros((2, 2, 3), dtype=np.uint8),
+        "new": image,
+    }
+    assert compare(results(100.0), images, baseline, 0.1, 1) == [
+        "changed: the image differs from the baseline by up to 3 levels, in 6.25% of "
+        "the pixels",
+        "resized: the image's shape changed",
+    ]
+    assert np.array_equal(np.asarray(Image.open(tmp_path / "same.png")), image)
+
+
+def test_render_cases_are_reproducible():
+    first_counts, first_image = render_case("pool", 8, 2, seed=3)
+    second_counts, second_image = render_case("pool", 8, 2, seed=3)
+    assert np.array_equal(first_image, second_image)
+    assert first_counts["primary_rays"] == 64
+    assert first_counts["shadow_rays"] == second_counts["shadow_rays"] > 0
@@ -0,0 +1,112 @@
+import contextlib
+import io
+import os
+
+import numpy as np
+import pytest
+
+from checkpoint import RenderCheckpoint, checkpoint_key
+from progressbar import progressbar
+from ray_tracer import RayTracer
+from scene import parse_scene_file
+from tiles import morton_order, render_tiles, split_into_tiles
+
+SCENE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "scenes", "pool.txt")
+HEIGHT, WIDTH = 40, 48
+TILES = morton_order(split_into_tiles(HEIGHT, WIDTH))
+KEY = checkpoint_key(SCENE, {"height": HEIGHT, "width": WIDTH})
+
+
+def load():
+    camera, scene_settings, surfaces, lights = parse_scene_file(SCENE)
+    scene_settings.root_number_shadow_rays = 2
+    return RayTracer(camera, scene_settings, surfaces, lights)
+
+
+def render(tracer, checkpoint=None, workers=1):
+    img_mat = np.zeros((HEIGHT, WIDTH, 3))
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracer.ray_trace_tiles(img_mat, workers, seed=5, checkpoint=checkpoint)
+    return img_mat
+
+
+def open_checkpoint(path, resume=True):
+    return RenderCheckpoint.open(path, KEY, HEIGHT, WIDTH, len(TILES), resume)
+
+
+def interrupted_checkpoint(path):
+    # Render the first half of the tiles only, like a render killed half way.
+    checkpoint = open_checkpoint(path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        render_tiles(
+            load(),
+            np.zeros((HEIGHT, WIDTH, 3)),
+            TILES[: len(TILES) // 2],
+            seed=5,
+            on_tile_rendered=checkpoint.tile_rendered,
+            shadow_sample_map=checkpoint.shadow_sample_map,
+        )
+    checkpoint.save()
+    return checkpoint
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_resumed_render_matches_an_uninterrupted_one(tmp_path, workers):
+    path = str(tmp_path / "render.checkpoint")
+    interrupted_checkpoint(path)
+    checkpoint = open_checkpoint(path)
+    assert len(checkpoint.pending(TILES)) == len(TILES) - len(TILES) // 2
+    assert np.array_equal(render(load(), checkpoint, workers), render(load()))
+    assert checkpoint.done.all()
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_resuming_a_finished_checkpoint_renders_nothing(tmp_path, workers):
+    path = str(tmp_path / "render.checkpoint")
+    expected = render(load(), open_checkpoint(path))
+    checkpoint = open_checkpoint(path)
+    assert checkpoint.pending(TILES) == []
+
+    tracer = load()
+
+    def render_tile(*args):
+        raise AssertionError("A finished tile was rendered again")
+
+    tracer.render_tile = render_tile
+    assert np.array_equal(render(tracer, checkpoint, workers), expected)
+
+
+def test_checkpoint_of_another_render_is_started_over(tmp_path):
+    path = str(tmp_path / "render.checkpoint")
+    interrupted_checkpoint(path)
+    other = RenderCheckpoint.open(path, KEY + "0", HEIGHT, WIDTH, len(TILES))
+    assert not other.done.any()
+    assert not open_checkpoint(path).done.any()
+
+
+def test_remove_keeps_other_files(tmp_path):
+    path = str(tmp_path / "render.checkpoint")
+    checkpoint = interrupted_checkpoint(path)
+    # Like an output image saved into the checkpoint's directory.
+    with open(os.path.join(path, "out.png"), "w") as f:
+        f.write("image")
+    checkpoint.remove()
+    assert os.listdir(path) == ["out.png"]
+
+    checkpoint = open_checkpoint(str(tmp_path / "other.checkpoint"))
+    checkpoint.remove()
+    assert not os.path.exists(tmp_path / "other.checkpoint")
+
+
+def test_directory_with_other_files_is_refused(tmp_path):
+    with open(tmp_path / "notes.txt", "w") as f:
+        f.write("keep")
+    with pytest.raises(ValueError, match="notes.txt"):
+        open_checkpoint(str(tmp_path))
+    assert os.listdir(tmp_path) == ["notes.txt"]
+
+
+def test_progressbar_of_nothing():
+    out = io.StringIO()
+    assert list(progressbar([], prefix="Computing: ", out=out)) == []
+    assert "0/0" in out.getvalue()
@@ -0,0 +1,125 @@
+import contextlib
+import io
+
+import numpy as np
+import pytest
+
+from base_surface import get_closest_hit, hit_faces, normals_at_points
+from camera import Camera
+from cube import NORMALS, Cube
+from material import Material
+from ray import Ray
+from ray_tracer import RayTracer
+from scene import SceneSettings
+from sphere import Sphere
+
+MATERIAL = Material([1, 1, 1], [1, 1, 1], [0, 0, 0], 10, 0)
+CUBE = Cube([1.0, 2.0, 3.0], 2.0, MATERIAL)
+
+
+def rays_at_faces(rng, count, edge_distance):
+    """
+    Return the expected faces, sources and directions of rays that hit CUBE's faces from
+    outside, at the given distance from one of the faces' edges.
+    """
+    faces = rng.integers(0, len(NORMALS), count)
+    points = CUBE.position + rng.uniform(-0.9, 0.9, (count, 3))
+    axes = faces // 2
+    others = (axes + rng.integers(1, 3, count)) % 3
+    rows = np.arange(count)
+    points[rows, axes] = CUBE.position[axes] + NORMALS[faces, axes]
+    points[rows, others] = CUBE.position[others] + (1 - edge_distance) * np.sign(
+        points[rows, others] - CUBE.position[others]
+    )
+    # Directions into the face, leaning towards the edge.
+    directions = -NORMALS[faces] + rng.uniform(-0.5, 0.5, (count, 3)) * (
+        1 - np.abs(NORMALS[faces])
+    )
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    sources = points - rng.uniform(1, 5, (count, 1)) * directions
+    return faces, sources, directions
+
+
+@pytest.mark.parametrize("edge_distance", [0.5, 1e-6, 1e-9])
+def test_hit_faces_come_from_the_slab_test(edge_distance):
+    faces, sources, directions = rays_at_faces(
+        np.random.default_rng(0), 200, edge_distance
+    )
+    parameters = Cube.stack_parameters([CUBE])
+    t = Cube.intersect_stacked(parameters, sources, directions)[:, 0]
+    assert np.all(np.isfinite(t))
+    rows = np.zeros(len(faces), dtype=np.int64)
+    assert np.array_equal(
+        Cube.stacked_hit_faces(parameters, rows, sources, directions), faces
+    )
+    for face, source, direction, ray_t in zip(faces, sources, directions, t):
+        hit = CUBE.hit_record(Ray(source, direction), ray_t, 7)
+        assert hit.face == face
+        assert np.array_equal(hit.normal, NORMALS[face])
+        assert hit.index == 7 and hit.t == ray_t
+
+
+def test_rays_from_inside_hit_the_faces_they_leave():
+    rng = np.random.default_rng(1)
+    sources = CUBE.position + rng.uniform(-0.9, 0.9, (100, 3))
+    directions = rng.normal(size=(100, 3))
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    parameters = Cube.stack_parameters([CUBE])
+    t = Cube.intersect_stacked(parameters, sources, directions)[:, 0]
+    points = sources + t[:, np.newaxis] * directions
+    faces = Cube.stacked_hit_faces(
+        parameters, np.zeros(100, dtype=np.int64), sources, directions
+    )
+    axes = faces // 2
+    rows = np.arange(100)
+    # The points are on the faces' planes, and the faces' normals point away from the
+    # sources.
+    np.testing.assert_allclose(
+        points[rows, axes], CUBE.position[axes] + NORMALS[faces, axes], atol=1e-12
+    )
+    assert np.all(np.einsum("ij,ij->i", NORMALS[faces], directions) > 0)
+
+
+def test_axis_parallel_rays():
+    sources = np.array([[-5.0, 2.5, 3.5], [1.5, 2.5, 10.0], [1.0, 2.0, 3.0]])
+    directions = np.array([[1.0, 0.0, 0.0], [0.0, 0.0, -1.0], [0.0, -1.0, 0.0]])
+    faces = Cube.stacked_hit_faces(
+        Cube.stack_parameters([CUBE]), np.zeros(3, dtype=np.int64), sources, directions
+    )
+    assert np.array_equal(faces, [1, 4, 3])
+
+
+def test_batched_hits_have_faces():
+    sphere = Sphere([10.0, 0.0, 0.0], 1.0, MATERIAL)
+    surfaces = [sphere, CUBE]
+    faces, sources, directions = rays_at_faces(np.random.default_rng(2), 50, 1e-6)
+    sources = np.concatenate([sources, [[10.0, 0.0, -5.0]]])
+    directions = np.concatenate([directions, [[0.0, 0.0, 1.0]]])
+    surface_indices = np.array([1] * 50 + [0])
+    found = hit_faces(surfaces, surface_indices, sources, directions)
+    assert np.array_equal(found, np.append(faces, -1))
+    for i in (0, 50):
+        hit = get_closest_hit(Ray(sources[i], directions[i]), surfaces)
+        assert hit.index == surface_indices[i] and hit.face == found[i]
+        points = sources[i : i + 1] + hit.t * directions[i : i + 1]
+        np.testing.assert_allclose(
+            normals_at_points(
+                surfaces,
+                surface_indices[i : i + 1],
+                points,
+                directions[i : i + 1],
+                found[i : i + 1],
+            )[0],
+            hit.normal,
+        )
+
+
+def test_g_buffer_normals_come_from_the_hit_faces():
+    camera = Camera([1.0, 2.0, -10.0], [1.0, 2.0, 3.0], [0.0, 1.0, 0.0], 1.0, 1.0)
+    tracer = RayTracer(camera, SceneSettings([0, 0, 0], 1, 1), [CUBE], [])
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracer.use_gbuffer(20, 20)
+    gbuffer = tracer.gbuffer
+    hit = gbuffer.surface_indices != -1
+    assert hit.any()
+    assert np.all(gbuffer.normals[hit] == NORMALS[5])
@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+
+import frustum
+from base_surface import get_closest_surfaces
+from camera import Camera
+from cube import Cube
+from infinite_plane import InfinitePlane
+from material import Material
+from ray_tracer import RayTracer
+from scene import SceneSettings
+from sphere import Sphere
+
+HEIGHT, WIDTH = 40, 48
+
+
+def make_tracer(use_bvh):
+    rng = np.random.default_rng(1)
+    material = Material([1, 1, 1], [1, 1, 1], [0, 0, 0], 10, 0)
+    surfaces = [InfinitePlane([0, 1, 0], -2, material)]
+    for position in rng.uniform([-6, -2, 4], [6, 4, 20], (300, 3)):
+        surfaces.append(Sphere(list(position), rng.uniform(0.1, 0.6), material))
+    for position in rng.uniform([-6, -2, 4], [6, 4, 20], (100, 3)):
+        surfaces.append(Cube(list(position), rng.uniform(0.1, 0.6), material))
+    camera = Camera([0.0, 0.0, 0.0], [0.0, 0.0, 1.0], [0.0, 1.0, 0.0], 1.0, 1.0)
+    return RayTracer(
+        camera,
+        SceneSettings([0, 0, 0], 1, 1),
+        surfaces,
+        [],
+        use_bvh=use_bvh,
+        frustum_culling=True,
+    )
+
+
+def primary_rays(tracer):
+    rows, cols = np.divmod(np.arange(HEIGHT * WIDTH), WIDTH)
+    # Jittered, like the anti-aliasing's sub-pixel rays.
+    offsets = np.random.default_rng(2).uniform(-0.5, 0.5, (2, HEIGHT * WIDTH))
+    rows = rows + offsets[0]
+    cols = cols + offsets[1]
+    sources, directions = tracer.construct_rays_through_pixels(
+        HEIGHT, WIDTH, rows, cols
+    )
+    packets = frustum.pixel_packets(tracer, HEIGHT, WIDTH, rows, cols)
+    return np.broadcast_to(sources, directions.shape), directions, packets
+
+
+@pytest.mark.parametrize("use_bvh", [False, True])
+@pytest.mark.parametrize("packets_per_chunk", [1, 4, 1000])
+@pytest.mark.parametrize("batch_size", [1 << 22, 1 << 10])
+def test_packets_find_the_closest_surfaces(
+    monkeypatch, use_bvh, packets_per_chunk, batch_size
+):
+    monkeypatch.setattr(frustum, "FRUSTUM_PACKETS_PER_CHUNK", packets_per_chunk)
+    monkeypatch.setattr(frustum, "INTERSECTION_BATCH_SIZE", batch_size)
+    tracer = make_tracer(use_bvh)
+    assert (tracer.surfaces.bvh is not None) == use_bvh
+    sources, directions, packets = primary_rays(tracer)
+    indices, t = frustum.get_closest_surfaces_in_packets(
+        sources, directions, tracer.surfaces, packets
+    )
+    expected_indices, expected_t = get_closest_surfaces(
+        sources, directions, make_tracer(False).surfaces
+    )
+    assert np.array_equal(indices, expected_indices)
+    np.testing.assert_allclose(t, expected_t, rtol=1e-12)
+    assert len(np.unique(indices)) > 50
+
+
+def test_packets_skip_the_rays_that_are_not_candidates():
+    tracer = make_tracer(False)
+    sources, directions, packets = primary_rays(tracer)
+    group_type, group_indices, parameters = next(
+        group for group in tracer.surfaces.groups if group[0] is Sphere
+    )
+    candidates = np.random.default_rng(3).random(len(sources)) < 0.5
+    closest_indices = np.full(len(sources), -1)
+    min_t = np.full(len(sources), np.inf)
+    tests = packets.update_closest_surfaces(
+        group_type,
+        parameters,
+        group_indices,
+        sources,
+        directions,
+        closest_indices,
+        min_t,
+        candidates=candidates,
+    )
+    assert 0 < tests < candidates.sum() * len(group_indices)
+    assert np.all(closest_indices[~candidates] == -1)
+    t = group_type.intersect_stacked(
+        parameters, sources[candidates], directions[candidates]
+    )
+    np.testing.assert_allclose(min_t[candidates], t.min(axis=1), rtol=1e-12)
+
+
+def test_packet_rays():
+    tracer = make_tracer(False)
+    _, _, packets = primary_rays(tracer)
+    rays, owners = packets._packet_rays(np.array([3, 0]))
+    assert np.array_equal(
+        rays, np.concatenate([packets.rays(np.array([p])) for p in (3, 0)])
+    )
+    assert np.array_equal(
+        owners, np.repeat([0, 1], [len(packets.rays(np.array([p]))) for p in (3, 0)])
+    )
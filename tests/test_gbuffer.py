@@ -0,0 +1,81 @@
+import contextlib
+import io
+import os
+
+import numpy as np
+import pytest
+
+import gbuffer
+from gbuffer import gbuffer_key
+from ray_tracer import RayTracer
+from scene import parse_scene_file
+
+SCENE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "scenes", "pool.txt")
+SIZE = 12
+
+
+def load():
+    camera, scene_settings, surfaces, lights = parse_scene_file(SCENE)
+    scene_settings.root_number_shadow_rays = 1
+    return RayTracer(camera, scene_settings, surfaces, lights)
+
+
+def render(tracer):
+    img_mat = np.zeros((SIZE, SIZE, 3))
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracer.ray_trace_wavefront(img_mat)
+    return img_mat
+
+
+def test_gbuffer_renders_the_same_image(tmp_path):
+    expected = render(load())
+    tracer = load()
+    tracer.use_gbuffer(SIZE, SIZE, str(tmp_path))
+    np.testing.assert_allclose(render(tracer), expected, atol=1e-9)
+
+
+def test_gbuffer_is_loaded_from_the_cache(tmp_path, monkeypatch):
+    first = load()
+    first.use_gbuffer(SIZE, SIZE, str(tmp_path))
+    assert [name for name in os.listdir(tmp_path) if ".tmp" in name] == []
+    assert len(os.listdir(tmp_path)) == 1
+
+    def compute_gbuffer(*args):
+        raise AssertionError("The cached G-buffer wasn't used")
+
+    monkeypatch.setattr(gbuffer, "compute_gbuffer", compute_gbuffer)
+    # Only the lights and materials changed, so the primary hits are reused.
+    relit = load()
+    for light in relit.lights:
+        light.color = light.color * 0.5
+    relit.surfaces.materials.diffuse_colors[:] = 0.3
+    relit.use_gbuffer(SIZE, SIZE, str(tmp_path))
+    np.testing.assert_array_equal(
+        relit.gbuffer.surface_indices, first.gbuffer.surface_indices
+    )
+    np.testing.assert_array_equal(relit.gbuffer.positions, first.gbuffer.positions)
+
+
+def test_gbuffer_key_depends_on_the_camera_size_and_geometry():
+    tracer = load()
+    key = gbuffer_key(tracer.camera, tracer.surfaces, SIZE, SIZE)
+    assert gbuffer_key(tracer.camera, tracer.surfaces, SIZE, SIZE) == key
+    assert gbuffer_key(tracer.camera, tracer.surfaces, SIZE, SIZE + 1) != key
+
+    camera, _, surfaces, _ = parse_scene_file(SCENE)
+    camera.position = camera.position + 0.5
+    moved_camera = RayTracer(camera, tracer.scene_settings, surfaces, tracer.lights)
+    assert gbuffer_key(moved_camera.camera, moved_camera.surfaces, SIZE, SIZE) != key
+
+    _, _, surfaces, _ = parse_scene_file(SCENE)
+    sphere = next(surface for surface in surfaces if hasattr(surface, "radius"))
+    sphere.position = sphere.position + 0.5
+    moved_surface = RayTracer(tracer.camera, tracer.scene_settings, surfaces, [])
+    assert gbuffer_key(tracer.camera, moved_surface.surfaces, SIZE, SIZE) != key
+
+
+@pytest.mark.parametrize("cache", [False, True])
+def test_gbuffer_is_ignored_for_other_sizes(tmp_path, cache):
+    tracer = load()
+    tracer.use_gbuffer(SIZE + 4, SIZE + 4, str(tmp_path) if cache else None)
+    np.testing.assert_allclose(render(tracer), render(load()), atol=1e-9)
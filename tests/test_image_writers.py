@@ -0,0 +1,112 @@
+import contextlib
+import io
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from image_writers import open_image_writer
+from ray_tracer import RayTracer
+from scene import parse_scene_file
+from tiles import _bounded_imap
+
+SCENE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "scenes", "pool.txt")
+# Two rows of tiles, the last ones partial.
+HEIGHT, WIDTH = 40, 70
+
+
+def load():
+    camera, scene_settings, surfaces, lights = parse_scene_file(SCENE)
+    scene_settings.root_number_shadow_rays = 2
+    return RayTracer(camera, scene_settings, surfaces, lights)
+
+
+@pytest.fixture(scope="module")
+def expected():
+    img_mat = np.zeros((HEIGHT, WIDTH, 3))
+    with contextlib.redirect_stdout(io.StringIO()):
+        load().ray_trace_tiles(img_mat, seed=3)
+    return img_mat
+
+
+def stream(path, workers=1, hdr=False):
+    with contextlib.redirect_stdout(io.StringIO()):
+        with open_image_writer(path, HEIGHT, WIDTH, hdr) as writer:
+            return load().ray_trace_streaming(writer, workers, seed=3, clip=not hdr)
+
+
+def read_pfm(path):
+    with open(path, "rb") as f:
+        assert f.readline() == b"PF\n"
+        assert f.readline() == f"{WIDTH} {HEIGHT}\n".encode()
+        assert float(f.readline()) < 0
+        image = np.frombuffer(f.read(), dtype="<f4").reshape(HEIGHT, WIDTH, 3)
+    # PFM images are stored bottom to top.
+    return image[::-1]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_streamed_png_matches_the_tiled_render(tmp_path, expected, workers):
+    path = str(tmp_path / "image.png")
+    mean_samples, max_samples = stream(path, workers)
+    assert np.array_equal(np.asarray(Image.open(path)), np.uint8(expected))
+    assert 0 < mean_samples <= max_samples
+
+
+def test_streamed_arrays_match_the_tiled_render(tmp_path, expected):
+    stream(str(tmp_path / "image.npy"))
+    assert np.array_equal(np.load(tmp_path / "image.npy"), np.uint8(expected))
+    stream(str(tmp_path / "image.raw"))
+    raw = np.fromfile(tmp_path / "image.raw", dtype=np.uint8)
+    assert np.array_equal(raw.reshape(HEIGHT, WIDTH, 3), np.uint8(expected))
+    stream(str(tmp_path / "image.pfm"))
+    np.testing.assert_allclose(
+        read_pfm(tmp_path / "image.pfm"), expected / 255, atol=1e-6
+    )
+
+
+def test_hdr_images_keep_unclipped_values(tmp_path, expected):
+    stream(str(tmp_path / "image.npy"), hdr=True)
+    image = np.load(tmp_path / "image.npy")
+    assert image.dtype == np.float32
+    np.testing.assert_allclose(np.clip(image * 255, 0, 255), expected, atol=1e-3)
+
+
+def test_unsupported_formats_are_refused(tmp_path):
+    with pytest.raises(ValueError):
+        open_image_writer(str(tmp_path / "image.jpg"), HEIGHT, WIDTH)
+    with pytest.raises(ValueError):
+        open_image_writer(str(tmp_path / "image.png"), HEIGHT, WIDTH, hdr=True)
+
+
+class _Result:
+    def __init__(self, pool, value):
+        self.pool = pool
+        self.value = value
+
+    def get(self):
+        self.pool.pending -= 1
+        return self.value
+
+
+class _Pool:
+    """
+    Counts the tasks submitted and not yet collected.
+    """
+
+    def __init__(self):
+        self.pending = 0
+        self.max_pending = 0
+
+    def apply_async(self, func, args):
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        return _Result(self, func(*args))
+
+
+def test_bounded_imap_limits_the_tasks_in_flight():
+    pool = _Pool()
+    results = list(_bounded_imap(pool, lambda task: task * 2, list(range(20)), 3))
+    assert results == [task * 2 for task in range(20)]
+    assert pool.max_pending == 3
@@ -0,0 +1,70 @@
+import contextlib
+import io
+import os
+
+import numpy as np
+import pytest
+
+from light_selection import select_lights
+from ray_tracer import RayTracer
+from scene import parse_scene_file
+
+SCENE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "scenes", "pool.txt")
+IMAGE_SIZE = 20
+
+
+def render(lights=None, **settings):
+    camera, scene_settings, surfaces, scene_lights = parse_scene_file(SCENE)
+    # With a single shadow ray per light there's no random sampling.
+    scene_settings.root_number_shadow_rays = 1
+    for name, value in settings.items():
+        setattr(scene_settings, name, value)
+    tracer = RayTracer(
+        camera, scene_settings, surfaces, scene_lights if lights is None else lights
+    )
+    img_mat = np.zeros((IMAGE_SIZE, IMAGE_SIZE, 3))
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracer.ray_trace_wavefront(img_mat)
+    return img_mat
+
+
+@pytest.mark.parametrize("settings", [dict(light_culling=True), dict(light_samples=1)])
+def test_no_lights(settings):
+    plain = render(lights=[])
+    np.testing.assert_array_equal(render(lights=[], **settings), plain)
+
+
+def test_culling_with_no_threshold_keeps_the_image():
+    np.testing.assert_allclose(
+        render(light_culling=True, light_cull_threshold=0), render(), atol=1e-6
+    )
+
+
+def test_sampling_every_light_keeps_the_image():
+    lights = parse_scene_file(SCENE)[3]
+    np.testing.assert_allclose(render(light_samples=len(lights)), render(), atol=1e-6)
+
+
+def test_select_lights_weights():
+    bounds = np.array([[1.0, 5.0, 0.0], [3.0, 0.0, 0.0], [0.0, 1.0, 0.0]])
+    candidates = np.array([[True, True, True], [True, False, True], [True, True, True]])
+    rng = np.random.default_rng(0)
+    draws = 20000
+    mean = sum(select_lights(bounds, candidates, 1, rng) for _ in range(draws)) / draws
+    # The points with more candidates than samples pick lights by their bounds, and weight
+    # them by their inverse probabilities, so every candidate's expected weight is 1,
+    # unless its bound is 0 (it adds nothing), and the points whose bounds are all 0 pick
+    # their candidates uniformly.
+    np.testing.assert_allclose(mean[:, 0], [1, 1, 0], atol=0.05)
+    np.testing.assert_allclose(mean[:, 1], [1, 0, 1], atol=0.05)
+    np.testing.assert_allclose(mean[:, 2], [1, 1, 1], atol=0.05)
+    weights = select_lights(bounds, candidates, 1, rng)
+    assert np.all(np.count_nonzero(weights, axis=0) == 1)
+    assert np.all(weights[~candidates] == 0)
+
+
+def test_select_lights_keeps_points_with_few_candidates():
+    bounds = np.array([[1.0, 2.0], [3.0, 4.0]])
+    candidates = np.array([[True, True], [False, True]])
+    weights = select_lights(bounds, candidates, 2)
+    assert np.array_equal(weights, candidates.astype(float))
@@ -0,0 +1,105 @@
+import contextlib
+import io
+import os
+
+import numpy as np
+
+from consts import PROGRESSIVE_INITIAL_STRIDE
+from progressive import ProgressiveImage, ProgressivePass, progressive_passes
+from ray_tracer import RayTracer
+from scene import parse_scene_file
+
+SCENE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "scenes", "pool.txt")
+HEIGHT, WIDTH = 24, 30
+# Enough for any of the test renders to finish the passes they're limited to.
+TIME_BUDGET = 600
+
+
+def load(root_number_shadow_rays):
+    camera, scene_settings, surfaces, lights = parse_scene_file(SCENE)
+    scene_settings.root_number_shadow_rays = root_number_shadow_rays
+    return RayTracer(camera, scene_settings, surfaces, lights)
+
+
+def render_progressive(tracer, time_budget=TIME_BUDGET, **kwargs):
+    img_mat = np.zeros((HEIGHT, WIDTH, 3))
+    passes = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        finished = tracer.ray_trace_progressive(
+            img_mat, time_budget, on_pass_done=passes.append, **kwargs
+        )
+    return img_mat, finished, passes
+
+
+def coarse_passes():
+    passes = progressive_passes()
+    return [next(passes) for _ in range(PROGRESSIVE_INITIAL_STRIDE.bit_length())]
+
+
+def test_coarse_passes_render_every_pixel_once():
+    counts = np.zeros((HEIGHT, WIDTH), dtype=int)
+    for progressive_pass in coarse_passes():
+        assert progressive_pass.coarse
+        rows, cols = progressive_pass.pixels(HEIGHT, WIDTH)
+        np.add.at(counts, (rows, cols), 1)
+    assert np.all(counts == 1)
+    full_pass = ProgressivePass(len(coarse_passes()), 0)
+    assert len(full_pass.pixels(HEIGHT, WIDTH)[0]) == HEIGHT * WIDTH
+
+
+def test_preview_fills_the_pixels_from_the_coarse_grid():
+    image = ProgressiveImage(HEIGHT, WIDTH)
+    first = coarse_passes()[0]
+    rows, cols = first.pixels(HEIGHT, WIDTH)
+    colors = np.stack([rows, cols, np.zeros_like(rows)], axis=-1).astype(float)
+    image.add(first, rows, cols, colors)
+    img_mat = np.zeros((HEIGHT, WIDTH, 3))
+    image.resolve(img_mat)
+    stride = first.stride
+    all_rows, all_cols = np.indices((HEIGHT, WIDTH))
+    assert np.array_equal(img_mat[..., 0], all_rows // stride * stride)
+    assert np.array_equal(img_mat[..., 1], all_cols // stride * stride)
+
+
+def test_full_passes_are_averaged():
+    image = ProgressiveImage(2, 2)
+    full_pass = ProgressivePass(10, 0)
+    rows, cols = full_pass.pixels(2, 2)
+    image.add(full_pass, rows, cols, np.full((4, 3), 100.0))
+    image.add(full_pass, rows, cols, np.full((4, 3), 400.0))
+    img_mat = np.zeros((2, 2, 3))
+    image.resolve(img_mat)
+    # 250 is out of range, the average is only clipped when resolved.
+    assert np.all(img_mat == 250)
+    image.add(full_pass, rows, cols, np.full((4, 3), 700.0))
+    image.resolve(img_mat)
+    assert np.all(img_mat == 255)
+
+
+def test_single_shadow_ray_stops_after_the_coarse_passes():
+    tracer = load(1)
+    img_mat, finished, passes = render_progressive(tracer)
+    assert finished == len(coarse_passes())
+    assert all(progressive_pass.coarse for progressive_pass in passes)
+    expected = np.zeros((HEIGHT, WIDTH, 3))
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracer.ray_trace_wavefront(expected)
+    np.testing.assert_allclose(img_mat, expected, atol=1e-6)
+
+
+def test_max_passes_and_seed_make_the_render_reproducible():
+    limit = len(coarse_passes()) + 2
+    first, finished, passes = render_progressive(load(2), max_passes=limit, seed=4)
+    assert finished == limit
+    assert [progressive_pass.index for progressive_pass in passes] == list(range(limit))
+    again, _, _ = render_progressive(load(2), max_passes=limit, seed=4)
+    assert np.array_equal(first, again)
+    other, _, _ = render_progressive(load(2), max_passes=limit, seed=5)
+    assert not np.array_equal(first, other)
+
+
+def test_spent_budget_renders_nothing():
+    img_mat, finished, passes = render_progressive(load(2), time_budget=0)
+    assert finished == 0
+    assert passes == []
+    assert not img_mat.any()
@@ -0,0 +1,110 @@
+import contextlib
+import io
+import os
+
+import numpy as np
+import pytest
+
+import ray_tracer
+from ray_tracer import RayTracer
+from scene import parse_scene_file
+from scene_cache import compile_scene_stream, load_scene
+
+SCENES_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "scenes")
+SCENES = sorted(name for name in os.listdir(SCENES_DIR) if name.endswith(".txt"))
+IMAGE_SIZE = 16
+# With a single shadow ray per light there's no random sampling, so every path renders
+# the scalar renderer's image, up to the rounding of the batched arithmetic.
+TOLERANCE = 1e-6
+# Compiled scenes store the geometry in float32, so the surfaces of scenes with values like
+# 0.3 move slightly, see scene_cache.SCENE_ARRAYS.
+COMPILED_TOLERANCE = 1e-3
+
+RENDER_PATHS = {
+    "wavefront": dict(use_bvh=False),
+    "bvh": dict(use_bvh=True),
+    "frustum": dict(use_bvh=False, frustum_culling=True),
+    "occluders": dict(use_bvh=False, occluder_lists=True),
+}
+
+
+def load(scene_path, compiled=False, **kwargs):
+    if compiled:
+        camera, scene_settings, surfaces, lights = load_scene(scene_path).to_objects()
+    else:
+        camera, scene_settings, surfaces, lights = parse_scene_file(scene_path)
+    scene_settings.root_number_shadow_rays = 1
+    scene_settings.max_recursions = min(scene_settings.max_recursions, 3)
+    return RayTracer(camera, scene_settings, surfaces, lights, **kwargs)
+
+
+def render(tracer, method):
+    img_mat = np.zeros((IMAGE_SIZE, IMAGE_SIZE, 3))
+    with contextlib.redirect_stdout(io.StringIO()):
+        getattr(tracer, method)(img_mat)
+    return img_mat
+
+
+@pytest.fixture(scope="module")
+def scalar_images():
+    return {
+        name: render(load(os.path.join(SCENES_DIR, name), use_bvh=False), "ray_trace")
+        for name in SCENES
+    }
+
+
+@pytest.mark.parametrize("path", RENDER_PATHS)
+@pytest.mark.parametrize("name", SCENES)
+def test_batched_paths_match_scalar(monkeypatch, scalar_images, name, path):
+    # The bundled scenes are small, so the BVH is forced, rather than skipped.
+    monkeypatch.setattr(ray_tracer, "BVH_MIN_PRIMITIVES", 1)
+    tracer = load(os.path.join(SCENES_DIR, name), **RENDER_PATHS[path])
+    assert (tracer.surfaces.bvh is not None) == (path == "bvh")
+    np.testing.assert_allclose(
+        render(tracer, "ray_trace_wavefront"), scalar_images[name], atol=TOLERANCE
+    )
+
+
+@pytest.mark.parametrize("name", SCENES)
+def test_compiled_scene_matches_scalar(tmp_path, scalar_images, name):
+    scene_path = str(tmp_path / name)
+    with open(os.path.join(SCENES_DIR, name), "rb") as src, open(
+        scene_path, "wb"
+    ) as dst:
+        dst.write(src.read())
+    for _ in range(2):
+        # The first load compiles the scene, the second one maps the saved arrays.
+        tracer = load(scene_path, compiled=True, use_bvh=False)
+        np.testing.assert_allclose(
+            render(tracer, "ray_trace_wavefront"),
+            scalar_images[name],
+            atol=COMPILED_TOLERANCE,
+        )
+
+
+MATERIAL = b"mtl 1 1 1 1 1 1 0 0 0 10 0\n"
+
+
+@pytest.mark.parametrize(
+    "text, chunk_size, message",
+    [
+        (b"sph 0 0 0 1 5\n", None, "<scene>:1: Undefined material index: 5"),
+        (
+            MATERIAL + b"\n# A comment\nsph 0 0 0 1\n",
+            None,
+            "<scene>:4: Expected 5 values, got 4: sph 0 0 0 1",
+        ),
+        (
+            MATERIAL + b"sph 0 0 x 1 1\n",
+            None,
+            "<scene>:2: Bad number in line: sph 0 0 x 1 1",
+        ),
+        # Chunks smaller than the file keep counting the lines of the previous ones.
+        (MATERIAL * 5 + b"foo 1 2\n", 30, "<scene>:6: Unknown object type: foo"),
+    ],
+)
+def test_scene_text_errors_name_the_line(text, chunk_size, message):
+    kwargs = {} if chunk_size is None else {"chunk_size": chunk_size}
+    with pytest.raises(ValueError) as error:
+        compile_scene_stream(io.BytesIO(text), "<scene>", **kwargs)
+    assert str(error.value) == message
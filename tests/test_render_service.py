@@ -0,0 +1,184 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import shutil
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import render_service
+from consts import RENDER_SERVICE_MAX_PIXELS
+from ray_tracer import RayTracer
+from render_service import RenderService, parse_job_request, parse_setting
+from scene import parse_scene_file
+
+SCENES_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "scenes")
+# The seed of the jobs whose worker process dies, see _render_or_die.
+DYING_SEED = 13
+
+
+def _render_or_die(scene_name, scene_key, scene_data, job):
+    if job["seed"] == DYING_SEED:
+        os._exit(1)
+    return _render_job(scene_name, scene_key, scene_data, job)
+
+
+_render_job = render_service._render_job
+
+
+def test_job_defaults():
+    job = parse_job_request({"scene_text": "cam 0 0 0 0 0 1 0 1 0 1 1\n"})
+    assert (job["width"], job["height"], job["seed"]) == (500, 500, 0)
+    assert job["bvh"] and not job["wait"]
+    assert job["settings"] == {} and job["output"] is None
+
+
+@pytest.mark.parametrize(
+    "request_, message",
+    [
+        ([], "must be a JSON object"),
+        ({"scene_text": "", "color": 1}, "Unknown job fields: color"),
+        ({}, "either a scene or a scene_text"),
+        ({"scene_text": "", "scene": "a.txt"}, "either a scene or a scene_text"),
+        ({"scene_text": "", "width": 1.5}, "width must be an integer"),
+        ({"scene_text": "", "height": 0}, "height must be positive"),
+        ({"scene_text": "", "width": True}, "width must be an integer"),
+        (
+            {"scene_text": "", "width": 1 << 13, "height": 1 << 13},
+            f"more than {RENDER_SERVICE_MAX_PIXELS} pixels",
+        ),
+        ({"scene_text": "", "seed": "1"}, "seed must be an integer"),
+        ({"scene_text": "", "wait": 1}, "wait must be true or false"),
+        ({"scene_text": 5}, "scene_text must be a string"),
+        ({"scene_text": "", "settings": []}, "settings must be a JSON object"),
+        ({"scene_text": "", "settings": {"fog": 1}}, "Unknown scene settings: fog"),
+        (
+            {"scene_text": "", "settings": {"max_recursions": -1}},
+            "max_recursions must be an integer of at least 0",
+        ),
+        ({"scene_text": "", "output": "a.png"}, "no output directory"),
+        ({"scene": "pool.txt"}, "no scene directory"),
+    ],
+)
+def test_bad_job_requests(request_, message):
+    with pytest.raises(ValueError, match=message):
+        parse_job_request(request_)
+
+
+def test_settings():
+    assert parse_setting("min_ray_weight", 1) == 1.0
+    assert parse_setting("shadow_sampling", "halton") == "halton"
+    with pytest.raises(ValueError, match="one of"):
+        parse_setting("shadow_sampling", "sobol")
+    with pytest.raises(ValueError, match="true or false"):
+        parse_setting("light_culling", 1)
+
+
+def test_paths_are_confined_to_their_directories(tmp_path):
+    scene_dir = tmp_path / "scenes"
+    output_dir = tmp_path / "output"
+    scene_dir.mkdir()
+    output_dir.mkdir()
+    (scene_dir / "sub").mkdir()
+    os.symlink(tmp_path, scene_dir / "link")
+
+    def parse(**fields):
+        return parse_job_request(fields, str(output_dir), str(scene_dir))
+
+    job = parse(scene="sub/../pool.txt", output="frames/a.png")
+    assert job["scene"] == os.path.realpath(scene_dir / "pool.txt")
+    assert job["output"] == os.path.realpath(output_dir / "frames" / "a.png")
+    for scene in ("../secret.txt", "/etc/passwd", "link/secret.txt"):
+        with pytest.raises(ValueError, match="within the scene directory"):
+            parse(scene=scene)
+    with pytest.raises(ValueError, match="within the output directory"):
+        parse(scene_text="", output="../a.png")
+
+
+async def _request(socket_path, method, path, body=None):
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    data = b"" if body is None else json.dumps(body).encode()
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\nContent-Length: {len(data)}\r\n\r\n".encode()
+        + data
+    )
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    response = await reader.read()
+    writer.close()
+    status = int(head.split(b" ", 2)[1])
+    if b"image/png" in head:
+        return status, np.asarray(Image.open(io.BytesIO(response)))
+    return status, json.loads(response)
+
+
+def _serve(tmp_path, requests):
+    # Run the service on a Unix socket, send it the requests in turn, and return their
+    # responses.
+    scene_dir = tmp_path / "scenes"
+    scene_dir.mkdir()
+    shutil.copy(os.path.join(SCENES_DIR, "pool.txt"), scene_dir)
+    (tmp_path / "secret.txt").write_text("secret\n")
+    socket_path = str(tmp_path / "service.sock")
+    service = RenderService(1, scene_dir=str(scene_dir))
+
+    async def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            server = asyncio.create_task(service.serve(socket_path=socket_path))
+            while not os.path.exists(socket_path):
+                await asyncio.sleep(0.01)
+            try:
+                return [await _request(socket_path, *request) for request in requests]
+            finally:
+                server.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await server
+
+    return asyncio.run(run())
+
+
+def test_service_renders_the_scenes_in_its_directory(tmp_path):
+    job = {"scene": "pool.txt", "width": 24, "height": 20, "seed": 3, "wait": True}
+    (status, image), (scene_status, scene_error), (_, metrics) = _serve(
+        tmp_path,
+        [
+            ("POST", "/jobs", job),
+            ("POST", "/jobs", {"scene": "../secret.txt"}),
+            ("GET", "/metrics"),
+        ],
+    )
+    assert status == 200
+    camera, scene_settings, surfaces, lights = parse_scene_file(
+        os.path.join(SCENES_DIR, "pool.txt")
+    )
+    expected = np.zeros((20, 24, 3))
+    with contextlib.redirect_stdout(io.StringIO()):
+        RayTracer(camera, scene_settings, surfaces, lights).ray_trace_tiles(
+            expected, seed=3
+        )
+    np.testing.assert_array_equal(image, np.uint8(expected))
+    assert scene_status == 400
+    assert "within the scene directory" in scene_error["error"]
+    assert "secret" not in scene_error["error"]
+    assert metrics["done"] == 1 and metrics["submitted"] == 1
+
+
+def test_service_replaces_a_broken_pool(tmp_path, monkeypatch):
+    monkeypatch.setattr(render_service, "_render_job", _render_or_die)
+    job = {"scene": "pool.txt", "width": 8, "height": 8, "wait": True}
+    (_, dying), (status, image), (_, metrics) = _serve(
+        tmp_path,
+        [
+            ("POST", "/jobs", {**job, "seed": DYING_SEED}),
+            ("POST", "/jobs", job),
+            ("GET", "/metrics"),
+        ],
+    )
+    assert dying["status"] == "failed"
+    assert "worker process died" in dying["error"]
+    assert status == 200 and image.shape == (8, 8, 3)
+    assert metrics["pool_restarts"] == 1
+    assert (metrics["failed"], metrics["done"]) == (1, 1)
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from consts import SAMPLE_TABLE_COUNT
+from sampling import (
+    SHADOW_SAMPLING_HALTON,
+    SHADOW_SAMPLING_STRATIFIED,
+    SampleTables,
+    hash_rotations,
+    radical_inverse,
+)
+
+ROOT = 4
+
+
+def cell_counts(samples, root):
+    cells = np.floor(samples * root).astype(int)
+    return np.bincount(cells[:, 0] * root + cells[:, 1], minlength=root * root)
+
+
+def test_radical_inverse():
+    np.testing.assert_allclose(
+        radical_inverse(np.arange(5), 2), [0, 0.5, 0.25, 0.75, 0.125]
+    )
+    np.testing.assert_allclose(
+        radical_inverse(np.arange(4), 3), [0, 1 / 3, 2 / 3, 1 / 9]
+    )
+
+
+def test_stratified_tables_have_a_sample_per_cell():
+    tables = SampleTables(1).get(SHADOW_SAMPLING_STRATIFIED, ROOT)
+    assert tables.shape == (SAMPLE_TABLE_COUNT, ROOT * ROOT, 2)
+    for table in tables:
+        assert np.all(cell_counts(table, ROOT) == 1)
+
+
+@pytest.mark.parametrize(
+    "sampling", [SHADOW_SAMPLING_STRATIFIED, SHADOW_SAMPLING_HALTON]
+)
+def test_tables_are_the_same_for_the_same_seed(sampling):
+    first = SampleTables(1).lookup(sampling, ROOT, np.arange(8))
+    again = SampleTables(1).lookup(sampling, ROOT, np.arange(8))
+    other = SampleTables(2).lookup(sampling, ROOT, np.arange(8))
+    assert np.array_equal(first, again)
+    assert not np.array_equal(first, other)
+    assert np.all((first >= 0) & (first < 1))
+
+
+@pytest.mark.parametrize(
+    "sampling", [SHADOW_SAMPLING_STRATIFIED, SHADOW_SAMPLING_HALTON]
+)
+def test_pixels_sharing_a_table_get_different_samples(sampling):
+    indices = np.array([3, 3 + SAMPLE_TABLE_COUNT, 3 + 5 * SAMPLE_TABLE_COUNT])
+    samples = SampleTables(1).lookup(sampling, ROOT, indices)
+    assert not np.allclose(samples[0], samples[1])
+    assert not np.allclose(samples[0], samples[2])
+
+
+def test_rotated_stratified_tables_stay_stratified():
+    tables = SampleTables(1)
+    indices = np.arange(3 * SAMPLE_TABLE_COUNT)
+    samples = tables.lookup(SHADOW_SAMPLING_STRATIFIED, ROOT, indices)
+    rotations = hash_rotations(tables.seed, indices)
+    for table, rotation in zip(samples, rotations):
+        # Every cell of the grid shifted by the rotation still has a single sample.
+        assert np.all(cell_counts((table - rotation) % 1.0, ROOT) == 1)
+
+
+def test_rotations_are_spread_over_the_unit_square():
+    rotations = hash_rotations(5, np.arange(1 << 14))
+    assert np.all((rotations >= 0) & (rotations < 1))
+    counts = cell_counts(rotations, 4)
+    assert counts.min() > 0.8 * counts.mean()
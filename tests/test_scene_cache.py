@@ -0,0 +1,135 @@
+import contextlib
+import io
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from base_surface import SurfaceGroups
+from ray_tracer import RayTracer
+from scene import parse_scene_file
+from scene_cache import (
+    SCENE_ARRAYS,
+    SCENE_CACHE_VERSION,
+    compile_scene_text,
+    is_cache_fresh,
+    load_compiled_scene,
+    load_scene,
+    save_compiled_scene,
+)
+
+SCENES_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "scenes")
+
+
+@pytest.fixture
+def scene_path(tmp_path):
+    path = str(tmp_path / "Room1.txt")
+    shutil.copy(os.path.join(SCENES_DIR, "Room1.txt"), path)
+    return path
+
+
+def test_compiled_tables_match_the_text(scene_path):
+    scene = compile_scene_text(scene_path)
+    _, _, surfaces, lights = parse_scene_file(scene_path)
+    spheres = [surface for surface in surfaces if hasattr(surface, "radius")]
+    assert scene.sphere_positions.dtype == np.float32
+    np.testing.assert_array_equal(
+        scene.sphere_positions,
+        np.array([sphere.position for sphere in spheres], dtype=np.float32),
+    )
+    np.testing.assert_array_equal(
+        scene.light_positions, [light.position for light in lights]
+    )
+
+
+def test_cache_is_memory_mapped_and_reused(scene_path):
+    cache_path = scene_path + ".cache"
+    scene = load_scene(scene_path)
+    assert is_cache_fresh(scene_path, cache_path)
+    assert isinstance(scene.sphere_positions, np.memmap)
+    for name, (dtype, _) in SCENE_ARRAYS.items():
+        assert getattr(load_scene(scene_path), name).dtype == dtype
+
+
+def test_cache_is_rebuilt_when_stale(scene_path):
+    cache_path = scene_path + ".cache"
+    load_scene(scene_path)
+    # A newer scene text, and a cache from another version, are both stale.
+    stat = os.stat(scene_path)
+    os.utime(cache_path + "/version.npy", (stat.st_atime - 10, stat.st_mtime - 10))
+    assert not is_cache_fresh(scene_path, cache_path)
+    load_scene(scene_path)
+    assert is_cache_fresh(scene_path, cache_path)
+    np.save(cache_path + "/version.npy", np.array([SCENE_CACHE_VERSION - 1]))
+    assert not is_cache_fresh(scene_path, cache_path)
+    with pytest.raises(ValueError):
+        load_compiled_scene(cache_path)
+    load_scene(scene_path)
+    assert is_cache_fresh(scene_path, cache_path)
+
+
+def test_unwritable_cache_falls_back_to_the_compiled_scene(scene_path):
+    cache_path = scene_path + ".cache"
+    # A file where the cache's directory should be can't be written, even by root.
+    with open(cache_path, "w") as f:
+        f.write("not a cache")
+    with pytest.warns(UserWarning, match="Can't save the compiled scene"):
+        scene = load_scene(scene_path)
+    assert len(scene.surface_kinds) == 8
+    with open(cache_path) as f:
+        assert f.read() == "not a cache"
+
+
+def test_interrupted_save_is_not_fresh(scene_path, tmp_path):
+    cache_path = str(tmp_path / "partial.cache")
+    save_compiled_scene(compile_scene_text(scene_path), cache_path)
+    os.remove(os.path.join(cache_path, "version.npy"))
+    assert not is_cache_fresh(scene_path, cache_path)
+
+
+def test_surface_groups_are_built_from_the_tables(scene_path):
+    scene = load_scene(scene_path)
+    _, _, surfaces, _ = scene.to_objects()
+    parsed = SurfaceGroups(parse_scene_file(scene_path)[2])
+    # No surface objects are built, the groups' parameters are the tables upcast once,
+    # and the materials are views of the memory mapped table.
+    assert surfaces._surfaces is None
+    assert [group[0] for group in surfaces.groups] == [
+        group[0] for group in parsed.groups
+    ]
+    for (_, indices, parameters), (_, parsed_indices, parsed_parameters) in zip(
+        surfaces.groups, parsed.groups
+    ):
+        np.testing.assert_array_equal(indices, parsed_indices)
+        for values, parsed_values in zip(parameters, parsed_parameters):
+            assert values.dtype == np.float64
+            np.testing.assert_allclose(values, parsed_values, rtol=1e-7)
+    assert np.shares_memory(
+        surfaces.materials.diffuse_colors, scene.material_diffuse_colors
+    )
+    np.testing.assert_array_equal(
+        surfaces.materials.diffuse_colors[surfaces.material_ids],
+        parsed.materials.diffuse_colors[parsed.material_ids],
+    )
+
+
+def test_surface_objects_are_built_lazily(scene_path):
+    _, _, surfaces, _ = load_scene(scene_path).to_objects()
+    objects = surfaces.surfaces
+    assert len(objects) == len(surfaces) == 8
+    # The objects rebuild the same stacked parameters.
+    rebuilt = SurfaceGroups(objects)
+    for (_, _, parameters), (_, _, rebuilt_parameters) in zip(
+        surfaces.groups, rebuilt.groups
+    ):
+        for values, rebuilt_values in zip(parameters, rebuilt_parameters):
+            np.testing.assert_array_equal(values, rebuilt_values)
+
+
+def test_batched_renders_dont_build_surface_objects(scene_path):
+    camera, scene_settings, surfaces, lights = load_scene(scene_path).to_objects()
+    tracer = RayTracer(camera, scene_settings, surfaces, lights, frustum_culling=True)
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracer.ray_trace_wavefront(np.zeros((8, 8, 3)))
+    assert tracer.surfaces._surfaces is None
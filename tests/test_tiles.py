@@ -0,0 +1,60 @@
+import contextlib
+import io
+import os
+
+import numpy as np
+
+from ray_tracer import RayTracer
+from scene import parse_scene_file
+from tiles import morton_order, split_into_tiles
+
+SCENE = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), "scenes", "Transparency.txt"
+)
+# Two tiles on every side, the last ones partial.
+HEIGHT, WIDTH = 40, 36
+
+
+def load():
+    camera, scene_settings, surfaces, lights = parse_scene_file(SCENE)
+    scene_settings.root_number_shadow_rays = 2
+    scene_settings.max_recursions = 2
+    return RayTracer(camera, scene_settings, surfaces, lights)
+
+
+def render(workers):
+    tracer = load()
+    img_mat = np.zeros((HEIGHT, WIDTH, 3))
+    shadow_sample_map = np.zeros((HEIGHT, WIDTH))
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracer.ray_trace_tiles(
+            img_mat, workers, seed=7, shadow_sample_map=shadow_sample_map
+        )
+    return tracer, img_mat, shadow_sample_map
+
+
+def test_tiles_cover_the_image_once():
+    tiles = morton_order(split_into_tiles(HEIGHT, WIDTH, 16))
+    covered = np.zeros((HEIGHT, WIDTH), dtype=int)
+    for tile in tiles:
+        covered[tile.top : tile.bottom, tile.left : tile.right] += 1
+    assert len(tiles) == 9
+    assert np.all(covered == 1)
+
+
+def test_image_does_not_depend_on_the_worker_count():
+    _, single, single_samples = render(1)
+    _, pooled, pooled_samples = render(2)
+    assert np.array_equal(single, pooled)
+    assert np.array_equal(single_samples, pooled_samples)
+    assert single_samples.max() > 0
+
+
+def test_workers_merge_their_bvh_counters():
+    single, _, _ = render(1)
+    pooled, _, _ = render(2)
+    assert single.surfaces.bvh is not None
+    assert single.surfaces.bvh.rays_traced > 0
+    assert (
+        pooled.surfaces.bvh.traversal_counts() == single.surfaces.bvh.traversal_counts()
+    )
@@ -0,0 +1,482 @@
+import collections
+import multiprocessing
+import multiprocessing.pool
+from multiprocessing import shared_memory
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+import stats
+from camera import Camera
+from colors import RayTreeStatistics
+from consts import (
+    ANIMATION_FRAMES_IN_FLIGHT,
+    COLOR_CHANNELS,
+    STREAMING_TILES_IN_FLIGHT_PER_WORKER,
+    TILE_SIZE,
+)
+from progressbar import progressbar
+
+# The shifts and masks that spread the bits of a 32 bit value apart, see morton_codes.
+MORTON_SPREAD_STEPS = (
+    (16, 0x0000FFFF0000FFFF),
+    (8, 0x00FF00FF00FF00FF),
+    (4, 0x0F0F0F0F0F0F0F0F),
+    (2, 0x3333333333333333),
+    (1, 0x5555555555555555),
+)
+
+
+class Tile:
+    """
+    A rectangular block of pixels, rows [top, bottom) and columns [left, right) of the image.
+    Every tile has its own random generator, seeded by the render's seed and the tile's index,
+    so that the image doesn't depend on which process renders which tile, or in which order.
+    """
+
+    def __init__(self, index: int, top: int, left: int, bottom: int, right: int):
+        self.index = index
+        self.top = top
+        self.left = left
+        self.bottom = bottom
+        self.right = right
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.bottom - self.top, self.right - self.left
+
+    def pixels(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return the arrays of the rows and columns of the tile's pixels, in scanline order.
+        """
+        rows, cols = np.divmod(np.arange(self.shape[0] * self.shape[1]), self.shape[1])
+        return rows + self.top, cols + self.left
+
+    def rng(self, seed: int) -> np.random.Generator:
+        return np.random.default_rng((seed, self.index))
+
+
+def split_into_tiles(height: int, width: int, tile_size: int = TILE_SIZE) -> List[Tile]:
+    """
+    Split an image of the given size into tiles of at most tile_size x tile_size pixels,
+    in scanline order.
+    """
+    tiles = []
+    for top in range(0, height, tile_size):
+        for left in range(0, width, tile_size):
+            tiles.append(
+                Tile(
+                    len(tiles),
+                    top,
+                    left,
+                    min(top + tile_size, height),
+                    min(left + tile_size, width),
+                )
+            )
+    return tiles
+
+
+def _spread_bits(values: np.ndarray) -> np.ndarray:
+    # Move the i-th bit of every 32 bit value to the 2i-th bit, in halving steps.
+    values = np.asarray(values, dtype=np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in MORTON_SPREAD_STEPS:
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+def morton_codes(rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+    """
+    Return the positions of the given (non-negative, integer) grid cells along a Z-order
+    (Morton) curve, which interleaves the bits of their rows and columns, so that cells which
+    are close along the curve are close in the grid too.
+    """
+    return _spread_bits(cols) | (_spread_bits(rows) << np.uint64(1))
+
+
+def morton_order(tiles: List[Tile]) -> List[Tile]:
+    """
+    Return the given tiles sorted along a Z-order curve over their rows and columns of tiles,
+    see morton_codes, so that consecutive tiles see nearby parts of the scene. The tiles keep
+    their indices, and so their random generators, so the image doesn't change.
+    """
+    if not tiles:
+        return []
+    _, tile_rows = np.unique([tile.top for tile in tiles], return_inverse=True)
+    _, tile_cols = np.unique([tile.left for tile in tiles], return_inverse=True)
+    order = np.argsort(morton_codes(tile_rows, tile_cols), kind="stable")
+    return [tiles[i] for i in order]
+
+
+# The state of a rendering worker process, set up once by _init_worker.
+_worker_state = {}
+
+
+def _init_worker(
+    ray_tracer,
+    shared_memory_name: Optional[str],
+    shape: Tuple[int, ...],
+    seed: int,
+    collect_statistics: bool,
+    clip: bool = True,
+):
+    # A forked worker inherits the main process' statistics, which are already counted there.
+    stats.disable()
+    _worker_state["ray_tracer"] = ray_tracer
+    if shared_memory_name is not None:
+        framebuffer_memory = shared_memory.SharedMemory(name=shared_memory_name)
+        _worker_state["memory"] = framebuffer_memory
+        _worker_state["img_mat"] = np.ndarray(
+            shape, dtype=np.float64, buffer=framebuffer_memory.buf
+        )
+    _worker_state["shape"] = shape
+    _worker_state["seed"] = seed
+    _worker_state["collect_statistics"] = collect_statistics
+    _worker_state["clip"] = clip
+
+
+def _start_tile_statistics(ray_tracer) -> None:
+    # The statistics are counted per tile, and merged into the main process' ray tracer (and
+    # its BVH's traversal counters), see _merge_tile_statistics.
+    ray_tracer.ray_tree_statistics = RayTreeStatistics()
+    if ray_tracer.surfaces.bvh is not None:
+        ray_tracer.surfaces.bvh.reset_statistics()
+    if _worker_state["collect_statistics"]:
+        stats.enable()
+
+
+def _bvh_traversal_counts(ray_tracer) -> Optional[Tuple[int, int, int]]:
+    if ray_tracer.surfaces.bvh is None:
+        return None
+    return ray_tracer.surfaces.bvh.traversal_counts()
+
+
+def _merge_tile_statistics(
+    ray_tracer,
+    statistics: RayTreeStatistics,
+    bvh_counts: Optional[Tuple[int, int, int]],
+    render_statistics: Optional[stats.RenderStatistics],
+) -> None:
+    ray_tracer.ray_tree_statistics.merge(statistics)
+    if bvh_counts is not None:
+        ray_tracer.surfaces.bvh.add_traversal_counts(bvh_counts)
+    if render_statistics is not None and stats.active() is not None:
+        stats.active().merge(render_statistics)
+
+
+def _render_tile_in_worker(
+    tile: Tile,
+) -> Tuple[
+    Tile,
+    RayTreeStatistics,
+    Optional[Tuple[int, int, int]],
+    np.ndarray,
+    Optional[stats.RenderStatistics],
+]:
+    ray_tracer = _worker_state["ray_tracer"]
+    _start_tile_statistics(ray_tracer)
+    shadow_sample_counts = ray_tracer.render_tile(
+        _worker_state["img_mat"], tile, _worker_state["seed"]
+    )
+    return (
+        tile,
+        ray_tracer.ray_tree_statistics,
+        _bvh_traversal_counts(ray_tracer),
+        shadow_sample_counts,
+        stats.disable(),
+    )
+
+
+def _render_tile_pixels_in_worker(
+    tile: Tile,
+) -> Tuple[
+    Tile,
+    RayTreeStatistics,
+    Optional[Tuple[int, int, int]],
+    np.ndarray,
+    np.ndarray,
+    Optional[stats.RenderStatistics],
+]:
+    ray_tracer = _worker_state["ray_tracer"]
+    _start_tile_statistics(ray_tracer)
+    height, width = _worker_state["shape"]
+    pixels, shadow_sample_counts = ray_tracer.render_tile_pixels(
+        height, width, tile, _worker_state["seed"], _worker_state["clip"]
+    )
+    return (
+        tile,
+        ray_tracer.ray_tree_statistics,
+        _bvh_traversal_counts(ray_tracer),
+        pixels,
+        shadow_sample_counts,
+        stats.disable(),
+    )
+
+
+def _render_frame_tile_in_worker(
+    task: Tuple[int, Camera, Tile],
+) -> Tuple[
+    int,
+    Tile,
+    RayTreeStatistics,
+    Optional[Tuple[int, int, int]],
+    np.ndarray,
+    np.ndarray,
+    Optional[stats.RenderStatistics],
+]:
+    # The worker keeps its ray tracer, with the scene's BVH, across the frames, and only
+    # switches its camera when it gets the first tile of another frame.
+    frame, camera, tile = task
+    if _worker_state.get("frame") != frame:
+        _worker_state["ray_tracer"].set_camera(camera)
+        _worker_state["frame"] = frame
+    return (frame, *_render_tile_pixels_in_worker(tile))
+
+
+def render_tiles(
+    ray_tracer,
+    img_mat: np.ndarray,
+    tiles: List[Tile],
+    workers: int = 1,
+    seed: int = 0,
+    on_tile_rendered: Optional[Callable[[Tile, np.ndarray], None]] = None,
+    shadow_sample_map: Optional[np.ndarray] = None,
+) -> None:
+    """
+    Render the given tiles of the image into img_mat.
+    With more than one worker, the tiles are rendered by a pool of processes, which receive the
+    ray tracer once when they start, and write the tiles straight into a framebuffer in shared
+    memory, which is copied to img_mat at the end.
+    :param ray_tracer: The RayTracer of the scene.
+    :param img_mat: The (height, width, COLOR_CHANNELS) image to render into.
+    :param tiles: The tiles to render, see split_into_tiles.
+    :param workers: The number of processes to render with.
+    :param seed: The seed of the tiles' random generators.
+    :param on_tile_rendered: An optional callback, called in this process with every tile and
+    its (tile height, tile width, COLOR_CHANNELS) pixels once it's rendered.
+    The workers' ray tree statistics and BVH traversal counters are merged into the ray
+    tracer's. If statistics are enabled (see stats.enable), the workers' statistics are
+    merged into this process' ones, and the "tile" hooks are called after every tile.
+    :param shadow_sample_map: An optional (height, width) array to fill with the number of
+    shadow rays cast for every pixel.
+    """
+    # No pool is started without tiles, like when resuming a finished checkpoint.
+    if workers <= 1 or not tiles:
+        for tile in progressbar(tiles, prefix="Computing: "):
+            shadow_sample_counts = ray_tracer.render_tile(img_mat, tile, seed)
+            if shadow_sample_map is not None:
+                shadow_sample_map[tile.top : tile.bottom, tile.left : tile.right] = (
+                    shadow_sample_counts
+                )
+            if on_tile_rendered is not None:
+                on_tile_rendered(
+                    tile, img_mat[tile.top : tile.bottom, tile.left : tile.right]
+                )
+            stats.notify("tile")
+        return
+
+    framebuffer_memory = shared_memory.SharedMemory(create=True, size=img_mat.nbytes)
+    try:
+        framebuffer = np.ndarray(
+            img_mat.shape, dtype=np.float64, buffer=framebuffer_memory.buf
+        )
+        framebuffer[:] = img_mat
+        with multiprocessing.Pool(
+            workers,
+            initializer=_init_worker,
+            initargs=(
+                ray_tracer,
+                framebuffer_memory.name,
+                img_mat.shape,
+                seed,
+                stats.active() is not None,
+            ),
+        ) as pool:
+            for (
+                tile,
+                statistics,
+                bvh_counts,
+                shadow_sample_counts,
+                render_statistics,
+            ) in progressbar(
+                pool.imap_unordered(_render_tile_in_worker, tiles),
+                count=len(tiles),
+                prefix="Computing: ",
+            ):
+                _merge_tile_statistics(
+                    ray_tracer, statistics, bvh_counts, render_statistics
+                )
+                if shadow_sample_map is not None:
+                    shadow_sample_map[
+                        tile.top : tile.bottom, tile.left : tile.right
+                    ] = shadow_sample_counts
+                if on_tile_rendered is not None:
+                    on_tile_rendered(
+                        tile,
+                        framebuffer[tile.top : tile.bottom, tile.left : tile.right],
+                    )
+                stats.notify("tile")
+        img_mat[:] = framebuffer
+        del framebuffer
+    finally:
+        framebuffer_memory.close()
+        framebuffer_memory.unlink()
+
+
+def _bounded_imap(
+    pool: multiprocessing.pool.Pool, func: Callable, tasks: List, window: int
+) -> Iterator:
+    """
+    Like pool.imap, yield the results of the function on the tasks in order, but only keep
+    up to window tasks queued or running (or done and not yet yielded) at a time, so the
+    workers can't run ahead of the caller by more than that.
+    """
+    pending = collections.deque()
+    for task in tasks:
+        if len(pending) == window:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (task,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def stream_tiles(
+    ray_tracer,
+    height: int,
+    width: int,
+    tiles: List[Tile],
+    workers: int = 1,
+    seed: int = 0,
+    clip: bool = True,
+) -> Iterator[Tuple[Tile, np.ndarray, np.ndarray]]:
+    """
+    Render the given tiles of an image of the given size, and yield every tile with its
+    (tile height, tile width, COLOR_CHANNELS) pixels and its (tile height, tile width) shadow
+    ray counts, in the order of the tiles.
+    Unlike render_tiles, no framebuffer of the whole image is allocated: the workers send
+    every tile's pixels back as soon as it's rendered, and only
+    STREAMING_TILES_IN_FLIGHT_PER_WORKER tiles per worker are rendered ahead of the caller,
+    so the memory used depends on the tiles' size and not on the image's.
+    :param clip: Whether to clip the pixels' values to [0, COLOR_SCALE], see
+    RayTracer.render_pixels.
+    Statistics are handled like in render_tiles.
+    """
+    if workers <= 1:
+        for tile in progressbar(tiles, prefix="Computing: "):
+            pixels, shadow_sample_counts = ray_tracer.render_tile_pixels(
+                height, width, tile, seed, clip
+            )
+            yield tile, pixels, shadow_sample_counts
+            stats.notify("tile")
+        return
+
+    with multiprocessing.Pool(
+        workers,
+        initializer=_init_worker,
+        initargs=(
+            ray_tracer,
+            None,
+            (height, width),
+            seed,
+            stats.active() is not None,
+            clip,
+        ),
+    ) as pool:
+        for (
+            tile,
+            statistics,
+            bvh_counts,
+            pixels,
+            shadow_sample_counts,
+            render_statistics,
+        ) in progressbar(
+            _bounded_imap(
+                pool,
+                _render_tile_pixels_in_worker,
+                tiles,
+                STREAMING_TILES_IN_FLIGHT_PER_WORKER * workers,
+            ),
+            count=len(tiles),
+            prefix="Computing: ",
+        ):
+            _merge_tile_statistics(
+                ray_tracer, statistics, bvh_counts, render_statistics
+            )
+            yield tile, pixels, shadow_sample_counts
+            stats.notify("tile")
+
+
+def stream_frames(
+    ray_tracer,
+    cameras: List[Camera],
+    height: int,
+    width: int,
+    workers: int = 1,
+    seed: int = 0,
+) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Render the frames of an animation, an image of the given size through every one of the
+    given cameras, tile by tile like render_tiles, and yield every frame's index with its
+    (height, width, COLOR_CHANNELS) image, in order.
+    The ray tracer (with its BVH) is set up once, and only its camera changes between the
+    frames, see RayTracer.set_camera. With more than one worker, a single pool of processes
+    renders all the frames: the workers receive the ray tracer once, and go on to the tiles of
+    the next frames while the caller handles the ones already yielded, like saving them, up
+    to ANIMATION_FRAMES_IN_FLIGHT frames ahead, so the tiles waiting to be assembled don't
+    grow with the animation.
+    Every frame's tiles are seeded like in render_tiles, so a frame is the same as an image
+    rendered through its camera on its own, whatever the number of workers.
+    Statistics are handled like in render_tiles.
+    """
+    tiles = morton_order(split_into_tiles(height, width))
+    if workers <= 1:
+        for frame, camera in enumerate(cameras):
+            ray_tracer.set_camera(camera)
+            img_mat = np.zeros((height, width, COLOR_CHANNELS))
+            render_tiles(ray_tracer, img_mat, tiles, seed=seed)
+            yield frame, img_mat
+        return
+
+    tasks = [
+        (frame, camera, tile) for frame, camera in enumerate(cameras) for tile in tiles
+    ]
+    with multiprocessing.Pool(
+        workers,
+        initializer=_init_worker,
+        initargs=(
+            ray_tracer,
+            None,
+            (height, width),
+            seed,
+            stats.active() is not None,
+        ),
+    ) as pool:
+        img_mat = np.zeros((height, width, COLOR_CHANNELS))
+        rendered_tiles = 0
+        for (
+            frame,
+            tile,
+            statistics,
+            bvh_counts,
+            pixels,
+            _,
+            render_statistics,
+        ) in progressbar(
+            _bounded_imap(
+                pool,
+                _render_frame_tile_in_worker,
+                tasks,
+                ANIMATION_FRAMES_IN_FLIGHT * len(tiles),
+            ),
+            count=len(tasks),
+            prefix="Computing: ",
+        ):
+            _merge_tile_statistics(
+                ray_tracer, statistics, bvh_counts, render_statistics
+            )
+            img_mat[tile.top : tile.bottom, tile.left : tile.right] = pixels
+            stats.notify("tile")
+            rendered_tiles += 1
+            if rendered_tiles == len(tiles):
+                yield frame, img_mat
+                img_mat = np.zeros((height, width, COLOR_CHANNELS))
+                rendered_tiles = 0
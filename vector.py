@@ -17,3 +17,31 @@ def orthonormal_vector_pair(vector: np.ndarray) -> Tuple[np.ndarray, np.ndarray]
     vec2 = np.cross(vector, vec1)
     vec2 /= np.linalg.norm(vec2)
     return vec1, vec2
+
+
+def orthonormal_vector_pairs(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The batched version of orthonormal_vector_pair, receive an (N, 3) array of vectors and
+    return two (N, 3) arrays of vectors which are orthonormal to them, row by row.
+    """
+    fixed_vectors = np.zeros_like(vectors)
+    near_x_axis = np.all(np.isclose(vectors, [1.0, 0.0, 0.0], atol=EPSILON), axis=1)
+    fixed_vectors[~near_x_axis, 0] = 1.0
+    fixed_vectors[near_x_axis, 1] = 1.0
+    vec1 = normalize_rows(np.cross(vectors, fixed_vectors))
+    vec2 = normalize_rows(np.cross(vectors, vec1))
+    return vec1, vec2
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """
+    Receive an (N, 3) array of vectors and return it with every row scaled to unit length.
+    """
+    return vectors / np.linalg.norm(vectors, axis=1)[:, np.newaxis]
+
+
+def dot_rows(vectors1: np.ndarray, vectors2: np.ndarray) -> np.ndarray:
+    """
+    Return the row-wise dot product of two (N, 3) arrays of vectors.
+    """
+    return np.einsum("ij,ij->i", vectors1, vectors2)